@@ -33,6 +33,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'storage.instrumentation.QueryInstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,17 +65,107 @@ WSGI_APPLICATION = 'config.wsgi.application'
 
 
 # Database
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-#         "ENGINE": "django.db.backends.postgresql",
-#         "NAME": os.getenv("POSTGRES_DB"),
-#         "USER": os.getenv("POSTGRES_USER"),
-#         "PASSWORD": os.getenv("POSTGRES_PASSWORD"),
-#         "HOST": os.getenv("POSTGRES_HOST"),
-#         "PORT": os.getenv("POSTGRES_PORT"),
+# По умолчанию SQLite. Если задан POSTGRES_DB - PostgreSQL с постоянными
+# соединениями (драйвер psycopg из requirements.txt); POSTGRES_REPLICA_HOST добавляет реплику для тяжелых чтений.
+# POSTGRES_PGBOUNCER=1 - соединения идут через pgbouncer (transaction pooling).
+# DATABASE_REPLICA=sqlite - реплика-заглушка на том же файле SQLite для локальных тестов.
+# SQLITE_NAME - путь к файлу SQLite вместо db.sqlite3.
+
+def postgres_database(host, port):
+    return {
+        "ENGINE": "django.db.backends.postgresql",
+        "NAME": os.getenv("POSTGRES_DB"),
+        "USER": os.getenv("POSTGRES_USER"),
+        "PASSWORD": os.getenv("POSTGRES_PASSWORD"),
+        "HOST": host,
+        "PORT": port,
+        "CONN_MAX_AGE": int(os.getenv("CONN_MAX_AGE", "60")),
+        "CONN_HEALTH_CHECKS": True,
+        "DISABLE_SERVER_SIDE_CURSORS": os.getenv("POSTGRES_PGBOUNCER") == "1",
+        "OPTIONS": {
+            "connect_timeout": int(os.getenv("POSTGRES_CONNECT_TIMEOUT", "5")),
+            "application_name": os.getenv("POSTGRES_APPLICATION_NAME", "dip_shop_storage"),
+        },
+    }
+
+
+if os.getenv("POSTGRES_DB"):
+    DATABASES = {
+        'default': postgres_database(os.getenv("POSTGRES_HOST"), os.getenv("POSTGRES_PORT")),
+    }
+    if os.getenv("POSTGRES_REPLICA_HOST"):
+        DATABASES['replica'] = postgres_database(
+            os.getenv("POSTGRES_REPLICA_HOST"),
+            os.getenv("POSTGRES_REPLICA_PORT", os.getenv("POSTGRES_PORT")),
+        )
+        DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+else:
+    # SQLITE_CONCURRENT=1 - WAL, busy timeout и BEGIN IMMEDIATE для нескольких кассиров
+    SQLITE_ENGINE = 'storage.backends.sqlite3' if os.getenv("SQLITE_CONCURRENT") == "1" else 'django.db.backends.sqlite3'
+    SQLITE_NAME = os.getenv("SQLITE_NAME", BASE_DIR / 'db.sqlite3')
+    DATABASES = {
+        'default': {
+            'ENGINE': SQLITE_ENGINE,
+            'NAME': SQLITE_NAME,
+        }
+    }
+    if os.getenv("DATABASE_REPLICA") == "sqlite":
+        DATABASES['replica'] = {
+            'ENGINE': SQLITE_ENGINE,
+            'NAME': SQLITE_NAME,
+            'TEST': {'MIRROR': 'default'},
+        }
+
+DATABASE_ROUTERS = ['storage.routers.ReplicaRouter']
+
+
+# Cache
+# REDIS_URL - общий кеш в Redis (клиент redis из requirements.txt), CACHE_DIR - файловый кеш, общий для процессов
+# на одной машине; иначе кеш в памяти процесса. Он годится только для одного
+# процесса: сброс кеша итогов не доходит до других (см. storage.cache).
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv("REDIS_URL"),
+        }
+    }
+elif os.getenv("CACHE_DIR"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv("CACHE_DIR"),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'storage',
+        }
     }
+
+
+# Query instrumentation, see storage.instrumentation
+# по умолчанию только при DEBUG: в production включается явно, STORAGE_QUERY_INSTRUMENTATION=1
+STORAGE_QUERY_INSTRUMENTATION = os.getenv("STORAGE_QUERY_INSTRUMENTATION", "1" if DEBUG else "0") == "1"
+STORAGE_QUERY_LOG = os.getenv("STORAGE_QUERY_LOG")
+STORAGE_QUERY_COUNT_WARNING = int(os.getenv("STORAGE_QUERY_COUNT_WARNING", "50"))
+STORAGE_QUERY_TIME_WARNING_MS = int(os.getenv("STORAGE_QUERY_TIME_WARNING_MS", "500"))
+
+# Shared in-memory stock index, see storage.stockindex (off when unset)
+STORAGE_STOCK_INDEX = os.getenv("STORAGE_STOCK_INDEX")
+STORAGE_STOCK_INDEX_RECONCILE = int(os.getenv("STORAGE_STOCK_INDEX_RECONCILE", "300"))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'storage': {'handlers': ['console'], 'level': os.getenv("STORAGE_LOG_LEVEL", "INFO")},
+    },
 }
 
 
@@ -118,5 +209,10 @@ MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
 
+# Группа операций в админке отправляет по шесть полей на строку,
+# стандартных 1000 полей хватает лишь на полторы сотни строк
+DATA_UPLOAD_MAX_NUMBER_FIELDS = 10000
+
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
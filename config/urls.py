@@ -1,5 +1,5 @@
 from django.contrib import admin
-from django.urls import path
+from django.urls import include, path
 from django.conf import settings
 from django.conf.urls.static import static
 
@@ -12,6 +12,7 @@ def redirect_to_admin_page(request):
 urlpatterns = [
     path('', redirect_to_admin_page),
     path('admin/', admin.site.urls),
+    path('api/', include('storage.urls')),
 ]
 
 
@@ -1,8 +1,35 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
 from django.contrib import admin
-from .models import Category, Product, Counterparty, OperationGroup, Operation
-from django.utils.safestring import mark_safe
-from django.db.models import Sum
-from .utils import get_remaining_product
+from django.core.exceptions import PermissionDenied
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404
+from django.urls import path, reverse
+from django import forms
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.forms.models import BaseInlineFormSet
+from django.template.response import TemplateResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from django.utils.functional import cached_property
+from .models import (
+    Category, Product, Counterparty, OperationGroup, Operation, DailyRollup, Watermark, Job, JobStatus,
+    OpeningBalance, ArchivedOperationGroup, ArchivedOperation,
+)
+from django.utils.html import format_html
+from django.db.models import Case, F, IntegerField, When
+from django.db.models.functions import Coalesce
+from .cache import category_totals_many, counterparty_turnover_many
+from .exports import streaming_export
+from .images import rendition_urls
+from .pagination import EstimatedCountPaginator, KeysetChangeList
+from . import jobs, reports, search
+from .rollups import WATERMARK
+from .routers import replica_reads
+from .services import group_edit_deltas, lock_and_check, save_group_lines
 
 
 
@@ -11,27 +38,191 @@ admin.site.site_header = "Склад магазина - ALive"
 admin.site.index_title = "Добро пожаловать на склад магазина - ALive"
 
 
+class PageTotalsMixin:
+    """ Итоги строк страницы списка: одно чтение кеша и один запрос для промахов
+    на всю страницу, а не по запросу на строку. page_totals(ids) -> {pk: итоги}.
+    """
+    
+    page_totals = None
+    
+    def get_changelist_instance(self, request):
+        changelist = super().get_changelist_instance(request)
+        rows = list(changelist.result_list)
+        totals = self.page_totals([obj.pk for obj in rows])
+        for obj in rows:
+            obj.totals = totals[obj.pk]
+        return changelist
+    
+    def row_totals(self, obj):
+        totals = getattr(obj, 'totals', None)
+        return totals if totals is not None else self.page_totals([obj.pk])[obj.pk]
+
+
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(PageTotalsMixin, admin.ModelAdmin):
     """ Административная панель для модели Category.
     """
     
     search_fields = ('name', )
-    list_display = ('name', 'created_at', )
+    list_display = ('name', 'products_count', 'remaining_total', 'created_at', )
     readonly_fields = ('created_at', 'updated_at', )
+    # итоги берутся из кеша и сбрасываются сигналами при изменении товаров и операций
+    page_totals = staticmethod(category_totals_many)
+    
+    def products_count(self, obj) -> int:
+        return self.row_totals(obj)['products']
+    
+    def remaining_total(self, obj) -> int:
+        return self.row_totals(obj)['remaining']
+    
+    products_count.short_description = 'товаров'
+    remaining_total.short_description = 'общий остаток'
+    
+    
+
+class ReplicaChangelistMixin:
+    """ Список объектов (GET) читается с реплики базы, если она настроена.
+    """
+    
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context)
+        with replica_reads():
+            return super().changelist_view(request, extra_context)
+
+
+class AutocompleteFilter(admin.SimpleListFilter):
+    """ Фильтр по внешнему ключу field_name с автодополнением: боковая панель не загружает
+    все связанные объекты. Параметр тот же, что у стандартного фильтра (<поле>__id__exact).
+    """
+    
+    field_name = None
+    template = 'admin/storage/autocomplete_filter.html'
+    
+    def __init__(self, request, params, model, model_admin):
+        self.field = model._meta.get_field(self.field_name)
+        self.title = self.field.verbose_name
+        self.parameter_name = f'{self.field_name}__{self.field.target_field.attname}__exact'
+        self.admin_site = model_admin.admin_site
+        super().__init__(request, params, model, model_admin)
+    
+    def has_output(self):
+        return True
+    
+    def lookups(self, request, model_admin):
+        return ()
+    
+    def queryset(self, request, queryset):
+        value = self.value()
+        if value is None:
+            return queryset
+        if not value.isdigit():
+            raise IncorrectLookupParameters
+        return queryset.filter(**{self.field.attname: value})
+    
+    def choices(self, changelist):
+        yield {
+            'selected': self.value() is None,
+            'query_string': changelist.get_query_string(remove=[self.parameter_name]),
+            'display': 'Все',
+        }
+    
+    def widget(self) -> str:
+        # в виджет загружается только выбранный объект, остальные приходят из автодополнения
+        field = forms.ModelChoiceField(
+            self.field.remote_field.model._default_manager.all(),
+            required=False,
+            widget=AutocompleteSelect(self.field, self.admin_site),
+        )
+        return field.widget.render(self.parameter_name, self.value(), attrs={
+            'id': f'filter_{self.parameter_name}',
+            'class': 'autocomplete-filter',
+            'data-filter-parameter': self.parameter_name,
+            'style': 'width: 100%',
+        })
+
+
+class CounterpartyFilter(AutocompleteFilter):
+    field_name = 'counterparty'
+
+
+class LargeChangelistMixin:
+    """ Списки больших таблиц: страницы по id вместо OFFSET (storage.pagination), количество
+    строк без COUNT(*) на каждой странице, фильтры по связанным объектам с автодополнением.
+    """
+    
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    change_list_template = 'admin/storage/keyset_change_list.html'
+    
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+    
+    @property
+    def media(self):
+        media = super().media
+        if any(isinstance(spec, type) and issubclass(spec, AutocompleteFilter) for spec in self.list_filter):
+            media += AutocompleteSelect(None, self.admin_site).media + forms.Media(js=['storage/admin/autocomplete_filter.js'])
+        return media
+
+
+class IndexedSearchMixin:
+    """ Поиск по поисковой таблице (storage.search) вместо цепочки icontains.
+    В автодополнении лучшие совпадения идут первыми.
+    """
+    
+    search_index = None
+    search_rank_limit = 100
     
+    def get_search_results(self, request, queryset, search_term):
+        subquery = search.matching(self.search_index, search_term)
+        if subquery is None:
+            return super().get_search_results(request, queryset, search_term)
+        if request.resolver_match and request.resolver_match.url_name == 'autocomplete':
+            # в подсказках только лучшие совпадения, дальше пользователь уточняет запрос
+            ids = search.ranked_ids(self.search_index, search_term, self.search_rank_limit)
+            rank = Case(*[When(pk=pk, then=position) for position, pk in enumerate(ids)], output_field=IntegerField())
+            return queryset.filter(pk__in=ids).order_by(rank), False
+        return queryset.filter(pk__in=subquery), False
+
+
+class StockStatusFilter(admin.SimpleListFilter):
+    """ Фильтр товаров по остатку, работает по аннотации remaining.
+    """
+    
+    title = 'остаток'
+    parameter_name = 'stock'
+    
+    def lookups(self, request, model_admin):
+        return (
+            ('out', 'Нет в наличии'),
+            ('low', 'Заканчивается'),
+            ('in', 'В наличии'),
+        )
+        
+    def queryset(self, request, queryset):
+        low = getattr(settings, 'STORAGE_LOW_STOCK_THRESHOLD', 10)
+        if self.value() == 'out':
+            return queryset.filter(remaining__lte=0)
+        if self.value() == 'low':
+            return queryset.filter(remaining__gt=0, remaining__lte=low)
+        if self.value() == 'in':
+            return queryset.filter(remaining__gt=low)
+        return queryset
     
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(IndexedSearchMixin, ReplicaChangelistMixin, admin.ModelAdmin):
     """ Административная панель для модели Product.
     """
     
     search_fields = ('name', 'category__name', )
+    search_index = 'product'
     list_display = ('name', 'get_remaining',  'show_image', 'category', 'created_at', )
     readonly_fields = ('show_image', 'created_at', 'updated_at', 'created_by', 'updated_by', )
     autocomplete_fields = ('category', )
-    list_filter = ('category', )
+    list_filter = (StockStatusFilter, 'category', )
+    actions = ('export_stock_csv', 'export_stock_jsonl', )
     fieldsets = (
         ('Информация', {
             "fields": (
@@ -57,13 +248,24 @@ class ProductAdmin(admin.ModelAdmin):
     )
     
 
+    def get_queryset(self, request):
+        # остаток берется из таблицы Stock одним JOIN, без запросов на строку
+        return super().get_queryset(request).annotate(remaining=Coalesce(F('stock__quantity'), 0))
+
     def get_remaining(self, obj):
-        return get_remaining_product(product=obj)
+        return obj.remaining
     
     
     def show_image(self, obj):
+        # оригинал не загружается, только уменьшенная копия; пока ее нет - подпись
+        if obj.image_hash:
+            urls = rendition_urls(obj.image_hash)['thumb']
+            return format_html(
+                '<picture><source srcset="{}" type="image/webp"><img src="{}" width="50" height="50" loading="lazy" /></picture>',
+                urls['webp'], urls['jpg'],
+            )
         if bool(obj.image):
-            return mark_safe('<img src="{}" width="50" height="50" />'.format(obj.image.url))
+            return 'обрабатывается'
 
     def save_model(self, request, obj, form, change):
         if not obj.pk:
@@ -71,18 +273,29 @@ class ProductAdmin(admin.ModelAdmin):
         obj.updated_by = request.user
         obj.save()
         
+    @admin.action(description='Выгрузить остатки (CSV)')
+    def export_stock_csv(self, request, queryset):
+        return streaming_export('stock', 'csv', queryset)
+
+    @admin.action(description='Выгрузить остатки (JSONL)')
+    def export_stock_jsonl(self, request, queryset):
+        return streaming_export('stock', 'jsonl', queryset)
+        
     get_remaining.short_description = 'остатка'
+    get_remaining.admin_order_field = 'remaining'
     show_image.short_description = 'изображение'
     
     
 @admin.register(Counterparty)
-class CounterpartyAdmin(admin.ModelAdmin):
+class CounterpartyAdmin(PageTotalsMixin, IndexedSearchMixin, admin.ModelAdmin):
     """ Административная панель для модели Counterparty.
     """
     
-    list_display = ('full_name', 'phone', 'company_name', 'created_at', )
+    list_display = ('full_name', 'phone', 'company_name', 'sale_turnover', 'receipt_turnover', 'created_at', )
     search_fields = ('full_name', 'phone', 'company_name', )
+    search_index = 'counterparty'
     readonly_fields = ('created_by', 'updated_by', 'created_at', 'updated_at', )
+    page_totals = staticmethod(counterparty_turnover_many)
     fieldsets = (
         ('Информация', {
             "fields": (
@@ -105,16 +318,121 @@ class CounterpartyAdmin(admin.ModelAdmin):
         }),
     )
     
+    def sale_turnover(self, obj) -> Decimal:
+        return self.row_totals(obj)['sale']
+    
+    def receipt_turnover(self, obj) -> Decimal:
+        return self.row_totals(obj)['receipt']
+    
     def save_model(self, request, obj, form, change):
         if not obj.pk:
             obj.created_by = request.user
         obj.updated_by = request.user
         obj.save()
         
+    sale_turnover.short_description = 'продажи на сумму'
+    receipt_turnover.short_description = 'приемы на сумму'
+        
         
+class PrefetchedModelChoiceField(forms.ModelChoiceField):
+    """ Выбор объекта, который сначала ищется в общем словаре формсета {str(pk): объект},
+    а не отдельным запросом на каждую строку.
+    """
+    
+    objects = None
+    
+    def to_python(self, value):
+        if self.objects is not None and value not in self.empty_values and str(value) in self.objects:
+            return self.objects[str(value)]
+        return super().to_python(value)
+
+
+class PrefetchedAutocompleteSelect(AutocompleteSelect):
+    """ Автодополнение, выбранное значение которого подписывается из словаря поля PrefetchedModelChoiceField.
+    """
+    
+    def optgroups(self, name, value, attr=None):
+        objects = self.choices.field.objects
+        selected = {str(v) for v in value if str(v) not in self.choices.field.empty_values}
+        if objects is None or not selected <= objects.keys():
+            return super().optgroups(name, value, attr)
+        default = (None, [], 0)
+        if not self.is_required:
+            default[1].append(self.create_option(name, '', '', False, 0))
+        for pk in sorted(selected):
+            obj = objects[pk]
+            default[1].append(
+                self.create_option(name, obj.pk, self.choices.field.label_from_instance(obj), selected, len(default[1]))
+            )
+        return [default]
+
+
+class OperationInlineForm(forms.ModelForm):
+    """ Строка операции без повторной проверки товара моделью.
+    """
+    
+    def _get_validation_exclusions(self):
+        exclude = super()._get_validation_exclusions()
+        # товар уже найден полем формы, ForeignKey.validate повторил бы запрос на каждую строку
+        exclude.add('product')
+        return exclude
+
+
+class OperationInlineFormSet(BaseInlineFormSet):
+    """ Не дает сохранить группу, после которой остаток товара станет отрицательным.
+    
+    Форма админки проверяется внутри транзакции changeform_view, поэтому
+    заблокированные строки остатков держатся до сохранения операций.
+    Товары всех строк вместе с категорией и остатком читаются заранее,
+    а не по запросу на строку.
+    """
+    
+    @cached_property
+    def operations(self) -> dict:
+        return {str(operation.pk): operation for operation in self.get_queryset()}
+    
+    @cached_property
+    def products(self) -> dict:
+        products = {str(operation.product_id): operation.product for operation in self.operations.values()}
+        if self.is_bound:
+            selected = {
+                self.data.get(f'{self.add_prefix(number)}-product')
+                for number in range(self.total_form_count())
+            }
+            missing = [pk for pk in selected if pk and pk.isdigit() and pk not in products]
+            for product in Product.objects.select_related('category', 'stock').filter(pk__in=missing):
+                products[str(product.pk)] = product
+        return products
+    
+    def add_fields(self, form, index):
+        super().add_fields(form, index)
+        # скрытое поле id тоже ищет свою операцию запросом на строку
+        pk_name = self.model._meta.pk.name
+        field = form.fields.get(pk_name)
+        if isinstance(field, forms.ModelChoiceField):
+            form.fields[pk_name] = PrefetchedModelChoiceField(field.queryset, initial=field.initial, required=False, widget=field.widget)
+            form.fields[pk_name].objects = self.operations
+        field = form.fields.get('product')
+        if isinstance(field, PrefetchedModelChoiceField):
+            field.objects = self.products
+    
+    def clean(self):
+        super().clean()
+        if any(self.errors):
+            return
+        lines = [
+            (form.cleaned_data['product'].pk, form.cleaned_data['quantity'])
+            for form in self.forms
+            if form.cleaned_data.get('product') and form.cleaned_data.get('quantity') is not None and not form.cleaned_data.get('DELETE')
+        ]
+        lock_and_check(group_edit_deltas(self.instance, lines))
+    
+    
 # use Operation inline for OperationGroup 
 class OperationInline(admin.TabularInline):
     model = Operation
+    form = OperationInlineForm
+    formset = OperationInlineFormSet
     extra = 3
     autocomplete_fields = ('product', )
     readonly_fields = ('created_by', 'updated_by', 'created_at', 'updated_at', 'amount', 'action', )
@@ -125,32 +443,65 @@ class OperationInline(admin.TabularInline):
         'discount',
     )
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product__category', 'product__stock')
+    
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # выбранные товары выводятся через Product.__str__, остаток подгружаем сразу
+        if db_field.name == 'product':
+            kwargs['queryset'] = Product.objects.select_related('stock')
+            kwargs['form_class'] = PrefetchedModelChoiceField
+            kwargs['widget'] = PrefetchedAutocompleteSelect(db_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+    
     
 @admin.register(OperationGroup)
-class OperationGroup(admin.ModelAdmin):
+class OperationGroupAdmin(LargeChangelistMixin, ReplicaChangelistMixin, admin.ModelAdmin):
     """ Административная панель для модели OperationGroup."""
     
     autocomplete_fields = ('counterparty', )
     list_display = ('counterparty', 'quantity_product',  'amount_product', 'action', "created_at", )
-    list_filter = ('action', 'counterparty', )
+    list_filter = ('action', CounterpartyFilter, )
     search_fields = ('counterparty__full_name', )
     readonly_fields = ('created_by', 'updated_by', 'created_at', 'updated_at', )
     inlines = [OperationInline, ]
+    actions = ('export_groups_csv', 'export_operations_csv', 'export_operations_jsonl', 'export_operations_background', )
 
+    def get_queryset(self, request):
+        # итоги хранятся в самой группе, соединение с операциями не нужно
+        return super().get_queryset(request).select_related('counterparty')
 
     def quantity_product(self, obj) -> int:
-        if obj.operation_set.exists():
-            return Operation.objects.filter(operation_group=obj).values_list('quantity', flat=True).aggregate(total_quantity=Sum('quantity')).get('total_quantity')
-        return 0
+        return obj.total_quantity
     
-    def amount_product(self, obj) -> float:
-        if obj.operation_set.exists():
-            amount = sum([i.amount for i in Operation.objects.filter(operation_group=obj)])
-            return round(amount, 2)
-        return 0.00
+    def amount_product(self, obj) -> Decimal:
+        return obj.total_amount
+
+    @admin.action(description='Выгрузить итоги групп (CSV)')
+    def export_groups_csv(self, request, queryset):
+        return streaming_export('groups', 'csv', OperationGroup.objects.filter(pk__in=queryset.order_by().values('pk')))
+
+    @admin.action(description='Выгрузить операции групп (CSV)')
+    def export_operations_csv(self, request, queryset):
+        return streaming_export('operations', 'csv', Operation.objects.filter(operation_group__in=queryset.order_by().values('pk')))
+
+    @admin.action(description='Выгрузить операции групп (JSONL)')
+    def export_operations_jsonl(self, request, queryset):
+        return streaming_export('operations', 'jsonl', Operation.objects.filter(operation_group__in=queryset.order_by().values('pk')))
+
+    @admin.action(description='Выгрузить операции групп в файл (в фоне)')
+    def export_operations_background(self, request, queryset):
+        ids = list(queryset.order_by().values_list('pk', flat=True))
+        job = jobs.enqueue('export', {'kind': 'operations', 'fmt': 'csv', 'ids': ids}, user=request.user)
+        self.message_user(request, format_html(
+            'Выгрузка поставлена в очередь: <a href="{}">задача №{}</a>',
+            reverse('admin:storage_job_change', args=(job.pk,)), job.pk,
+        ))
 
     amount_product.short_description = "Общая сумма товаров"
+    amount_product.admin_order_field = 'total_amount'
     quantity_product.short_description = "Количество товаров"
+    quantity_product.admin_order_field = 'total_quantity'
     
     
     
@@ -158,4 +509,227 @@ class OperationGroup(admin.ModelAdmin):
         if not obj.pk:
             obj.created_by = request.user
         obj.updated_by = request.user
-        obj.save()
\ No newline at end of file
+        obj.save()
+
+    def save_formset(self, request, form, formset, change):
+        if formset.model is not Operation:
+            return super().save_formset(request, form, formset, change)
+        # строки пишутся пачкой, остатки и итоги ведет save_group_lines вместо сигналов
+        formset.save(commit=False)
+        # удаляемые строки могли быть изменены в той же форме, сигналам нужны значения из базы
+        deleted = Operation.objects.filter(pk__in=[operation.pk for operation in formset.deleted_objects])
+        for operation in deleted.select_related('operation_group'):
+            operation.delete()
+        save_group_lines(
+            form.instance,
+            formset.new_objects,
+            [operation for operation, changed_fields in formset.changed_objects],
+            request.user,
+        )
+
+
+def _date_param(request, name):
+    try:
+        return parse_date(request.GET.get(name) or '')
+    except ValueError:
+        return None
+
+
+@admin.register(DailyRollup)
+class ReportsAdmin(admin.ModelAdmin):
+    """ Отчеты по продажам и складу. Читаются из дневных итогов, которые строит build_rollups.
+    """
+    
+    report_days = 30
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+    
+    def changelist_view(self, request, extra_context=None):
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        end = _date_param(request, 'end') or timezone.localdate()
+        start = _date_param(request, 'start') or end - timedelta(days=self.report_days - 1)
+        year = int(request.GET['year']) if request.GET.get('year', '').isdigit() else end.year
+        with replica_reads():
+            daily = reports.daily_revenue(start, end)
+            context = {
+                **self.admin_site.each_context(request),
+                'title': self.model._meta.verbose_name_plural,
+                'opts': self.model._meta,
+                'start': start,
+                'end': end,
+                'year': year,
+                'watermark': Watermark.objects.filter(name=WATERMARK).first(),
+                'daily': daily,
+                'daily_total': sum((row['amount'] for row in daily), Decimal('0')),
+                'categories': reports.revenue_by_category(start, end),
+                'counterparties': reports.revenue_by_counterparty(start, end),
+                'top_products': reports.top_products(start, end),
+                'turnover': reports.turnover(start, end),
+                'slow_moving': reports.slow_moving(end),
+                'year_over_year': reports.year_over_year(year),
+                **(extra_context or {}),
+            }
+        return TemplateResponse(request, 'admin/storage/dailyrollup/reports.html', context)
+
+
+
+class JobForm(forms.ModelForm):
+    """ Постановка задачи из админки, только задачи без параметров.
+    """
+    
+    name = forms.ChoiceField(label="Задача")
+    
+    class Meta:
+        model = Job
+        fields = ('name', 'priority')
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['name'].choices = [(name, task.title) for name, task in jobs.TASKS.items() if task.admin]
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    """ Очередь фоновых задач: ход выполнения, ошибки, задержка и пропускная способность.
+    Задачи выполняет run_workers, из админки их можно только поставить, повторить или отменить.
+    """
+    
+    list_display = ('__str__', 'title', 'status', 'priority', 'progress_display', 'attempts', 'created_at', 'started_at', 'finished_at', 'download', )
+    list_filter = ('status', 'name', )
+    actions = ('retry_jobs', 'cancel_jobs', )
+    change_list_template = 'admin/storage/job/change_list.html'
+    view_fields = (
+        'name', 'payload', 'status', 'priority', 'idempotency_key', 'attempts', 'max_attempts', 'progress_display',
+        'message', 'result', 'download', 'error', 'worker', 'run_after', 'created_at', 'started_at', 'heartbeat_at',
+        'finished_at', 'created_by',
+    )
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def get_form(self, request, obj=None, **kwargs):
+        if obj is None:
+            kwargs['form'] = JobForm
+        return super().get_form(request, obj, **kwargs)
+    
+    def get_fields(self, request, obj=None):
+        return ('name', 'priority') if obj is None else self.view_fields
+    
+    def get_readonly_fields(self, request, obj=None):
+        return () if obj is None else self.view_fields
+    
+    def save_model(self, request, obj, form, change):
+        obj.run_after = timezone.now()
+        obj.created_by = request.user
+        obj.save()
+    
+    def changelist_view(self, request, extra_context=None):
+        return super().changelist_view(request, {'queue_stats': jobs.queue_stats(), **(extra_context or {})})
+    
+    def get_urls(self):
+        return [
+            path('<int:job_id>/download/', self.admin_site.admin_view(self.download_view), name='storage_job_download'),
+            *super().get_urls(),
+        ]
+    
+    def download_view(self, request, job_id):
+        job = Job.objects.filter(pk=job_id).first()
+        if job is None:
+            raise Http404("Задача не найдена")
+        if not self.has_view_permission(request, job):
+            raise PermissionDenied
+        name = (job.result or {}).get('file') if isinstance(job.result, dict) else None
+        if not name or not default_storage.exists(name):
+            raise Http404("Файл выгрузки не найден")
+        return FileResponse(default_storage.open(name, 'rb'), as_attachment=True, filename=name.rsplit('/', 1)[-1])
+    
+    def title(self, obj) -> str:
+        task = jobs.TASKS.get(obj.name)
+        return task.title if task else obj.name
+    
+    def progress_display(self, obj) -> str:
+        if obj.progress_total:
+            text = f"{obj.progress} / {obj.progress_total} ({obj.progress * 100 // obj.progress_total}%)"
+        else:
+            text = str(obj.progress) if obj.progress else ''
+        return f"{text} {obj.message}".strip()
+    
+    def download(self, obj):
+        if obj.status == JobStatus.DONE and isinstance(obj.result, dict) and obj.result.get('file'):
+            return format_html('<a href="{}">скачать</a>', reverse('admin:storage_job_download', args=(obj.pk,)))
+        return ''
+    
+    @admin.action(description='Повторить выбранные задачи', permissions=['add'])
+    def retry_jobs(self, request, queryset):
+        updated = queryset.filter(status__in=(JobStatus.FAILED, JobStatus.CANCELLED)).update(
+            status=JobStatus.QUEUED, attempts=0, run_after=timezone.now(), finished_at=None,
+        )
+        self.message_user(request, f"Возвращено в очередь: {updated}")
+    
+    @admin.action(description='Отменить выбранные задачи', permissions=['add'])
+    def cancel_jobs(self, request, queryset):
+        updated = queryset.filter(status=JobStatus.QUEUED).update(status=JobStatus.CANCELLED, finished_at=timezone.now())
+        self.message_user(request, f"Отменено: {updated}")
+    
+    title.short_description = 'название'
+    progress_display.short_description = 'выполнено'
+    download.short_description = 'файл'
+
+
+
+class ReadOnlyAdminMixin:
+    """ Только просмотр: архив меняет лишь archive_operations.
+    """
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class ArchivedOperationInline(ReadOnlyAdminMixin, admin.TabularInline):
+    model = ArchivedOperation
+    fields = ('product', 'price', 'quantity', 'discount', 'amount', 'created_at', )
+    readonly_fields = fields
+    extra = 0
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product')
+
+
+@admin.register(ArchivedOperationGroup)
+class ArchivedOperationGroupAdmin(ReadOnlyAdminMixin, LargeChangelistMixin, ReplicaChangelistMixin, admin.ModelAdmin):
+    """ Группы операций, перенесенные в архив командой archive_operations.
+    """
+    
+    list_display = ('__str__', 'counterparty', 'total_quantity', 'total_amount', 'action', 'created_at', 'archived_at', )
+    list_filter = ('action', CounterpartyFilter, )
+    search_fields = ('=id', 'counterparty__full_name', )
+    inlines = [ArchivedOperationInline, ]
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('counterparty')
+
+
+@admin.register(OpeningBalance)
+class OpeningBalanceAdmin(ReadOnlyAdminMixin, admin.ModelAdmin):
+    """ Начальные остатки: количество перенесенных в архив операций по товарам.
+    """
+    
+    list_display = ('product', 'quantity', 'lines', 'updated_at', )
+    search_fields = ('product__name', )
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('product__stock')
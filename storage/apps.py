@@ -5,3 +5,6 @@ class StorageConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'storage'
     verbose_name = 'Склад'
+
+    def ready(self):
+        from . import signals, tasks  # noqa: F401
@@ -0,0 +1,132 @@
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Optional, Tuple
+
+from django.db import connection, transaction
+from django.db.models import Count, DateTimeField, F, Sum, Value
+from django.utils import timezone
+
+from .models import OperationGroup, Operation, Watermark, OpeningBalance, ArchivedOperationGroup, ArchivedOperation
+
+
+# Архив истории: archive_operations переносит старые группы вместе с операциями
+# в ArchivedOperationGroup и ArchivedOperation, а количество со знаком складывает
+# в OpeningBalance. Остаток товара = начальный остаток + рабочие операции, Stock
+# при переносе не меняется. Журнал операций перенос не записывает: история та же,
+# отчеты по архивным дням остаются как были.
+
+WATERMARK = 'archive'
+
+GROUP_COLUMNS = (
+    'id', 'counterparty_id', 'action', 'comment', 'total_quantity', 'total_amount', 'lines_count',
+    'created_at', 'updated_at', 'created_by_id', 'updated_by_id',
+)
+OPERATION_COLUMNS = (
+    'id', 'product_id', 'operation_group_id', 'quantity', 'price', 'discount', 'amount', 'signed_quantity',
+    'created_at', 'updated_at', 'created_by_id', 'updated_by_id',
+)
+
+
+@dataclass
+class ArchiveStats:
+    groups: int = 0
+    operations: int = 0
+    seconds: float = 0.0
+
+
+def lock_archive() -> Watermark:
+    """ До конца транзакции не дает переносить операции. Пересчеты по рабочим таблицам
+    и архиву (остатки, отчеты) иначе могут учесть перенесенную пачку дважды.
+    """
+    Watermark.objects.get_or_create(name=WATERMARK)
+    return Watermark.objects.select_for_update().get(name=WATERMARK)
+
+
+def _insert_select(cursor, model, columns: Tuple[str, ...], rows) -> None:
+    quote = connection.ops.quote_name
+    sql, params = rows.order_by().query.sql_with_params()
+    cursor.execute(
+        f"INSERT INTO {quote(model._meta.db_table)} ({', '.join(quote(column) for column in columns)}) {sql}",
+        params,
+    )
+
+
+def _add_opening(cursor, operations, now: datetime) -> None:
+    """ Прибавляет количество со знаком пачки операций к начальным остаткам одним INSERT ... ON CONFLICT.
+    """
+    rows = (
+        operations.order_by()
+        .values(opening_product=F('product_id'))
+        .annotate(opening_quantity=Sum('signed_quantity'), opening_lines=Count('id'))
+    )
+    sql, params = rows.query.sql_with_params()
+    table = connection.ops.quote_name(OpeningBalance._meta.db_table)
+    cursor.execute(
+        f'INSERT INTO {table} ("product_id", "quantity", "lines", "updated_at") '
+        f'SELECT opening_product, opening_quantity, opening_lines, %s FROM ({sql}) AS batch WHERE true '
+        f'ON CONFLICT ("product_id") DO UPDATE SET '
+        f'"quantity" = {table}."quantity" + excluded."quantity", '
+        f'"lines" = {table}."lines" + excluded."lines", '
+        f'"updated_at" = excluded."updated_at"',
+        (connection.ops.adapt_datetimefield_value(now), *params),
+    )
+
+
+def _move(groups) -> Tuple[int, int]:
+    """ Переносит группы (queryset) с их операциями в архив, возвращает (групп, операций).
+    """
+    now = timezone.now()
+    operations = Operation.objects.filter(operation_group__in=groups.values('id'))
+    quote = connection.ops.quote_name
+    ids_sql, ids_params = groups.order_by().values('id').query.sql_with_params()
+    with connection.cursor() as cursor:
+        _insert_select(
+            cursor, ArchivedOperationGroup, GROUP_COLUMNS + ('archived_at',),
+            groups.annotate(archive_time=Value(now, output_field=DateTimeField())).values_list(*GROUP_COLUMNS, 'archive_time'),
+        )
+        _insert_select(cursor, ArchivedOperation, OPERATION_COLUMNS, operations.values_list(*OPERATION_COLUMNS))
+        _add_opening(cursor, operations, now)
+        # сигналы не нужны: остатки не меняются, а история переезжает без изменений
+        cursor.execute(f"DELETE FROM {quote(Operation._meta.db_table)} WHERE {quote('operation_group_id')} IN ({ids_sql})", ids_params)
+        moved_operations = cursor.rowcount
+        cursor.execute(f"DELETE FROM {quote(OperationGroup._meta.db_table)} WHERE {quote('id')} IN ({ids_sql})", ids_params)
+        moved_groups = cursor.rowcount
+    return moved_groups, moved_operations
+
+
+def archive_operations(
+    before: datetime,
+    chunk_size: int = 500,
+    progress: Optional[Callable[[ArchiveStats], None]] = None,
+) -> ArchiveStats:
+    """ Переносит в архив группы, созданные раньше before, вместе с их операциями.
+
+    Каждые chunk_size групп переносятся отдельной короткой транзакцией,
+    прерванный запуск можно просто повторить.
+    """
+    stats = ArchiveStats()
+    started = time.monotonic()
+    after = 0
+    while True:
+        with transaction.atomic():
+            watermark = lock_archive()
+            old = OperationGroup.objects.filter(created_at__lt=before, id__gt=after)
+            ids = list(old.order_by('id').values_list('id', flat=True)[:chunk_size])
+            if not ids:
+                break
+            # правка из админки или apply_sale между копированием и удалением пропала бы из архива
+            # или дважды попала в начальные остатки: строки пачки блокируются по порядку id
+            locked = list(OperationGroup.objects.select_for_update().filter(id__in=ids).order_by('id').values_list('id', flat=True))
+            list(Operation.objects.select_for_update().filter(operation_group_id__in=locked).order_by('id').values_list('id', flat=True))
+            groups, operations = _move(OperationGroup.objects.filter(id__in=locked))
+            watermark.value = max(watermark.value, ids[-1])
+            watermark.save(update_fields=['value', 'updated_at'])
+        after = ids[-1]
+        stats.groups += groups
+        stats.operations += operations
+        stats.seconds = time.monotonic() - started
+        if progress:
+            progress(stats)
+    stats.seconds = time.monotonic() - started
+    return stats
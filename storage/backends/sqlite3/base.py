@@ -0,0 +1,35 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """ SQLite для нескольких одновременных пользователей.
+
+    WAL позволяет читать во время записи, busy_timeout ждет блокировку
+    вместо ошибки "database is locked", а BEGIN IMMEDIATE берет блокировку
+    записи в начале транзакции: иначе две транзакции, начавшие с чтения,
+    не могут повысить блокировку и одна из них сразу падает.
+    """
+
+    pragmas = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', 20000),
+        ('cache_size', -64000),
+        ('mmap_size', 268435456),
+        ('temp_store', 'MEMORY'),
+    )
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        # таймаут драйвера совпадает с busy_timeout
+        params.setdefault('timeout', 20)
+        return params
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute('BEGIN IMMEDIATE')
@@ -0,0 +1,301 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Callable, Dict, List
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import events
+from .jobs import enqueue, run_next
+from .models import Product, Counterparty, OperationGroup, Operation, Action, Stock
+from .rollups import build_rollups
+from .stockindex import StockIndex
+from .utils import apply_stock_deltas, get_remaining_product, set_group_totals
+
+
+@dataclass
+class Result:
+    name: str
+    timings: List[float] = field(default_factory=list)
+    queries: int = 0
+
+    def as_dict(self) -> dict:
+        timings = sorted(self.timings)
+        return {
+            'name': self.name,
+            'runs': len(timings),
+            'median_ms': round(statistics.median(timings) * 1000, 3),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 3),
+            'queries': self.queries,
+        }
+
+
+class Context:
+    """ Общие данные замеров: клиент админки и случайные объекты.
+    """
+
+    def __init__(self, seed: int = 1):
+        self.rng = random.Random(seed)
+        user = get_user_model().objects.filter(is_superuser=True).first()
+        if user is None:
+            raise RuntimeError("Нужен суперпользователь: python manage.py initadmin")
+        self.user = user
+        self.client = Client()
+        self.client.force_login(user)
+        self.product_ids = list(Product.objects.order_by().values_list('pk', flat=True)[:10000])
+        self.counterparty_id = Counterparty.objects.order_by().values_list('pk', flat=True).first()
+        self.group_id = OperationGroup.objects.order_by('-id').values_list('pk', flat=True).first()
+        if not self.product_ids or self.counterparty_id is None:
+            raise RuntimeError("Нет данных: python manage.py seed_warehouse")
+        self.cleanups: List[Callable[[], None]] = []
+
+    def close(self) -> None:
+        """ Освобождает ресурсы замеров (файлы, временные каталоги) в обратном порядке.
+        """
+        while self.cleanups:
+            self.cleanups.pop()()
+
+    def get(self, url: str) -> None:
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: HTTP {response.status_code}")
+
+
+BENCHMARKS: Dict[str, Callable[[Context], None]] = {}
+
+
+def benchmark(name: str):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+@benchmark('stock_lookup')
+def stock_lookup(context: Context) -> None:
+    get_remaining_product(Product(pk=context.rng.choice(context.product_ids)))
+
+
+def stock_sample(context: Context) -> List[int]:
+    if not hasattr(context, 'stock_ids'):
+        context.stock_ids = context.rng.sample(context.product_ids, min(1000, len(context.product_ids)))
+    return context.stock_ids
+
+
+@benchmark('stock_batch_db_1000')
+def stock_batch_db(context: Context) -> None:
+    list(Stock.objects.filter(product_id__in=stock_sample(context)).values_list('product_id', 'quantity'))
+
+
+@benchmark('stock_index_1000')
+def stock_index_batch(context: Context) -> None:
+    # отдельный файл индекса, настройка STORAGE_STOCK_INDEX не нужна
+    if not hasattr(context, 'stock_index'):
+        directory = tempfile.TemporaryDirectory()
+        context.cleanups.append(directory.cleanup)
+        context.stock_index = StockIndex(os.path.join(directory.name, 'stock.idx'))
+        context.cleanups.append(context.stock_index.close)
+        context.stock_index.reconcile()
+    context.stock_index.lookup(stock_sample(context))
+
+
+@benchmark('product_changelist')
+def product_changelist(context: Context) -> None:
+    context.get(reverse('admin:storage_product_changelist'))
+
+
+@benchmark('operationgroup_changelist')
+def operationgroup_changelist(context: Context) -> None:
+    context.get(reverse('admin:storage_operationgroup_changelist'))
+
+
+@benchmark('operationgroup_changelist_deep')
+def operationgroup_changelist_deep(context: Context) -> None:
+    # страница в глубине списка: по id она выбирается так же, как первая
+    if context.group_id:
+        context.get(reverse('admin:storage_operationgroup_changelist') + f'?after={context.rng.randint(1, context.group_id)}')
+
+
+@benchmark('product_autocomplete')
+def product_autocomplete(context: Context) -> None:
+    context.get(
+        reverse('admin:autocomplete')
+        + '?app_label=storage&model_name=operation&field_name=product&term=' + context.rng.choice('0123456789')
+    )
+
+
+@benchmark('operationgroup_change_form')
+def operationgroup_change_form(context: Context) -> None:
+    if context.group_id:
+        context.get(reverse('admin:storage_operationgroup_change', args=(context.group_id,)))
+
+
+@benchmark('reports')
+def reports(context: Context) -> None:
+    context.get(reverse('admin:storage_dailyrollup_changelist'))
+
+
+def inline_form_data(context: Context, lines: int) -> dict:
+    data = {
+        'counterparty': context.counterparty_id,
+        'action': Action.RECEIPT,
+        'comment': '',
+        'operation_set-TOTAL_FORMS': lines,
+        'operation_set-INITIAL_FORMS': 0,
+        'operation_set-MIN_NUM_FORMS': 0,
+        'operation_set-MAX_NUM_FORMS': 1000,
+    }
+    for number in range(lines):
+        data.update({
+            f'operation_set-{number}-product': context.rng.choice(context.product_ids),
+            f'operation_set-{number}-price': '10.00',
+            f'operation_set-{number}-quantity': 1,
+            f'operation_set-{number}-discount': '0',
+        })
+    return data
+
+
+@benchmark('inline_save_20')
+def inline_save(context: Context) -> None:
+    data = inline_form_data(context, 20)
+    # сохраненная группа откатывается, база не меняется
+    with transaction.atomic():
+        response = context.client.post(reverse('admin:storage_operationgroup_add'), data)
+        transaction.set_rollback(True)
+    if response.status_code != 302:
+        raise RuntimeError(f"inline save: HTTP {response.status_code}")
+
+
+LARGE_GROUP_LINES = 500
+
+
+def create_large_group(context: Context) -> OperationGroup:
+    """ Прием на LARGE_GROUP_LINES строк в обход сигналов, вызывается внутри откатываемой транзакции.
+    """
+    group = OperationGroup(counterparty_id=context.counterparty_id, action=Action.RECEIPT, created_by=context.user)
+    operations = [
+        Operation(product_id=product_id, quantity=1, price=Decimal('10.00'), discount=Decimal('0'))
+        for product_id in context.rng.sample(context.product_ids, min(LARGE_GROUP_LINES, len(context.product_ids)))
+    ]
+    set_group_totals(group, operations)
+    group.save()
+    for operation in operations:
+        operation.operation_group = group
+    Operation.objects.bulk_create(operations)
+    events.write(events.operations_created(group, operations))
+    apply_stock_deltas({operation.product_id: operation.quantity for operation in operations})
+    return group
+
+
+@benchmark('change_form_500')
+def change_form_large(context: Context) -> None:
+    with transaction.atomic():
+        group = create_large_group(context)
+        context.get(reverse('admin:storage_operationgroup_change', args=(group.pk,)))
+        transaction.set_rollback(True)
+
+
+@benchmark('inline_save_500')
+def inline_save_large(context: Context) -> None:
+    data = inline_form_data(context, LARGE_GROUP_LINES)
+    with transaction.atomic():
+        response = context.client.post(reverse('admin:storage_operationgroup_add'), data)
+        transaction.set_rollback(True)
+    if response.status_code != 302:
+        raise RuntimeError(f"inline save: HTTP {response.status_code}")
+
+
+@benchmark('inline_edit_500')
+def inline_edit_large(context: Context) -> None:
+    with transaction.atomic():
+        group = create_large_group(context)
+        data = {
+            'counterparty': group.counterparty_id,
+            'action': group.action,
+            'comment': '',
+            'operation_set-INITIAL_FORMS': group.lines_count,
+            'operation_set-MIN_NUM_FORMS': 0,
+            'operation_set-MAX_NUM_FORMS': 1000,
+        }
+        operations = group.operation_set.order_by('pk').values_list('pk', 'product_id')
+        for number, (pk, product_id) in enumerate(operations):
+            data.update({
+                f'operation_set-{number}-id': pk,
+                f'operation_set-{number}-operation_group': group.pk,
+                f'operation_set-{number}-product': product_id,
+                f'operation_set-{number}-price': '10.00',
+                # каждая вторая строка меняется
+                f'operation_set-{number}-quantity': 1 + number % 2,
+                f'operation_set-{number}-discount': '0',
+            })
+        data['operation_set-TOTAL_FORMS'] = len(operations)
+        response = context.client.post(reverse('admin:storage_operationgroup_change', args=(group.pk,)), data)
+        transaction.set_rollback(True)
+    if response.status_code != 302:
+        raise RuntimeError(f"inline edit: HTTP {response.status_code}")
+
+
+@benchmark('rollup_events_500')
+def rollup_events(context: Context) -> None:
+    # отчеты дочитывают журнал после приема на LARGE_GROUP_LINES строк
+    with transaction.atomic():
+        create_large_group(context)
+        build_rollups()
+        transaction.set_rollback(True)
+
+
+QUEUE_JOBS = 100
+
+
+@benchmark('job_queue')
+def job_queue(context: Context) -> None:
+    # накладные расходы очереди: постановка и выполнение пустых задач
+    with transaction.atomic():
+        for number in range(QUEUE_JOBS):
+            enqueue('noop')
+        while run_next('benchmark') is not None:
+            pass
+        transaction.set_rollback(True)
+
+
+def run(names: List[str], repeat: int, seed: int = 1) -> List[Result]:
+    context = Context(seed)
+    results = []
+    try:
+        for name in names:
+            func = BENCHMARKS[name]
+            result = Result(name)
+            func(context)  # прогрев
+            for number in range(repeat):
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    func(context)
+                    result.timings.append(time.perf_counter() - started)
+                result.queries = max(result.queries, len(queries))
+            results.append(result)
+    finally:
+        context.close()
+    return results
+
+
+def regressions(results: List[dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """ Замеры, которые медленнее базовых больше чем на tolerance или делают больше запросов.
+    """
+    problems = []
+    for result in results:
+        base = baseline.get(result['name'])
+        if not base:
+            continue
+        if result['median_ms'] > base['median_ms'] * (1 + tolerance):
+            problems.append(f"{result['name']}: медиана {result['median_ms']} мс, было {base['median_ms']} мс")
+        if result['queries'] > base['queries']:
+            problems.append(f"{result['name']}: запросов {result['queries']}, было {base['queries']}")
+    return problems
@@ -0,0 +1,195 @@
+import time
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, List
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Product, OperationGroup, ArchivedOperationGroup, Action, Stock
+
+
+# Версионный кеш итогов. invalidate() меняет поколение ключа в самом кеше, поэтому
+# сброс виден другим процессам (gunicorn, run_workers) только при общем бэкенде:
+# Redis или файловом кеше. С LocMemCache каждый процесс сбрасывает только свою
+# копию, остальные отдают старые итоги до TIMEOUT секунд.
+
+TIMEOUT = 300
+
+LOCK_TIMEOUT = 10
+
+LOCK_WAIT = 5
+
+_MISSING = object()
+
+
+def _generation_key(kind: str, ident) -> str:
+    return f'storage:{kind}:{ident}:gen'
+
+
+def _generation(kind: str, ident) -> int:
+    key = _generation_key(kind, ident)
+    generation = cache.get(key)
+    if generation is None:
+        # начальное значение по времени, чтобы после вытеснения ключа не попасть на старые записи
+        cache.add(key, time.time_ns(), None)
+        generation = cache.get(key)
+    return generation
+
+
+def _versioned_key(kind: str, ident, generation: int) -> str:
+    return f'storage:{kind}:{ident}:v{generation}'
+
+
+def cache_keys(kind: str, idents: Iterable) -> Dict:
+    """ Версионные ключи нескольких объектов {ident: ключ}, поколения читаются одним get_many.
+    """
+    generation_keys = {ident: _generation_key(kind, ident) for ident in idents}
+    found = cache.get_many(list(generation_keys.values()))
+    return {
+        ident: _versioned_key(kind, ident, found[key] if key in found else _generation(kind, ident))
+        for ident, key in generation_keys.items()
+    }
+
+
+def invalidate(kind: str, ident) -> None:
+    key = _generation_key(kind, ident)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def invalidate_on_commit(kind: str, *idents) -> None:
+    """ Сбрасывает ключи после фиксации транзакции, чтобы не закешировать незафиксированные данные.
+    """
+    for ident in set(idents):
+        if ident is not None:
+            transaction.on_commit(lambda ident=ident: invalidate(kind, ident))
+
+
+def invalidate_operations(product_ids: Iterable[int], counterparty_ids: Iterable[int]) -> None:
+    """ Сброс после массовой записи операций в обход сигналов.
+    """
+    invalidate_on_commit('category', *Product.objects.filter(pk__in=set(product_ids)).values_list('category_id', flat=True))
+    invalidate_on_commit('counterparty', *counterparty_ids)
+
+
+def get_or_compute(key: str, compute: Callable, timeout: int = TIMEOUT):
+    """ Значение из кеша; при промахе считает только один процесс, остальные ждут его результат.
+    """
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        return value
+
+    lock = f'{key}:lock'
+    if cache.add(lock, 1, LOCK_TIMEOUT):
+        try:
+            value = compute()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock)
+        return value
+
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+    return compute()
+
+
+def get_or_compute_many(kind: str, idents: Iterable, compute: Callable[[List], Dict], timeout: int = TIMEOUT) -> Dict:
+    """ Значения для нескольких объектов: одно чтение кеша, промахи считаются
+    одним вызовом compute(список ident) -> {ident: значение}.
+
+    Как в get_or_compute, промах считает только один процесс: ключи, которые
+    уже считает другой, ждут его результата до LOCK_WAIT секунд.
+    """
+    keys = cache_keys(kind, set(idents))
+    found = cache.get_many(list(keys.values()))
+    values = {ident: found[key] for ident, key in keys.items() if key in found}
+    missing = [ident for ident in keys if ident not in values]
+    if not missing:
+        return values
+
+    owned = [ident for ident in missing if cache.add(f'{keys[ident]}:lock', 1, LOCK_TIMEOUT)]
+    if owned:
+        try:
+            computed = compute(owned)
+            cache.set_many({keys[ident]: computed[ident] for ident in owned}, timeout)
+        finally:
+            cache.delete_many([f'{keys[ident]}:lock' for ident in owned])
+        values.update(computed)
+
+    waiting = [ident for ident in missing if ident not in values]
+    deadline = time.monotonic() + LOCK_WAIT
+    while waiting and time.monotonic() < deadline:
+        time.sleep(0.05)
+        found = cache.get_many([keys[ident] for ident in waiting])
+        values.update((ident, found[keys[ident]]) for ident in waiting if keys[ident] in found)
+        waiting = [ident for ident in waiting if ident not in values]
+    if waiting:
+        values.update(compute(waiting))
+    return values
+
+
+def category_totals_many(category_ids: Iterable[int]) -> Dict[int, Dict[str, int]]:
+    """ {категория: {'products': товаров, 'remaining': общий остаток}}.
+    """
+    def compute(missing):
+        totals = {category_id: {'products': 0, 'remaining': 0} for category_id in missing}
+        rows = (
+            Stock.objects.filter(product__category_id__in=missing)
+            .order_by()
+            .values('product__category_id')
+            .annotate(products=Count('product_id'), remaining=Coalesce(Sum('quantity'), 0))
+        )
+        for row in rows:
+            totals[row['product__category_id']] = {'products': row['products'], 'remaining': row['remaining']}
+        return totals
+    return get_or_compute_many('category', category_ids, compute)
+
+
+def category_totals(category_id: int) -> Dict[str, int]:
+    return category_totals_many([category_id])[category_id]
+
+
+def counterparty_turnover_many(counterparty_ids: Iterable[int]) -> Dict[int, Dict[str, Decimal]]:
+    """ {контрагент: {'sale': сумма продаж, 'receipt': сумма приемов}}.
+    """
+    def compute(missing):
+        totals = {counterparty_id: {'sale': Decimal('0'), 'receipt': Decimal('0')} for counterparty_id in missing}
+        # перенесенные в архив группы тоже входят в оборот
+        for model in (OperationGroup, ArchivedOperationGroup):
+            rows = (
+                model.objects.filter(counterparty_id__in=missing)
+                .order_by()
+                .values('counterparty_id', 'action')
+                .annotate(amount=Sum('total_amount'))
+            )
+            for row in rows:
+                name = 'sale' if row['action'] == Action.SALE else 'receipt'
+                totals[row['counterparty_id']][name] += Decimal(row['amount'] or 0).quantize(Decimal('0.01'))
+        return totals
+    return get_or_compute_many('counterparty', counterparty_ids, compute)
+
+
+def counterparty_turnover(counterparty_id: int) -> Dict[str, Decimal]:
+    return counterparty_turnover_many([counterparty_id])[counterparty_id]
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if settings.DEBUG or not backend.endswith('LocMemCache'):
+        return []
+    return [checks.Warning(
+        "Кеш в памяти процесса: сброс итогов не доходит до других процессов, они видят старые итоги до истечения TIMEOUT",
+        hint="Задайте REDIS_URL или CACHE_DIR",
+        id='storage.W001',
+    )]
@@ -0,0 +1,237 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import OperationGroup, Operation, Watermark, EventKind, OperationEvent
+
+
+# Журнал изменений (outbox): вставка, правка и удаление операции или группы пишут
+# OperationEvent в той же транзакции - сигналами, а массовые пути записи явно.
+# Потребители читают журнал по порядку id и хранят позицию (и пропуски) в Watermark, поэтому
+# производные данные правятся по изменениям, без пересчета всей истории.
+
+State = Dict[str, Any]
+
+OPERATION_STATE_FIELDS = (
+    'product_id', 'operation_group_id', 'operation_group__counterparty_id', 'operation_group__action',
+    'quantity', 'price', 'discount', 'amount', 'signed_quantity', 'created_at',
+)
+
+
+def operation_state(operation: Operation, counterparty_id: int, action: int) -> State:
+    """ Состояние операции для журнала. Действие и контрагент берутся из группы,
+    они нужны потребителям, а группа к моменту чтения журнала может измениться.
+    """
+    return {
+        'product': operation.product_id,
+        'group': operation.operation_group_id,
+        'counterparty': counterparty_id,
+        'action': action,
+        'quantity': operation.quantity,
+        'price': operation.price,
+        'discount': operation.discount,
+        'amount': operation.amount,
+        'signed_quantity': operation.signed_quantity,
+        'created_at': operation.created_at,
+    }
+
+
+def operation_states(operations) -> Dict[int, State]:
+    """ Состояния операций из базы, {id: состояние}.
+    """
+    states = {}
+    for pk, product_id, group_id, counterparty_id, action, quantity, price, discount, amount, signed, created_at in (
+        operations.order_by().values_list('pk', *OPERATION_STATE_FIELDS).iterator(chunk_size=2000)
+    ):
+        states[pk] = {
+            'product': product_id,
+            'group': group_id,
+            'counterparty': counterparty_id,
+            'action': action,
+            'quantity': quantity,
+            'price': price,
+            'discount': discount,
+            'amount': amount,
+            'signed_quantity': signed,
+            'created_at': created_at,
+        }
+    return states
+
+
+def group_state(group: OperationGroup) -> State:
+    return {'counterparty': group.counterparty_id, 'action': group.action, 'comment': group.comment}
+
+
+def state_amount(state: State) -> Decimal:
+    # после чтения из базы суммы и время - строки JSON
+    return Decimal(str(state['amount']))
+
+
+def state_created_at(state: State) -> datetime:
+    value = state['created_at']
+    return value if isinstance(value, datetime) else parse_datetime(value)
+
+
+def event(kind: int, operation_group_id: int, operation_id: Optional[int] = None, before: Optional[State] = None, after: Optional[State] = None) -> OperationEvent:
+    return OperationEvent(kind=kind, operation_group_id=operation_group_id, operation_id=operation_id, before=before, after=after)
+
+
+def operations_created(group: OperationGroup, operations: Iterable[Operation]) -> List[OperationEvent]:
+    """ События вставки операций группы, сохраненных через bulk_create.
+    """
+    return [
+        event(EventKind.CREATE, group.pk, operation.pk, after=operation_state(operation, group.counterparty_id, group.action))
+        for operation in operations
+    ]
+
+
+def write(events: Iterable[OperationEvent]) -> None:
+    """ Добавляет события в журнал. Вызывается в транзакции изменения, иначе событие может пропасть.
+    """
+    OperationEvent.objects.bulk_create(list(events), batch_size=1000)
+
+
+@dataclass(frozen=True)
+class Consumer:
+    # func(events) правит производные данные по пачке событий
+    func: Callable[[List[OperationEvent]], None]
+    title: str
+
+
+CONSUMERS: Dict[str, Consumer] = {}
+
+
+def consumer(name: str, title: str):
+    """ Регистрирует потребителя журнала. Пачка событий и новая позиция сохраняются одной транзакцией.
+    """
+    def register(func):
+        CONSUMERS[name] = Consumer(func, title)
+        return func
+    return register
+
+
+def cursor_name(name: str) -> str:
+    return f'events:{name}'
+
+
+def position(name: str) -> Optional[int]:
+    """ id последнего обработанного события или None, если потребитель еще не запускался.
+    """
+    return Watermark.objects.filter(name=cursor_name(name)).values_list('value', flat=True).first()
+
+
+def pending(name: str) -> int:
+    return OperationEvent.objects.filter(id__gt=position(name) or 0).count()
+
+
+def _snapshot() -> Optional[Tuple[int, int]]:
+    """ (xmin, xmax) текущего снимка PostgreSQL: транзакции с номером меньше xmin завершены,
+    с номером от xmax еще не начались. В SQLite транзакции пишут по одному, пропусков в id нет.
+    """
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_snapshot_xmin(snapshot)::text::bigint, pg_snapshot_xmax(snapshot)::text::bigint '
+            'FROM pg_current_snapshot() AS taken(snapshot)'
+        )
+        return cursor.fetchone()
+
+
+def _batch(cursor: Watermark, batch_size: int) -> List[OperationEvent]:
+    """ Следующая пачка событий потребителя, сдвигает cursor.value и cursor.gaps.
+
+    В PostgreSQL меньший id может зафиксироваться позже большего. Пропущенные id
+    запоминаются вместе с xmax снимка и перечитываются, пока не завершатся все
+    транзакции, начатые до него; после этого пропуск - откаченная вставка.
+    """
+    fresh = list(OperationEvent.objects.filter(id__gt=cursor.value).order_by('id')[:batch_size])
+    # снимок после чтения: транзакция, державшая пропущенный id, началась до его xmax
+    snapshot = _snapshot()
+    if snapshot is None:
+        if fresh:
+            cursor.value = fresh[-1].pk
+        return fresh
+    xmin, xmax = snapshot
+    gaps = dict(cursor.gaps)
+    late = []
+    if gaps:
+        # читаются после новых событий: изменение, зависящее от запоздавшего события, без него не придет
+        late = list(OperationEvent.objects.filter(id__in=list(gaps)).order_by('id'))
+        for item in late:
+            del gaps[item.pk]
+        gaps = {pk: horizon for pk, horizon in gaps.items() if horizon > xmin}
+    if fresh:
+        seen = {item.pk for item in fresh}
+        gaps.update((pk, xmax) for pk in range(cursor.value + 1, fresh[-1].pk) if pk not in seen)
+        cursor.value = fresh[-1].pk
+    cursor.gaps = sorted([pk, horizon] for pk, horizon in gaps.items())
+    return late + fresh
+
+
+def consume(name: str, batch_size: int = 5000, progress: Optional[Callable[[int], None]] = None) -> int:
+    """ Передает потребителю name события новее его позиции, пачками по batch_size.
+
+    Прерванный запуск продолжается с последней сохраненной пачки.
+    Возвращает количество обработанных событий.
+    """
+    handler = CONSUMERS[name]
+    processed = 0
+    while True:
+        with transaction.atomic():
+            Watermark.objects.get_or_create(name=cursor_name(name))
+            cursor = Watermark.objects.select_for_update().get(name=cursor_name(name))
+            gaps = cursor.gaps
+            events = _batch(cursor, batch_size)
+            if events:
+                handler.func(events)
+            if events or cursor.gaps != gaps:
+                cursor.save(update_fields=['value', 'gaps', 'updated_at'])
+            if not events:
+                return processed
+        processed += len(events)
+        if progress:
+            progress(processed)
+
+
+def lock_log() -> int:
+    """ До конца транзакции не дает другим транзакциям писать в журнал и возвращает id
+    последнего события. Все, что записано до него, уже видно в таблицах операций.
+    """
+    table = connection.ops.quote_name(OperationEvent._meta.db_table)
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            # ждет незафиксированные вставки, чтение не блокирует
+            cursor.execute(f'LOCK TABLE {table} IN EXCLUSIVE MODE')
+        else:
+            # SQLite пишет по одному: пустая запись захватывает блокировку записи
+            cursor.execute(f'DELETE FROM {table} WHERE id < 0')
+    return OperationEvent.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def set_position(name: str, value: int) -> None:
+    Watermark.objects.update_or_create(name=cursor_name(name), defaults={'value': value, 'gaps': []})
+
+
+def prune(keep: Optional[timedelta] = None) -> int:
+    """ Удаляет события старше keep, которые прочитали все потребители.
+    """
+    if keep is None:
+        keep = timedelta(days=getattr(settings, 'STORAGE_EVENT_RETENTION_DAYS', 30))
+    names = [cursor_name(name) for name in CONSUMERS]
+    positions = Watermark.objects.filter(name__in=names)
+    if positions.count() < len(names):
+        # потребитель еще не запускался, его события нельзя удалять
+        return 0
+    read = positions.aggregate(read=Min('value'))['read'] or 0
+    # пропуск еще может зафиксироваться со старым временем записи
+    waiting = [pk for gaps in positions.values_list('gaps', flat=True) for pk, horizon in gaps]
+    deleted, _ = OperationEvent.objects.filter(id__lte=read, created_at__lt=timezone.now() - keep).exclude(id__in=waiting).delete()
+    return deleted
@@ -0,0 +1,165 @@
+import csv
+import json
+import secrets
+import tempfile
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db.models import F, QuerySet
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Product, OperationGroup, Operation, Action
+from .routers import replica_alias
+
+
+CHUNK_SIZE = 2000
+
+EXPORTS_DIR = 'exports'
+
+CENT = Decimal('0.01')
+
+ACTION_NAMES = dict(Action.choices)
+
+
+class Echo:
+    """ Псевдо-файл для csv.writer: возвращает строку вместо записи.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _money(value) -> str:
+    return str(Decimal(value or 0).quantize(CENT, rounding=ROUND_HALF_UP))
+
+
+def operation_rows(queryset: Optional[QuerySet] = None) -> Tuple[Tuple[str, ...], Iterator[tuple]]:
+    queryset = (Operation.objects.all() if queryset is None else queryset).using(replica_alias())
+    header = ('id', 'created_at', 'group', 'action', 'counterparty', 'product', 'category', 'quantity', 'price', 'discount', 'amount')
+    rows = (
+        queryset.order_by('id')
+        .values_list(
+            'id',
+            'created_at',
+            'operation_group_id',
+            'operation_group__action',
+            'operation_group__counterparty__full_name',
+            'product__name',
+            'product__category__name',
+            'quantity',
+            'price',
+            'discount',
+            'amount',
+        )
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    return header, (
+        (pk, created_at.isoformat(), group, ACTION_NAMES.get(action), counterparty, product, category, quantity, price, discount, _money(amount))
+        for pk, created_at, group, action, counterparty, product, category, quantity, price, discount, amount in rows
+    )
+
+
+def group_rows(queryset: Optional[QuerySet] = None) -> Tuple[Tuple[str, ...], Iterator[tuple]]:
+    queryset = (OperationGroup.objects.all() if queryset is None else queryset).using(replica_alias())
+    header = ('id', 'created_at', 'action', 'counterparty', 'total_quantity', 'total_amount')
+    rows = (
+        queryset.order_by('id')
+        .values_list('id', 'created_at', 'action', 'counterparty__full_name', 'total_quantity', 'total_amount')
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    return header, (
+        (pk, created_at.isoformat(), ACTION_NAMES.get(action), counterparty, quantity, _money(amount))
+        for pk, created_at, action, counterparty, quantity, amount in rows
+    )
+
+
+def stock_rows(queryset: Optional[QuerySet] = None) -> Tuple[Tuple[str, ...], Iterator[tuple]]:
+    queryset = (Product.objects.all() if queryset is None else queryset).using(replica_alias())
+    header = ('id', 'name', 'category', 'remaining')
+    rows = (
+        queryset.order_by('id')
+        .annotate(remaining_value=Coalesce(F('stock__quantity'), 0))
+        .values_list('id', 'name', 'category__name', 'remaining_value')
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    return header, rows
+
+
+EXPORTS: Dict[str, Callable] = {
+    'operations': operation_rows,
+    'groups': group_rows,
+    'stock': stock_rows,
+}
+
+
+def iter_csv(header: Iterable, rows: Iterable[tuple]) -> Iterator[str]:
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_jsonl(header: Iterable, rows: Iterable[tuple]) -> Iterator[str]:
+    header = tuple(header)
+    for row in rows:
+        yield json.dumps(dict(zip(header, row)), ensure_ascii=False, default=str) + '\n'
+
+
+FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (iter_jsonl, 'application/x-ndjson; charset=utf-8'),
+}
+
+
+def iter_export(kind: str, fmt: str = 'csv', queryset: Optional[QuerySet] = None) -> Iterator[str]:
+    header, rows = EXPORTS[kind](queryset)
+    writer = FORMATS[fmt][0]
+    return writer(header, rows)
+
+
+def streaming_export(kind: str, fmt: str = 'csv', queryset: Optional[QuerySet] = None) -> StreamingHttpResponse:
+    """ Ответ, который отдает выгрузку по мере чтения из базы.
+    """
+    writer, content_type = FORMATS[fmt]
+    filename = f"{kind}-{timezone.localtime():%Y%m%d-%H%M%S}.{fmt}"
+    return StreamingHttpResponse(
+        iter_export(kind, fmt, queryset),
+        content_type=content_type,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+
+def save_export(
+    kind: str,
+    fmt: str = 'csv',
+    queryset: Optional[QuerySet] = None,
+    progress: Optional[Callable[[int], None]] = None,
+) -> Tuple[str, int]:
+    """ Записывает выгрузку в файловое хранилище для фоновой задачи.
+    Возвращает имя файла и количество строк.
+    """
+    header, rows = EXPORTS[kind](queryset)
+    writer = FORMATS[fmt][0]
+    written = 0
+
+    def counted(rows):
+        nonlocal written
+        for row in rows:
+            written += 1
+            if progress and written % CHUNK_SIZE == 0:
+                progress(written)
+            yield row
+
+    with tempfile.TemporaryFile() as file:
+        for line in writer(header, counted(rows)):
+            file.write(line.encode('utf-8'))
+        file.seek(0)
+        # случайный каталог: файл отдается только через админку, имя не угадать
+        name = default_storage.save(
+            f"{EXPORTS_DIR}/{secrets.token_hex(8)}/{kind}-{timezone.localtime():%Y%m%d-%H%M%S}.{fmt}", File(file),
+        )
+    return name, written
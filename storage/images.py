@@ -0,0 +1,84 @@
+import hashlib
+from io import BytesIO
+from typing import Dict, Optional
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ImageOps
+
+from .jobs import enqueue
+from .models import Product
+
+
+RENDITIONS_DIR = 'products/renditions'
+
+# имя: наибольшая сторона в пикселях
+SIZES = {
+    'thumb': 100,
+    'medium': 600,
+}
+
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def rendition_name(image_hash: str, size: str, fmt: str) -> str:
+    """ Имя файла зависит только от содержимого оригинала, поэтому его можно кешировать навсегда.
+    """
+    return f'{RENDITIONS_DIR}/{image_hash}/{size}.{fmt}'
+
+
+def rendition_urls(image_hash: str) -> Dict[str, Dict[str, str]]:
+    return {
+        size: {fmt: reverse('storage:rendition', args=(image_hash, size, fmt)) for fmt in FORMATS}
+        for size in SIZES
+    }
+
+
+def file_hash(file) -> str:
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def generate_renditions(product_id: int, force: bool = False) -> Optional[str]:
+    """ Создает все размеры изображения товара и записывает хеш в Product.image_hash.
+    """
+    product = Product.objects.filter(pk=product_id).only('image', 'image_hash').first()
+    if product is None or not product.image:
+        return None
+
+    with product.image.open('rb') as file:
+        image_hash = file_hash(file)
+        file.seek(0)
+        original = ImageOps.exif_transpose(Image.open(file))
+        original.load()
+
+    for size, pixels in SIZES.items():
+        image = original.copy()
+        image.thumbnail((pixels, pixels), Image.LANCZOS)
+        for fmt, (pil_format, params) in FORMATS.items():
+            name = rendition_name(image_hash, size, fmt)
+            if not force and default_storage.exists(name):
+                continue
+            converted = image.convert('RGB') if pil_format == 'JPEG' else image
+            buffer = BytesIO()
+            converted.save(buffer, pil_format, **params)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+            default_storage.save(name, ContentFile(buffer.getvalue()))
+
+    # только если изображение не заменили, пока шла обработка
+    Product.objects.filter(pk=product_id, image=product.image.name).update(image_hash=image_hash)
+    return image_hash
+
+
+def schedule_renditions(product_id: int, image: str) -> None:
+    """ Ставит обработку в очередь фоновых задач, загрузка не ждет ее.
+    Задача видна обработчикам после фиксации транзакции с товаром.
+    """
+    enqueue('generate_renditions', {'product_id': product_id}, key=f'renditions:{product_id}:{image}')
@@ -0,0 +1,240 @@
+import csv
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.db import transaction
+
+from . import cache, events
+from .models import Product, Counterparty, OperationGroup, Operation, Action, EventKind, ImportCheckpoint, normalize_phone
+from .rollups import schedule_rollups
+from .utils import apply_stock_deltas, set_group_totals
+
+
+# Строка файла: group, action, counterparty, product, quantity, price, discount, comment.
+# Строки одной группы идут подряд; counterparty - телефон контрагента, product - название товара.
+
+ACTIONS = {
+    '1': Action.SALE,
+    'sale': Action.SALE,
+    'продажа': Action.SALE,
+    '2': Action.RECEIPT,
+    'receipt': Action.RECEIPT,
+    'прием': Action.RECEIPT,
+}
+
+# ключ, под которым в базе несколько строк: строку файла нельзя отнести ни к одной
+AMBIGUOUS = -1
+
+
+class ImportRowError(ValueError):
+    """ Ошибка в строке файла импорта.
+    """
+
+    def __init__(self, line: int, message: str):
+        super().__init__(f"строка {line}: {message}")
+        self.line = line
+
+
+@dataclass
+class ImportStats:
+    rows: int = 0
+    groups: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def read_rows(path: str, fmt: Optional[str] = None) -> Iterator[Tuple[int, dict]]:
+    """ Потоково читает CSV или JSONL, отдает (номер строки, данные).
+    """
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, encoding='utf-8', newline='') as file:
+        if fmt == 'jsonl':
+            for line, text in enumerate(file, start=1):
+                if text.strip():
+                    try:
+                        row = json.loads(text)
+                    except ValueError as exc:
+                        raise ImportRowError(line, f"неверный JSON: {exc}")
+                    if not isinstance(row, dict):
+                        raise ImportRowError(line, "ожидается объект JSON")
+                    yield line, row
+        else:
+            # строка 1 - заголовок, номера совпадают со строками файла
+            for line, row in enumerate(csv.DictReader(file), start=2):
+                yield line, row
+
+
+def fingerprint(path: str) -> str:
+    """ Отпечаток файла: размер, время изменения и хеш начала файла.
+    Контрольная точка действует только для того же файла.
+    """
+    stat = os.stat(path)
+    with open(path, 'rb') as file:
+        head = hashlib.sha1(file.read(1 << 16)).hexdigest()
+    return f'{stat.st_size}:{stat.st_mtime_ns}:{head}'
+
+
+def _lookup(pairs: Iterable[Tuple[str, int]]) -> Dict[str, int]:
+    """ {ключ: id}; ключи, которые есть у нескольких строк, получают AMBIGUOUS.
+    """
+    found: Dict[str, int] = {}
+    for key, pk in pairs:
+        found[key] = AMBIGUOUS if key in found else pk
+    return found
+
+
+def _parse(line: int, row: dict, products: Dict[str, int], counterparties: Dict[str, int]) -> dict:
+    try:
+        action = ACTIONS[str(row['action']).strip().lower()]
+    except KeyError:
+        raise ImportRowError(line, f"неизвестное действие {row.get('action')!r}")
+    product_id = products.get(str(row.get('product', '')).strip())
+    if product_id is None:
+        raise ImportRowError(line, f"товар {row.get('product')!r} не найден")
+    if product_id == AMBIGUOUS:
+        raise ImportRowError(line, f"товаров с названием {row.get('product')!r} несколько")
+    counterparty_id = counterparties.get(normalize_phone(str(row.get('counterparty', ''))))
+    if counterparty_id is None:
+        raise ImportRowError(line, f"контрагент {row.get('counterparty')!r} не найден")
+    if counterparty_id == AMBIGUOUS:
+        raise ImportRowError(line, f"контрагентов с телефоном {row.get('counterparty')!r} несколько")
+    try:
+        quantity = int(row['quantity'])
+        price = Decimal(str(row['price']))
+        discount = Decimal(str(row.get('discount') or 0))
+    except (KeyError, ValueError, InvalidOperation) as exc:
+        raise ImportRowError(line, f"неверное число: {exc}")
+    if quantity <= 0:
+        raise ImportRowError(line, f"количество должно быть больше нуля: {quantity}")
+    return {
+        'group': str(row.get('group', '')),
+        'action': action,
+        'counterparty_id': counterparty_id,
+        'product_id': product_id,
+        'quantity': quantity,
+        'price': price,
+        'discount': discount,
+        'comment': row.get('comment') or '',
+    }
+
+
+def _flush(
+    source: str,
+    file_fingerprint: str,
+    last_line: int,
+    groups: List[Tuple[OperationGroup, List[Operation]]],
+    finished: bool = False,
+) -> None:
+    """ Сохраняет пачку групп одной транзакцией вместе с остатками, журналом и контрольной точкой.
+    После последней пачки контрольная точка удаляется.
+    """
+    with transaction.atomic():
+        for group, lines in groups:
+            set_group_totals(group, lines)
+        OperationGroup.objects.bulk_create([group for group, operations in groups])
+        operations = []
+        deltas: Dict[int, int] = defaultdict(int)
+        for group, lines in groups:
+            for operation in lines:
+                operation.operation_group = group
+                deltas[operation.product_id] += operation.signed_quantity
+                operations.append(operation)
+        Operation.objects.bulk_create(operations)
+        logged = []
+        for group, lines in groups:
+            logged.append(events.event(EventKind.CREATE, group.pk, after=events.group_state(group)))
+            logged.extend(events.operations_created(group, lines))
+        events.write(logged)
+        apply_stock_deltas(deltas)
+        cache.invalidate_operations(deltas, {group.counterparty_id for group, lines in groups})
+        schedule_rollups()
+        if finished:
+            ImportCheckpoint.objects.filter(source=source).delete()
+        else:
+            ImportCheckpoint.objects.update_or_create(source=source, defaults={'line': last_line, 'fingerprint': file_fingerprint})
+
+
+def import_operations(
+    path: str,
+    fmt: Optional[str] = None,
+    chunk_size: int = 5000,
+    source: Optional[str] = None,
+    user=None,
+    progress: Optional[Callable[[ImportStats], None]] = None,
+) -> ImportStats:
+    """ Импортирует группы операций из файла пачками по chunk_size строк.
+
+    После каждой пачки в ImportCheckpoint записывается номер последней
+    сохраненной строки и отпечаток файла, прерванный импорт того же файла
+    продолжается с нее. После успешного импорта контрольная точка удаляется.
+    """
+    source = source or path
+    file_fingerprint = fingerprint(path)
+    checkpoint = (
+        ImportCheckpoint.objects.filter(source=source, fingerprint=file_fingerprint).values_list('line', flat=True).first() or 0
+    )
+    products = _lookup(Product.objects.order_by().values_list('name', 'id').iterator(chunk_size=10000))
+    # телефон сравнивается по цифрам, формат записи в файле не важен
+    counterparties = _lookup(Counterparty.objects.exclude(phone_digits='').order_by().values_list('phone_digits', 'id'))
+
+    stats = ImportStats()
+    started = time.monotonic()
+    batch: List[Tuple[OperationGroup, List[Operation]]] = []
+    batch_rows = 0
+    current_key = None
+    last_line = checkpoint
+
+    for line, row in read_rows(path, fmt):
+        if line <= checkpoint:
+            stats.skipped += 1
+            continue
+        data = _parse(line, row, products, counterparties)
+        key = (data['group'], data['action'], data['counterparty_id'])
+        if key != current_key or not data['group']:
+            # группа закончилась, пачку можно сохранить только на границе групп
+            if batch_rows >= chunk_size:
+                _flush(source, file_fingerprint, last_line, batch)
+                stats.seconds = time.monotonic() - started
+                if progress:
+                    progress(stats)
+                batch, batch_rows = [], 0
+            group = OperationGroup(
+                counterparty_id=data['counterparty_id'],
+                action=data['action'],
+                comment=data['comment'],
+                created_by=user,
+                updated_by=user,
+            )
+            batch.append((group, []))
+            stats.groups += 1
+            current_key = key
+        batch[-1][1].append(Operation(
+            product_id=data['product_id'],
+            quantity=data['quantity'],
+            price=data['price'],
+            discount=data['discount'],
+            created_by=user,
+            updated_by=user,
+        ))
+        batch_rows += 1
+        stats.rows += 1
+        last_line = line
+
+    if batch:
+        _flush(source, file_fingerprint, last_line, batch, finished=True)
+    else:
+        ImportCheckpoint.objects.filter(source=source).delete()
+    stats.seconds = time.monotonic() - started
+    if progress:
+        progress(stats)
+    return stats
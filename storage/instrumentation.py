@@ -0,0 +1,209 @@
+import heapq
+import json
+import logging
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from contextlib import ExitStack
+from typing import Deque, Dict, List, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.urls import Resolver404, resolve
+
+
+logger = logging.getLogger('storage.queries')
+
+# сколько последних запросов хранится на один URL
+HISTORY_SIZE = 1000
+
+
+class QueryRecorder:
+    """ execute_wrapper, который запоминает время и форму каждого SQL запроса.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest: List[tuple] = []
+        self.shapes: Counter = Counter()
+        self.stacks: Dict[str, traceback.StackSummary] = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.total += duration
+            # параметры передаются отдельно, поэтому текст SQL и есть форма запроса
+            self.shapes[sql] += 1
+            if sql not in self.stacks:
+                # строки исходников читаются только при выводе предупреждения
+                stack = traceback.StackSummary.extract(traceback.walk_stack(None), limit=25, lookup_lines=False)
+                stack.reverse()
+                self.stacks[sql] = stack
+            # три самых долгих: куча, без сортировки на каждый запрос
+            if len(self.slowest) < 3:
+                heapq.heappush(self.slowest, (duration, sql))
+            else:
+                heapq.heappushpop(self.slowest, (duration, sql))
+
+    def format_stack(self, sql: str) -> str:
+        stack = self.stacks.get(sql)
+        return ''.join(stack.format()) if stack else ''
+
+    @property
+    def duplicates(self) -> Dict[str, int]:
+        return {sql: count for sql, count in self.shapes.items() if count > 1}
+
+
+class UrlStats:
+    """ Скользящая история запросов к одному URL.
+    """
+
+    def __init__(self):
+        self.queries: Deque[int] = deque(maxlen=HISTORY_SIZE)
+        self.sql_ms: Deque[float] = deque(maxlen=HISTORY_SIZE)
+        self.total_ms: Deque[float] = deque(maxlen=HISTORY_SIZE)
+
+    def add(self, queries: int, sql_ms: float, total_ms: float) -> None:
+        self.queries.append(queries)
+        self.sql_ms.append(sql_ms)
+        self.total_ms.append(total_ms)
+
+    def summary(self) -> dict:
+        return summarize(list(self.queries), list(self.sql_ms), list(self.total_ms))
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(queries: list, sql_ms: list, total_ms: list) -> dict:
+    return {
+        'requests': len(queries),
+        'queries_p50': percentile(queries, 0.5),
+        'queries_p95': percentile(queries, 0.95),
+        'queries_max': max(queries, default=0),
+        'sql_ms_p50': round(percentile(sql_ms, 0.5), 2),
+        'sql_ms_p95': round(percentile(sql_ms, 0.95), 2),
+        'total_ms_p95': round(percentile(total_ms, 0.95), 2),
+    }
+
+
+_lock = threading.Lock()
+
+histograms: Dict[str, UrlStats] = {}
+
+
+def record(url_name: str, queries: int, sql_ms: float, total_ms: float) -> None:
+    with _lock:
+        histograms.setdefault(url_name, UrlStats()).add(queries, sql_ms, total_ms)
+
+
+def url_name(request) -> str:
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return request.path_info
+    return match.view_name or request.path_info
+
+
+class QueryInstrumentationMiddleware:
+    """ Считает SQL запросы каждого ответа.
+
+    Пишет X-Query-Count/X-Query-Time-Ms (STORAGE_QUERY_HEADERS), структурный
+    лог в логгер storage.queries и файл STORAGE_QUERY_LOG, обновляет
+    histograms. При превышении STORAGE_QUERY_COUNT_WARNING или
+    STORAGE_QUERY_TIME_WARNING_MS пишет предупреждение со стеком самого
+    повторяющегося запроса. Включается STORAGE_QUERY_INSTRUMENTATION
+    (по умолчанию при DEBUG), иначе Django убирает его из цепочки.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'STORAGE_QUERY_INSTRUMENTATION', settings.DEBUG):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.headers = getattr(settings, 'STORAGE_QUERY_HEADERS', settings.DEBUG)
+        self.count_warning = getattr(settings, 'STORAGE_QUERY_COUNT_WARNING', 50)
+        self.time_warning_ms = getattr(settings, 'STORAGE_QUERY_TIME_WARNING_MS', 500)
+        self.log_path: Optional[str] = getattr(settings, 'STORAGE_QUERY_LOG', None)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    @staticmethod
+    def _install(stack: ExitStack, recorder: QueryRecorder) -> None:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder))
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            self._install(stack, recorder)
+            response = self.get_response(request)
+        return self._finish(request, response, recorder, started)
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        stack = ExitStack()
+        # асинхронный ORM выполняет запросы в потоке sync_to_async этого запроса,
+        # обертка ставится на соединения того же потока
+        await sync_to_async(self._install)(stack, recorder)
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self._finish(request, response, recorder, started)
+
+    def _finish(self, request, response, recorder: QueryRecorder, started: float):
+        total_ms = (time.perf_counter() - started) * 1000
+        sql_ms = recorder.total * 1000
+        name = url_name(request)
+        record(name, recorder.count, sql_ms, total_ms)
+
+        duplicates = recorder.duplicates
+        entry = {
+            'url_name': name,
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'queries': recorder.count,
+            'sql_ms': round(sql_ms, 2),
+            'total_ms': round(total_ms, 2),
+            'duplicates': sum(count - 1 for count in duplicates.values()),
+            'slowest': [{'ms': round(duration * 1000, 2), 'sql': sql} for duration, sql in sorted(recorder.slowest, reverse=True)],
+        }
+        logger.debug('request queries', extra={'queries': entry})
+        if self.log_path:
+            with _lock, open(self.log_path, 'a', encoding='utf-8') as log:
+                log.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+        if recorder.count > self.count_warning or sql_ms > self.time_warning_ms:
+            shape, repeats = max(recorder.shapes.items(), key=lambda item: item[1], default=('', 0))
+            logger.warning(
+                '%s %s: %d SQL queries, %.1f ms; repeated %d times: %s\n%s',
+                request.method, request.path, recorder.count, sql_ms, repeats, shape, recorder.format_stack(shape),
+            )
+
+        if self.headers:
+            response['X-Query-Count'] = str(recorder.count)
+            response['X-Query-Time-Ms'] = f'{sql_ms:.2f}'
+            response['X-Duplicate-Queries'] = str(entry['duplicates'])
+        return response
@@ -0,0 +1,339 @@
+import logging
+import os
+import random
+import socket
+import statistics
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, Optional
+
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, OperationalError, close_old_connections, connection, transaction
+from django.db.models import Count, F, Subquery
+from django.utils import timezone
+
+from .models import Job, JobStatus
+
+
+logger = logging.getLogger('storage.jobs')
+
+# Очередь задач в таблице Job, без внешнего брокера. Задачи выполняет run_workers:
+# обработчик забирает задачу одним UPDATE (в PostgreSQL - с SKIP LOCKED), пока она
+# выполняется, поток отклика обновляет heartbeat_at. Задачи без отклика дольше
+# STORAGE_JOB_TIMEOUT секунд считаются упавшими и повторяются. Завершенные задачи
+# хранятся STORAGE_JOB_RETENTION_DAYS дней, затем обработчики их удаляют.
+
+ACTIVE = (JobStatus.QUEUED, JobStatus.RUNNING)
+FINISHED = (JobStatus.DONE, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+class FatalJobError(Exception):
+    """ Ошибка, после которой повторять задачу бессмысленно.
+    """
+
+
+@dataclass(frozen=True)
+class Task:
+    func: Callable
+    title: str
+    # можно поставить из админки без параметров
+    admin: bool = False
+
+
+TASKS: Dict[str, Task] = {}
+
+
+def task(name: str, title: str, admin: bool = False):
+    """ Регистрирует функцию задачи func(progress, **payload), результат должен сериализоваться в JSON.
+    """
+    def register(func):
+        TASKS[name] = Task(func, title, admin)
+        return func
+    return register
+
+
+def _setting(name: str, default: float) -> float:
+    return getattr(settings, name, default)
+
+
+def worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue(
+    name: str,
+    payload: Optional[dict] = None,
+    priority: int = 0,
+    key: Optional[str] = None,
+    run_after: Optional[datetime] = None,
+    max_attempts: int = 3,
+    user=None,
+    match_done: bool = False,
+) -> Job:
+    """ Ставит задачу в очередь. Если задача с ключом key ждет или выполняется, возвращает ее.
+    С match_done=True возвращается и успешно выполненная задача, пока она хранится
+    (см. prune_jobs): так повтор не выполняет ту же работу второй раз.
+
+    Внутри транзакции задача становится видна обработчикам после фиксации.
+    """
+    if name not in TASKS:
+        raise ValueError(f"Неизвестная задача: {name}")
+    if key is not None:
+        statuses = ACTIVE + (JobStatus.DONE,) if match_done else ACTIVE
+        existing = Job.objects.filter(idempotency_key=key, status__in=statuses).order_by('-id').first()
+        if existing is not None:
+            return existing
+    job = Job(
+        name=name,
+        payload=payload or {},
+        priority=priority,
+        idempotency_key=key,
+        max_attempts=max_attempts,
+        run_after=run_after or timezone.now(),
+        created_by=user,
+    )
+    try:
+        with transaction.atomic():
+            job.save()
+    except IntegrityError:
+        # тот же ключ поставили параллельно
+        if key is None:
+            raise
+        return Job.objects.get(idempotency_key=key, status__in=ACTIVE)
+    return job
+
+
+def claim(worker: str, names: Optional[Iterable[str]] = None) -> Optional[Job]:
+    """ Забирает следующую задачу: сначала больший приоритет, затем более ранняя.
+    """
+    now = timezone.now()
+    queued = Job.objects.filter(status=JobStatus.QUEUED, run_after__lte=now).order_by('-priority', 'run_after', 'id')
+    if names:
+        queued = queued.filter(name__in=list(names))
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            # строки, которые забирают другие обработчики, пропускаются без ожидания
+            target = queued.select_for_update(skip_locked=True).values_list('pk', flat=True).first()
+            if target is None:
+                return None
+        else:
+            # SQLite пишет по одному, выбор и захват одним UPDATE не дают взять задачу дважды
+            target = Subquery(queued.values('pk')[:1])
+        updated = Job.objects.filter(pk=target, status=JobStatus.QUEUED).update(
+            status=JobStatus.RUNNING,
+            worker=worker,
+            attempts=F('attempts') + 1,
+            started_at=now,
+            heartbeat_at=now,
+        )
+    if not updated:
+        return None
+    return Job.objects.filter(status=JobStatus.RUNNING, worker=worker, started_at=now).first()
+
+
+def _update_running(job: Job, retries: int = 5, **fields) -> int:
+    """ Записывает состояние задачи, пока она числится за этим обработчиком.
+    Занятая база (SQLite) не теряет результат: запись повторяется с паузой.
+    """
+    running = Job.objects.filter(pk=job.pk, status=JobStatus.RUNNING, worker=job.worker)
+    for attempt in range(retries):
+        try:
+            with transaction.atomic():
+                return running.update(**fields)
+        except OperationalError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.1 * 2 ** attempt)
+    return 0
+
+
+class Progress:
+    """ Передается в задачу: progress(выполнено, всего, сообщение).
+    В базу пишется не чаще раза в interval секунд; неудачная запись задачу не прерывает.
+    """
+
+    def __init__(self, job: Job, interval: float = 1.0):
+        self.job = job
+        self.interval = interval
+        self._written = 0.0
+
+    def __call__(self, done: int, total: Optional[int] = None, message: str = '') -> None:
+        now = time.monotonic()
+        if now - self._written < self.interval and (total is None or done < total):
+            return
+        self._written = now
+        fields = {'progress': done, 'message': message[:255], 'heartbeat_at': timezone.now()}
+        if total is not None:
+            fields['progress_total'] = total
+        try:
+            _update_running(self.job, retries=1, **fields)
+        except DatabaseError:
+            logger.warning("Не удалось записать ход задачи %s", self.job.pk, exc_info=True)
+
+
+class Heartbeat(threading.Thread):
+    """ Обновляет heartbeat_at задачи, пока она выполняется, даже если задача не сообщает о ходе.
+    """
+
+    def __init__(self, job: Job):
+        super().__init__(name=f'heartbeat-{job.pk}', daemon=True)
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(_setting('STORAGE_JOB_HEARTBEAT', 10)):
+                try:
+                    _update_running(self.job, retries=1, heartbeat_at=timezone.now())
+                except DatabaseError:
+                    logger.warning("Не удалось обновить отклик задачи %s", self.job.pk, exc_info=True)
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _retry_delay(attempts: int) -> timedelta:
+    return timedelta(seconds=_setting('STORAGE_JOB_RETRY_DELAY', 30) * 2 ** max(attempts - 1, 0))
+
+
+def _fail(job: Job, error: str, retry: bool) -> None:
+    now = timezone.now()
+    if retry and job.attempts < job.max_attempts:
+        _update_running(job, status=JobStatus.QUEUED, run_after=now + _retry_delay(job.attempts), error=error, heartbeat_at=now)
+    else:
+        _update_running(job, status=JobStatus.FAILED, error=error, finished_at=now, heartbeat_at=now)
+
+
+def run_job(job: Job) -> None:
+    """ Выполняет забранную задачу и записывает результат или ошибку.
+    """
+    started = time.monotonic()
+    heartbeat = Heartbeat(job)
+    heartbeat.start()
+    try:
+        task = TASKS.get(job.name)
+        if task is None:
+            raise FatalJobError(f"Неизвестная задача: {job.name}")
+        result = task.func(Progress(job), **job.payload)
+    except Exception as exc:
+        heartbeat.stop()
+        logger.exception("Задача %s (%s), попытка %s: ошибка", job.pk, job.name, job.attempts)
+        _fail(job, traceback.format_exc(), retry=not isinstance(exc, FatalJobError))
+        return
+    heartbeat.stop()
+    now = timezone.now()
+    _update_running(
+        job,
+        status=JobStatus.DONE,
+        result=result,
+        error='',
+        finished_at=now,
+        heartbeat_at=now,
+    )
+    logger.info("Задача %s (%s) выполнена за %.1f с", job.pk, job.name, time.monotonic() - started)
+
+
+def run_next(worker: str, names: Optional[Iterable[str]] = None) -> Optional[Job]:
+    job = claim(worker, names)
+    if job is not None:
+        run_job(job)
+    return job
+
+
+def recover_stale(timeout: Optional[float] = None) -> int:
+    """ Возвращает в очередь задачи, обработчик которых перестал откликаться.
+    """
+    timeout = _setting('STORAGE_JOB_TIMEOUT', 300) if timeout is None else timeout
+    now = timezone.now()
+    stale = Job.objects.filter(status=JobStatus.RUNNING, heartbeat_at__lt=now - timedelta(seconds=timeout))
+    error = "Обработчик не откликался, задача прервана"
+    retried = stale.filter(attempts__lt=F('max_attempts')).update(status=JobStatus.QUEUED, run_after=now, error=error)
+    failed = stale.update(status=JobStatus.FAILED, error=error, finished_at=now)
+    if retried or failed:
+        logger.warning("Прерванных задач: %s возвращено в очередь, %s завершено с ошибкой", retried, failed)
+    return retried + failed
+
+
+def prune_jobs(keep: Optional[timedelta] = None, batch_size: int = 1000) -> int:
+    """ Удаляет задачи, завершенные раньше чем keep назад, пачками по batch_size.
+    """
+    if keep is None:
+        keep = timedelta(days=_setting('STORAGE_JOB_RETENTION_DAYS', 7))
+    old = Job.objects.filter(status__in=FINISHED, finished_at__lt=timezone.now() - keep).order_by()
+    deleted = 0
+    while True:
+        ids = list(old.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += Job.objects.filter(pk__in=ids).delete()[0]
+
+
+def work(
+    worker: str,
+    names: Optional[Iterable[str]] = None,
+    poll: float = 1.0,
+    burst: bool = False,
+    should_stop: Callable[[], bool] = lambda: False,
+) -> int:
+    """ Цикл обработчика: выполняет задачи, пока should_stop() не вернет True.
+    С burst=True выходит, когда готовых задач не осталось. Возвращает количество задач.
+    """
+    processed = 0
+    recovered_at = 0.0
+    pruned_at = 0.0
+    while not should_stop():
+        close_old_connections()
+        try:
+            if time.monotonic() - recovered_at > _setting('STORAGE_JOB_HEARTBEAT', 10):
+                recover_stale()
+                recovered_at = time.monotonic()
+            if time.monotonic() - pruned_at > _setting('STORAGE_JOB_PRUNE_INTERVAL', 3600):
+                prune_jobs()
+                pruned_at = time.monotonic()
+            job = run_next(worker, names)
+        except DatabaseError:
+            # база недоступна или занята: обработчик не падает, а пробует позже
+            logger.exception("Обработчик %s: ошибка базы", worker)
+            job = None
+        else:
+            if job is not None:
+                processed += 1
+                continue
+            if burst:
+                break
+        # обработчики опрашивают очередь вразнобой, а не все разом
+        time.sleep(poll * random.uniform(0.5, 1.5))
+    close_old_connections()
+    return processed
+
+
+def queue_stats(window: timedelta = timedelta(hours=1)) -> dict:
+    """ Состояние очереди: задачи по состояниям, пропускная способность и задержка
+    от готовности задачи (run_after) до запуска за последний window.
+    """
+    now = timezone.now()
+    counts = dict(Job.objects.order_by().values_list('status').annotate(count=Count('id')))
+    finished = list(
+        Job.objects.filter(status=JobStatus.DONE, finished_at__gte=now - window)
+        .values_list('run_after', 'started_at', 'finished_at')
+    )
+    latencies = sorted((started - run_after).total_seconds() for run_after, started, finished_at in finished)
+    durations = [(finished_at - started).total_seconds() for run_after, started, finished_at in finished]
+    oldest = Job.objects.filter(status=JobStatus.QUEUED, run_after__lte=now).order_by('run_after').values_list('run_after', flat=True).first()
+    return {
+        'queued': counts.get(JobStatus.QUEUED, 0),
+        'running': counts.get(JobStatus.RUNNING, 0),
+        'failed': counts.get(JobStatus.FAILED, 0),
+        'done': len(finished),
+        'per_minute': round(len(finished) / (window.total_seconds() / 60), 2),
+        'latency_median_s': round(statistics.median(latencies), 3) if latencies else None,
+        'latency_p95_s': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None,
+        'duration_median_s': round(statistics.median(durations), 3) if durations else None,
+        'oldest_wait_s': round((now - oldest).total_seconds(), 1) if oldest else None,
+    }
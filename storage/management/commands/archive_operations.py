@@ -0,0 +1,42 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.utils import timezone
+
+from storage.archive import archive_operations
+from storage.models import OperationGroup
+
+
+class Command(BaseCommand):
+    help = "Переносит в архив группы операций, созданные до даты, и складывает их количество в начальные остатки"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', required=True, help="День YYYY-MM-DD, переносятся группы, созданные до его начала")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Групп в одной транзакции")
+        parser.add_argument('--dry-run', action='store_true', help="Только посчитать, что будет перенесено")
+
+    def handle(self, *args, **options):
+        try:
+            day = datetime.strptime(options['before'], '%Y-%m-%d').date()
+        except ValueError:
+            raise CommandError("Дата должна быть в формате YYYY-MM-DD")
+        if day > timezone.localdate():
+            raise CommandError("Дата не может быть в будущем")
+        if options['chunk_size'] < 1:
+            raise CommandError("Размер пачки должен быть положительным")
+        before = timezone.make_aware(datetime.combine(day, time.min))
+
+        if options['dry_run']:
+            totals = OperationGroup.objects.filter(created_at__lt=before).aggregate(groups=Count('id', distinct=True), operations=Count('operation'))
+            self.stdout.write(f"Будет перенесено групп: {totals['groups']}, операций: {totals['operations']}")
+            return
+
+        stats = archive_operations(
+            before,
+            chunk_size=options['chunk_size'],
+            progress=lambda stats: self.stdout.write(f"групп: {stats.groups}, операций: {stats.operations}"),
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Перенесено групп: {stats.groups}, операций: {stats.operations} за {stats.seconds:.1f} с"
+        ))
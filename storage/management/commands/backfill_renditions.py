@@ -0,0 +1,44 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from storage.images import generate_renditions
+from storage.models import Product
+
+
+class Command(BaseCommand):
+    help = "Создает уменьшенные копии изображений существующих товаров параллельно"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--force', action='store_true', help="Пересоздать и уже готовые копии")
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image__isnull=True)
+        if not options['force']:
+            products = products.filter(image_hash='')
+        product_ids = list(products.order_by('id').values_list('id', flat=True))
+
+        def work(product_id):
+            close_old_connections()
+            try:
+                return generate_renditions(product_id, force=options['force'])
+            finally:
+                close_old_connections()
+
+        started = time.monotonic()
+        done = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            futures = {pool.submit(work, product_id): product_id for product_id in product_ids}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    done += 1
+                except Exception as exc:
+                    failed += 1
+                    self.stderr.write(f"Товар {futures[future]}: {exc}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Обработано {done}, ошибок {failed} за {time.monotonic() - started:.1f} с"
+        ))
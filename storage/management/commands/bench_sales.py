@@ -0,0 +1,86 @@
+import json
+import random
+import threading
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, transaction
+
+from storage.models import Category, Product, Counterparty, OperationGroup, Operation, Action, Stock
+from storage.services import InsufficientStock, SaleLine, apply_sale
+
+
+class Command(BaseCommand):
+    help = "Нагрузка на apply_sale: много продавцов одновременно продают популярные товары"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sellers', type=int, default=8, help="Параллельных продавцов (потоков)")
+        parser.add_argument('--sales', type=int, default=50, help="Продаж на продавца")
+        parser.add_argument('--products', type=int, default=5, help="Популярных товаров")
+        parser.add_argument('--lines', type=int, default=3, help="Строк в продаже")
+        parser.add_argument('--stock', type=int, default=500, help="Начальный остаток каждого товара")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            category = Category.objects.create(name='bench sales')
+            counterparty = Counterparty.objects.create(full_name='bench sales', phone='bench', company_name='bench')
+            products = [Product.objects.create(name=f'bench sales {number}', category=category) for number in range(options['products'])]
+            receipt = OperationGroup.objects.create(counterparty=counterparty, action=Action.RECEIPT)
+            for product in products:
+                Operation.objects.create(operation_group=receipt, product=product, quantity=options['stock'], price=1)
+        product_ids = [product.pk for product in products]
+
+        totals = {'sold': 0, 'rejected': 0, 'lock_errors': 0}
+        lock = threading.Lock()
+
+        def seller(number):
+            rng = random.Random(number)
+            try:
+                for _ in range(options['sales']):
+                    lines = [
+                        SaleLine(rng.choice(product_ids), rng.randint(1, 5), Decimal('1'))
+                        for _ in range(options['lines'])
+                    ]
+                    try:
+                        apply_sale(counterparty.pk, lines)
+                        result = 'sold'
+                    except InsufficientStock:
+                        result = 'rejected'
+                    except OperationalError:
+                        result = 'lock_errors'
+                    with lock:
+                        totals[result] += 1
+            finally:
+                connection.close()
+
+        # продавцы работают в своих транзакциях, откатить все разом нельзя:
+        # данные убираются в finally и при ошибке или прерывании нагрузки
+        try:
+            started = time.monotonic()
+            threads = [threading.Thread(target=seller, args=(number,)) for number in range(options['sellers'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.monotonic() - started
+
+            remaining = dict(Stock.objects.filter(product_id__in=product_ids).values_list('product_id', 'quantity'))
+            result = dict(
+                totals,
+                seconds=round(seconds, 3),
+                sales_per_second=round(totals['sold'] / seconds, 1) if seconds else 0.0,
+                negative=sorted(product_id for product_id, quantity in remaining.items() if quantity < 0),
+            )
+        finally:
+            # группы и операции удаляются с контрагентом, товары - с категорией; журнал получит
+            # события удаления, и отчеты вернутся к прежним итогам
+            with transaction.atomic():
+                counterparty.delete()
+                category.delete()
+
+        self.stdout.write(
+            f"продано {result['sold']}, отказано {result['rejected']}, ошибок блокировки {result['lock_errors']}, "
+            f"{result['sales_per_second']} продаж/с, товаров с минусом: {len(result['negative'])}"
+        )
+        self.stdout.write(json.dumps(result))
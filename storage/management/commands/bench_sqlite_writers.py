@@ -0,0 +1,102 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, transaction
+
+
+MODES = {
+    'default': '0',
+    'concurrent': '1',
+}
+
+
+class Command(BaseCommand):
+    help = "Сравнивает запись в SQLite несколькими процессами: обычный режим и SQLITE_CONCURRENT"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=8, help="Количество параллельных процессов")
+        parser.add_argument('--groups', type=int, default=100, help="Групп операций на процесс")
+        parser.add_argument('--lines', type=int, default=5, help="Операций в группе")
+        parser.add_argument('--worker', action='store_true', help="Внутренний режим: один процесс записи")
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            return self.run_worker(options['groups'], options['lines'])
+
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for mode, flag in MODES.items():
+                env = dict(os.environ, SQLITE_NAME=str(Path(directory) / f'{mode}.sqlite3'), SQLITE_CONCURRENT=flag)
+                env.pop('POSTGRES_DB', None)
+                self.manage(env, 'migrate', '-v0')
+                self.manage(env, 'shell', '-c', SEED)
+                results[mode] = self.run_writers(env, options)
+
+        for mode, result in results.items():
+            self.stdout.write(
+                f"{mode}: {result['groups_per_second']:.1f} групп/с, "
+                f"сохранено {result['saved']}, ошибок блокировки {result['lock_errors']}"
+            )
+        self.stdout.write(json.dumps(results))
+
+    def manage(self, env, *args):
+        subprocess.run([sys.executable, str(settings.BASE_DIR / 'manage.py'), *args], env=env, check=True)
+
+    def run_writers(self, env, options):
+        command = [
+            sys.executable, str(settings.BASE_DIR / 'manage.py'), 'bench_sqlite_writers', '--worker',
+            '--groups', str(options['groups']), '--lines', str(options['lines']),
+        ]
+        workers = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True) for _ in range(options['writers'])]
+        outputs = [json.loads(worker.communicate()[0].strip().splitlines()[-1]) for worker in workers]
+        # время запуска процессов не учитывается, только цикл записи
+        seconds = max(output['seconds'] for output in outputs)
+        saved = sum(output['saved'] for output in outputs)
+        return {
+            'writers': options['writers'],
+            'seconds': round(seconds, 3),
+            'saved': saved,
+            'lock_errors': sum(output['lock_errors'] for output in outputs),
+            'groups_per_second': saved / seconds if seconds else 0.0,
+        }
+
+    def run_worker(self, groups, lines):
+        from storage.models import Product, Counterparty, OperationGroup, Operation, Action, Stock
+
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        counterparty = Counterparty.objects.first()
+        saved = lock_errors = 0
+        started = time.monotonic()
+        for number in range(groups):
+            try:
+                with transaction.atomic():
+                    # как в форме: сначала чтение остатков, потом запись
+                    list(Stock.objects.filter(product_id__in=product_ids[:lines]).values_list('quantity', flat=True))
+                    group = OperationGroup.objects.create(counterparty=counterparty, action=Action.RECEIPT)
+                    for line in range(lines):
+                        Operation.objects.create(
+                            product_id=product_ids[(number + line) % len(product_ids)],
+                            operation_group=group,
+                            quantity=1,
+                            price=1,
+                        )
+                saved += 1
+            except OperationalError:
+                lock_errors += 1
+        seconds = time.monotonic() - started
+        self.stdout.write(json.dumps({'saved': saved, 'lock_errors': lock_errors, 'seconds': seconds}))
+
+
+SEED = """
+from storage.models import Category, Product, Counterparty
+category = Category.objects.create(name='bench')
+Product.objects.bulk_create([Product(name=f'bench {number}', category=category) for number in range(20)])
+Counterparty.objects.create(full_name='bench', phone='0', company_name='bench')
+"""
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage.rollups import build_rollups, reset_rollups
+
+
+class Command(BaseCommand):
+    help = "Переносит в дневные итоги отчетов изменения из журнала операций новее последней отметки"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Событий журнала в одной транзакции")
+        parser.add_argument('--rebuild', action='store_true', help="Очистить итоги и построить заново по всем операциям")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+
+        def progress(processed):
+            self.stdout.write(f"обработано: {processed}, {processed / (time.monotonic() - started):.0f} в секунду")
+
+        if options['rebuild']:
+            rebuilt = reset_rollups(progress=progress)
+            self.stdout.write(f"Учтено операций: {rebuilt} за {time.monotonic() - started:.1f} с")
+            started = time.monotonic()
+        processed = build_rollups(chunk_size=options['chunk_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(f"Обработано: {processed} за {time.monotonic() - started:.1f} с"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from storage.utils import rebuild_totals
+
+
+class Command(BaseCommand):
+    help = "Сверяет хранимые суммы операций и итоги групп с исходными данными и исправляет расхождения"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Только проверить, ничего не исправлять")
+
+    def handle(self, *args, **options):
+        check = options['check']
+        operations, groups = rebuild_totals(fix=not check)
+
+        for pk, stored, actual in operations:
+            self.stdout.write(f"Операция {pk}: сохранено {stored}, фактически {actual}")
+        for pk, stored, actual in groups:
+            self.stdout.write(f"Группа {pk}: сохранено {stored}, фактически {actual}")
+
+        count = len(operations) + len(groups)
+        if not count:
+            self.stdout.write(self.style.SUCCESS("Итоги совпадают с операциями"))
+        elif check:
+            raise CommandError(f"Расхождений: {count}")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Исправлено расхождений: {count}"))
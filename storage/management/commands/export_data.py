@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from storage.exports import EXPORTS, FORMATS, iter_export
+
+
+class Command(BaseCommand):
+    help = "Потоковая выгрузка операций, итогов групп или остатков"
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--output', help="Файл для записи, по умолчанию stdout")
+
+    def handle(self, *args, **options):
+        chunks = iter_export(options['kind'], options['format'])
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+            for chunk in chunks:
+                output.write(chunk)
@@ -0,0 +1,73 @@
+import os
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from storage.importer import ImportRowError, import_operations
+from storage.jobs import enqueue
+from storage.models import ImportCheckpoint
+
+
+class Command(BaseCommand):
+    help = "Импортирует продажи и приемы из CSV или JSONL пачками"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Файл .csv или .jsonl")
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help="Формат файла, по умолчанию по расширению")
+        parser.add_argument('--chunk-size', type=int, default=5000, help="Строк в одной транзакции")
+        parser.add_argument('--source', help="Ключ контрольной точки, по умолчанию путь к файлу")
+        parser.add_argument('--user', help="Имя пользователя для created_by/updated_by")
+        parser.add_argument('--restart', action='store_true', help="Сбросить контрольную точку и начать сначала")
+        parser.add_argument('--background', action='store_true', help="Поставить импорт в очередь фоновых задач (run_workers)")
+
+    def handle(self, *args, **options):
+        source = options['source'] or options['path']
+        user = None
+        if options['user']:
+            user = get_user_model().objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"Пользователь {options['user']} не найден")
+        if options['restart']:
+            ImportCheckpoint.objects.filter(source=source).delete()
+
+        if options['background']:
+            path = os.path.abspath(options['path'])
+            stat = os.stat(path)
+            # тот же файл без изменений второй раз в очередь не попадает (пока хранится его задача),
+            # если не просили начать сначала
+            job = enqueue(
+                'import_operations',
+                {
+                    'path': path,
+                    'fmt': options['format'],
+                    'chunk_size': options['chunk_size'],
+                    'source': source,
+                    'user_id': user.pk if user else None,
+                },
+                key=None if options['restart'] else f"import_operations:{source}:{stat.st_size}:{stat.st_mtime_ns}",
+                user=user,
+                match_done=True,
+            )
+            self.stdout.write(self.style.SUCCESS(f"Импорт в очереди: задача №{job.pk}, {job.get_status_display()}"))
+            return
+
+        def progress(stats):
+            self.stdout.write(f"строк: {stats.rows}, групп: {stats.groups}, {stats.rows_per_second:.0f} строк/с")
+
+        try:
+            stats = import_operations(
+                options['path'],
+                fmt=options['format'],
+                chunk_size=options['chunk_size'],
+                source=source,
+                user=user,
+                progress=progress,
+            )
+        except ImportRowError as exc:
+            raise CommandError(f"{exc}. Сохраненные пачки не откатываются, повторный запуск продолжит с контрольной точки")
+
+        if stats.skipped:
+            self.stdout.write(f"Пропущено уже импортированных строк: {stats.skipped}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Импортировано строк: {stats.rows}, групп: {stats.groups} за {stats.seconds:.1f} с ({stats.rows_per_second:.0f} строк/с)"
+        ))
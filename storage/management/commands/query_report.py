@@ -0,0 +1,48 @@
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from storage.instrumentation import summarize
+
+
+class Command(BaseCommand):
+    help = "Сводка по SQL запросам на URL из журнала STORAGE_QUERY_LOG"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--log', help="Файл журнала, по умолчанию STORAGE_QUERY_LOG")
+        parser.add_argument('--json', action='store_true', help="Вывести сводку в JSON")
+
+    def handle(self, *args, **options):
+        path = options['log'] or getattr(settings, 'STORAGE_QUERY_LOG', None)
+        if not path:
+            raise CommandError("Журнал не задан: укажите --log или STORAGE_QUERY_LOG")
+
+        queries, sql_ms, total_ms, duplicates = defaultdict(list), defaultdict(list), defaultdict(list), defaultdict(int)
+        try:
+            with open(path, encoding='utf-8') as log:
+                for line in log:
+                    entry = json.loads(line)
+                    name = entry['url_name']
+                    queries[name].append(entry['queries'])
+                    sql_ms[name].append(entry['sql_ms'])
+                    total_ms[name].append(entry['total_ms'])
+                    duplicates[name] = max(duplicates[name], entry['duplicates'])
+        except FileNotFoundError:
+            raise CommandError(f"Файл {path} не найден")
+
+        report = {
+            name: dict(summarize(queries[name], sql_ms[name], total_ms[name]), duplicates_max=duplicates[name])
+            for name in queries
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        for name, row in sorted(report.items(), key=lambda item: item[1]['queries_p95'], reverse=True):
+            self.stdout.write(
+                f"{name}: запросов {row['requests']}, SQL p50/p95 {row['queries_p50']}/{row['queries_p95']} "
+                f"(макс. {row['queries_max']}, повторов {row['duplicates_max']}), "
+                f"SQL мс p95 {row['sql_ms_p95']}, ответ мс p95 {row['total_ms_p95']}"
+            )
@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from storage import search
+
+
+class Command(BaseCommand):
+    help = "Заново строит поисковые таблицы товаров и контрагентов для админки"
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Поисковый индекс построен за {time.monotonic() - started:.1f} с"))
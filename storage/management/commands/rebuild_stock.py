@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from storage.utils import rebuild_stock
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает таблицу остатков по истории операций"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help="Только проверить, ничего не исправлять")
+
+    def handle(self, *args, **options):
+        check = options['check']
+        mismatches = rebuild_stock(fix=not check)
+
+        for product_id, stored, actual in mismatches:
+            self.stdout.write(f"Товар {product_id}: сохранено {stored}, фактически {actual}")
+
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS("Остатки совпадают с историей операций"))
+        elif check:
+            raise CommandError(f"Расхождений: {len(mismatches)}")
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Исправлено расхождений: {len(mismatches)}"))
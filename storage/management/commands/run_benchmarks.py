@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from storage.benchmarks import BENCHMARKS, regressions, run
+
+
+class Command(BaseCommand):
+    help = "Замеры горячих путей склада; сравнение с базовыми результатами"
+
+    def add_arguments(self, parser):
+        parser.add_argument('names', nargs='*', help=f"Замеры, по умолчанию все: {', '.join(BENCHMARKS)}")
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--output', help="Записать результаты в JSON файл")
+        parser.add_argument('--baseline', help="JSON файл с прошлыми результатами")
+        parser.add_argument('--tolerance', type=float, default=0.25, help="Допустимое замедление, доля")
+
+    def handle(self, *args, **options):
+        names = options['names'] or list(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(f"Неизвестные замеры: {', '.join(sorted(unknown))}")
+
+        # тестовый клиент ходит с хостом testserver
+        with override_settings(ALLOWED_HOSTS=['*']):
+            try:
+                results = [result.as_dict() for result in run(names, options['repeat'])]
+            except RuntimeError as exc:
+                raise CommandError(str(exc))
+
+        for result in results:
+            self.stdout.write(
+                f"{result['name']}: медиана {result['median_ms']} мс, p95 {result['p95_ms']} мс, запросов {result['queries']}"
+            )
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump({'results': results}, output, ensure_ascii=False, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as baseline_file:
+                baseline = {result['name']: result for result in json.load(baseline_file)['results']}
+            problems = regressions(results, baseline, options['tolerance'])
+            if problems:
+                raise CommandError("Регрессии:\n" + "\n".join(problems))
+            self.stdout.write(self.style.SUCCESS("Регрессий нет"))
@@ -0,0 +1,91 @@
+import multiprocessing
+import signal
+import time
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from storage.jobs import TASKS, queue_stats, work, worker_name
+
+
+def worker_main(stop, names, poll, burst):
+    """ Процесс обработчика: выполняет задачи, пока главный процесс не попросит остановиться.
+    """
+    django.setup()
+    # Ctrl+C получает вся группа процессов, останавливает их главный процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    work(worker_name(), names, poll=poll, burst=burst, should_stop=stop.is_set)
+
+
+class Command(BaseCommand):
+    help = "Запускает обработчики очереди фоновых задач"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=getattr(settings, 'STORAGE_JOB_WORKERS', 2), help="Количество процессов-обработчиков",
+        )
+        parser.add_argument('--tasks', nargs='*', help=f"Выполнять только эти задачи: {', '.join(TASKS)}")
+        parser.add_argument('--poll', type=float, default=1.0, help="Пауза опроса пустой очереди, секунд")
+        parser.add_argument('--burst', action='store_true', help="Выйти, когда готовых задач не останется")
+        parser.add_argument('--stats-interval', type=float, default=60, help="Как часто выводить состояние очереди, секунд")
+
+    def handle(self, *args, **options):
+        names = options['tasks'] or None
+        unknown = set(names or ()) - set(TASKS)
+        if unknown:
+            raise CommandError(f"Неизвестные задачи: {', '.join(sorted(unknown))}")
+        if options['processes'] < 1:
+            raise CommandError("Нужен хотя бы один процесс")
+
+        stop = multiprocessing.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+
+        def start(number):
+            process = multiprocessing.Process(
+                target=worker_main,
+                args=(stop, names, options['poll'], options['burst']),
+                name=f'worker-{number}',
+            )
+            process.start()
+            return process
+
+        # соединения с базой не должны достаться дочерним процессам
+        connections.close_all()
+        started = time.monotonic()
+        processes = {number: start(number) for number in range(options['processes'])}
+        self.stdout.write(f"Запущено обработчиков: {len(processes)}")
+        reported = time.monotonic()
+        while not stop.is_set():
+            for number, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                if options['burst']:
+                    del processes[number]
+                elif process.exitcode != 0:
+                    self.stderr.write(f"Обработчик {process.name} завершился с кодом {process.exitcode}, перезапуск")
+                    processes[number] = start(number)
+            if not processes:
+                break
+            if time.monotonic() - reported >= options['stats_interval']:
+                self.write_stats()
+                reported = time.monotonic()
+            stop.wait(1)
+
+        stop.set()
+        for process in processes.values():
+            process.join()
+        connections.close_all()
+        self.write_stats()
+        self.stdout.write(self.style.SUCCESS(f"Обработчики остановлены через {time.monotonic() - started:.1f} с"))
+
+    def write_stats(self):
+        stats = queue_stats()
+        self.stdout.write(
+            f"в очереди: {stats['queued']}, выполняется: {stats['running']}, ошибок: {stats['failed']}, "
+            f"выполнено за час: {stats['done']} ({stats['per_minute']} в минуту), "
+            f"задержка запуска: медиана {stats['latency_median_s']} с, p95 {stats['latency_p95_s']} с"
+        )
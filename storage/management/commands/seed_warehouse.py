@@ -0,0 +1,165 @@
+import random
+import time
+from bisect import bisect
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from itertools import accumulate
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from storage.models import Category, Product, Counterparty, OperationGroup, Operation, Action, Stock, operation_amount
+from storage import search
+from storage.rollups import reset_rollups
+from storage.utils import rebuild_stock, signed_quantity
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """ Позволяет задать created_at в bulk_create: auto_now_add иначе ставит текущее время.
+
+    Поле общее для процесса, поэтому исходные значения восстанавливаются
+    при любом выходе, в том числе по ошибке.
+    """
+    fields = [model._meta.get_field('created_at') for model in models]
+    saved = [field.auto_now_add for field in fields]
+    try:
+        for field in fields:
+            field.auto_now_add = False
+        yield
+    finally:
+        for field, auto_now_add in zip(fields, saved):
+            field.auto_now_add = auto_now_add
+
+
+def insert_operations(rows) -> None:
+    """ Вставка операций одним executemany: в разы быстрее bulk_create на миллионах строк.
+
+    rows - кортежи (product_id, operation_group_id, quantity, price, discount, amount, signed_quantity, created_at).
+    """
+    ops = connection.ops
+    columns = ('product_id', 'operation_group_id', 'quantity', 'price', 'discount', 'amount', 'signed_quantity', 'created_at', 'updated_at')
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        ops.quote_name(Operation._meta.db_table),
+        ', '.join(ops.quote_name(column) for column in columns),
+        ', '.join(['%s'] * len(columns)),
+    )
+    params = []
+    for product_id, group_id, quantity, price, discount, amount, signed, created_at in rows:
+        created_at = ops.adapt_datetimefield_value(created_at)
+        params.append((
+            product_id,
+            group_id,
+            quantity,
+            ops.adapt_decimalfield_value(price, 10, 2),
+            ops.adapt_decimalfield_value(discount, 10, 2),
+            ops.adapt_decimalfield_value(amount, 14, 2),
+            signed,
+            created_at,
+            created_at,
+        ))
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def zipf_weights(count: int, exponent: float):
+    """ Накопленные веса: небольшая часть товаров и контрагентов дает большую часть оборота.
+    """
+    return list(accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+class Command(BaseCommand):
+    help = "Заполняет базу синтетическими данными склада для замеров производительности"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=50)
+        parser.add_argument('--products', type=int, default=10000)
+        parser.add_argument('--counterparties', type=int, default=1000)
+        parser.add_argument('--operations', type=int, default=500000, help="Всего операций")
+        parser.add_argument('--max-lines', type=int, default=10, help="Максимум операций в группе")
+        parser.add_argument('--days', type=int, default=365, help="За сколько дней распределить операции")
+        parser.add_argument('--skew', type=float, default=1.1, help="Показатель распределения Ципфа")
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        chunk_size = options['chunk_size']
+        started = time.monotonic()
+
+        categories = Category.objects.bulk_create(
+            [Category(name=f"Категория {number}") for number in range(options['categories'])]
+        )
+        products = []
+        for start in range(0, options['products'], chunk_size):
+            batch = Product.objects.bulk_create([
+                Product(name=f"Товар {number}", category=rng.choice(categories))
+                for number in range(start, min(start + chunk_size, options['products']))
+            ])
+            Stock.objects.bulk_create([Stock(product=product) for product in batch])
+            products.extend(product.pk for product in batch)
+        counterparties = [
+            counterparty.pk for counterparty in Counterparty.objects.bulk_create([
+                Counterparty(
+                    full_name=f"Контрагент {number}",
+                    phone=f"+992{number:09d}",
+                    phone_digits=f"992{number:09d}",
+                    company_name=f"Компания {number}",
+                )
+                for number in range(options['counterparties'])
+            ])
+        ]
+        rng.shuffle(products)
+        product_weights = zipf_weights(len(products), options['skew'])
+        counterparty_weights = zipf_weights(len(counterparties), options['skew'])
+        self.stdout.write(f"Справочники созданы за {time.monotonic() - started:.1f} с")
+
+        now = timezone.now()
+        period = options['days'] * 86400
+        created = 0
+        with explicit_timestamps(OperationGroup):
+            while created < options['operations']:
+                groups, lines = [], []
+                while len(lines) < chunk_size and created + len(lines) < options['operations']:
+                    created_at = now - timedelta(seconds=rng.random() * period)
+                    group = OperationGroup(
+                        counterparty_id=counterparties[bisect(counterparty_weights, rng.random() * counterparty_weights[-1])],
+                        action=Action.SALE if rng.random() < 0.7 else Action.RECEIPT,
+                        created_at=created_at,
+                    )
+                    groups.append(group)
+                    for _ in range(rng.randint(1, options['max_lines'])):
+                        quantity = rng.randint(1, 20)
+                        price = Decimal(rng.randint(100, 100000)) / 100
+                        discount = Decimal(rng.choice((0, 0, 0, 5, 10, 15)))
+                        amount = operation_amount(quantity, price, discount)
+                        group.total_quantity += quantity
+                        group.total_amount += amount
+                        group.lines_count += 1
+                        lines.append((
+                            group,
+                            products[bisect(product_weights, rng.random() * product_weights[-1])],
+                            quantity,
+                            price,
+                            discount,
+                            amount,
+                            signed_quantity(group.action, quantity),
+                            created_at,
+                        ))
+                with transaction.atomic():
+                    OperationGroup.objects.bulk_create(groups)
+                    insert_operations(
+                        (product_id, group.pk, quantity, price, discount, amount, signed, created_at)
+                        for group, product_id, quantity, price, discount, amount, signed, created_at in lines
+                    )
+                created += len(lines)
+                elapsed = time.monotonic() - started
+                self.stdout.write(f"операций: {created}, {created / elapsed:.0f} в секунду")
+
+        rebuild_stock()
+        # bulk_create минует сигналы и журнал, поисковые таблицы и отчеты строятся целиком
+        search.rebuild()
+        reset_rollups()
+        self.stdout.write(self.style.SUCCESS(f"Готово за {time.monotonic() - started:.1f} с"))
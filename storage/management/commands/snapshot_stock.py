@@ -0,0 +1,36 @@
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from storage.snapshots import take_snapshot
+
+
+class Command(BaseCommand):
+    help = "Записывает снимок остатков (по умолчанию на конец вчерашнего дня)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help="День YYYY-MM-DD, снимок на его конец")
+        parser.add_argument('--now', action='store_true', help="Снимок на текущий момент")
+        parser.add_argument('--days', type=int, default=1, help="Сколько дней назад от --date заполнить")
+
+    def handle(self, *args, **options):
+        if options['now']:
+            count = take_snapshot()
+            self.stdout.write(self.style.SUCCESS(f"Снимок записан, товаров: {count}"))
+            return
+
+        if options['date']:
+            try:
+                day = datetime.strptime(options['date'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("Дата должна быть в формате YYYY-MM-DD")
+        else:
+            day = timezone.localdate() - timedelta(days=1)
+
+        # от последнего дня к первому: каждый снимок считается от соседнего
+        for offset in range(options['days']):
+            current = day - timedelta(days=offset)
+            taken_at = timezone.make_aware(datetime.combine(current + timedelta(days=1), time.min))
+            count = take_snapshot(taken_at)
+            self.stdout.write(f"{current}: товаров {count}")
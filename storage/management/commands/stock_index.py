@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from storage import stockindex
+
+
+class Command(BaseCommand):
+    help = "Заполняет общий индекс остатков (STORAGE_STOCK_INDEX) из таблицы Stock"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', type=float, help="Сверять индекс с базой каждые N секунд, пока процесс не остановят")
+
+    def handle(self, *args, **options):
+        index = stockindex.get_index()
+        if index is None:
+            raise CommandError("Индекс остатков выключен: задайте STORAGE_STOCK_INDEX")
+        while True:
+            started = time.monotonic()
+            count = index.reconcile()
+            self.stdout.write(f"Индекс {index.path}: товаров {count} за {time.monotonic() - started:.3f} с")
+            if not options['watch']:
+                break
+            time.sleep(options['watch'])
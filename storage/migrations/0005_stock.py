@@ -0,0 +1,52 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:24
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Case, F, IntegerField, Sum, When
+from django.db.models.functions import Coalesce
+
+
+def fill_stock(apps, schema_editor):
+    Product = apps.get_model('storage', 'Product')
+    Stock = apps.get_model('storage', 'Stock')
+    products = Product.objects.order_by().annotate(
+        remaining=Coalesce(
+            Sum(
+                Case(
+                    When(operation__operation_group__action=1, then=-F('operation__quantity')),
+                    default=F('operation__quantity'),
+                    output_field=IntegerField(),
+                )
+            ),
+            0,
+        )
+    ).values_list('id', 'remaining')
+    Stock.objects.bulk_create([Stock(product_id=product_id, quantity=remaining) for product_id, remaining in products], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0004_alter_product_options_operationgroup_operation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Stock',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock', serialize=False, to='storage.product', verbose_name='Товар')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Количество')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Время изменения')),
+            ],
+            options={
+                'verbose_name': 'Остаток',
+                'verbose_name_plural': 'Остатки',
+            },
+        ),
+        migrations.AlterField(
+            model_name='operationgroup',
+            name='action',
+            field=models.IntegerField(choices=[(1, 'Продажа'), (2, 'Прием')], verbose_name='Действие'),
+        ),
+        migrations.RunPython(fill_stock, migrations.RunPython.noop),
+    ]
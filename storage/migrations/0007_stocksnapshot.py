@@ -0,0 +1,32 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0006_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(verbose_name='Время снимка')),
+                ('quantity', models.IntegerField(verbose_name='Количество')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='storage.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Снимок остатка',
+                'verbose_name_plural': 'Снимки остатков',
+                'ordering': ('-taken_at',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stocksnapshot',
+            constraint=models.UniqueConstraint(fields=('taken_at', 'product'), name='unique_stock_snapshot'),
+        ),
+    ]
@@ -0,0 +1,79 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:29
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Trigram and pattern indexes for the admin search fields, PostgreSQL only
+SEARCH_INDEXES = (
+    ('product_name_trgm_idx', 'storage_product', 'name'),
+    ('category_name_trgm_idx', 'storage_category', 'name'),
+    ('counterparty_full_name_trgm_idx', 'storage_counterparty', 'full_name'),
+    ('counterparty_phone_trgm_idx', 'storage_counterparty', 'phone'),
+    ('counterparty_company_trgm_idx', 'storage_counterparty', 'company_name'),
+)
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in SEARCH_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin (UPPER({column}) gin_trgm_ops)')
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name[:-9]}_like_idx ON {table} (UPPER({column}) text_pattern_ops)')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, column in SEARCH_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name[:-9]}_like_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0007_stocksnapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='counterparty',
+            index=models.Index(fields=['full_name'], name='counterparty_full_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='counterparty',
+            index=models.Index(fields=['phone'], name='counterparty_phone_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['product', 'operation_group', 'quantity'], name='operation_product_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['created_at', 'product', 'operation_group', 'quantity'], name='operation_created_product_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='operationgroup',
+            index=models.Index(fields=['action', 'created_at'], name='opgroup_action_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='operationgroup',
+            index=models.Index(fields=['counterparty', '-id'], name='opgroup_counterparty_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='operationgroup',
+            index=models.Index(fields=['created_at'], name='opgroup_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', '-id'], name='product_category_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['name'], name='product_name_idx'),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:44
+
+from collections import defaultdict
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_totals(apps, schema_editor):
+    Operation = apps.get_model('storage', 'Operation')
+    OperationGroup = apps.get_model('storage', 'OperationGroup')
+    actions = dict(OperationGroup.objects.order_by().values_list('id', 'action'))
+    totals = defaultdict(lambda: [0, Decimal('0'), 0])
+    batch = []
+    rows = Operation.objects.order_by('id').values_list('id', 'operation_group_id', 'quantity', 'price', 'discount').iterator(chunk_size=2000)
+    for pk, group_id, quantity, price, discount in rows:
+        amount = (quantity * price * (1 - discount / 100)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        batch.append(Operation(pk=pk, amount=amount, signed_quantity=-quantity if actions[group_id] == 1 else quantity))
+        group_totals = totals[group_id]
+        group_totals[0] += quantity
+        group_totals[1] += amount
+        group_totals[2] += 1
+        if len(batch) >= 2000:
+            Operation.objects.bulk_update(batch, ['amount', 'signed_quantity'])
+            batch = []
+    Operation.objects.bulk_update(batch, ['amount', 'signed_quantity'])
+    OperationGroup.objects.bulk_update(
+        [
+            OperationGroup(pk=pk, total_quantity=quantity, total_amount=amount, lines_count=lines)
+            for pk, (quantity, amount, lines) in totals.items()
+        ],
+        ['total_quantity', 'total_amount', 'lines_count'],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0009_product_image_hash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='operation',
+            name='operation_product_group_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='operation',
+            name='operation_created_product_idx',
+        ),
+        migrations.AddField(
+            model_name='operation',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=14, verbose_name='Сумма'),
+        ),
+        migrations.AddField(
+            model_name='operation',
+            name='signed_quantity',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Количество со знаком'),
+        ),
+        migrations.AddField(
+            model_name='operationgroup',
+            name='lines_count',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Строк'),
+        ),
+        migrations.AddField(
+            model_name='operationgroup',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=16, verbose_name='Общая сумма'),
+        ),
+        migrations.AddField(
+            model_name='operationgroup',
+            name='total_quantity',
+            field=models.IntegerField(default=0, editable=False, verbose_name='Количество товаров'),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['product', 'signed_quantity'], name='operation_product_signed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='operation',
+            index=models.Index(fields=['created_at', 'product', 'signed_quantity'], name='operation_created_product_idx'),
+        ),
+    ]
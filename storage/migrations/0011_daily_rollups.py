@@ -0,0 +1,71 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0010_operation_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Watermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='Название')),
+                ('value', models.PositiveBigIntegerField(default=0, verbose_name='Последний id')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Время изменения')),
+            ],
+            options={
+                'verbose_name': 'Отметка обработки',
+                'verbose_name_plural': 'Отметки обработки',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyCounterpartyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('action', models.IntegerField(choices=[(1, 'Продажа'), (2, 'Прием')], verbose_name='Действие')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Количество')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=16, verbose_name='Сумма')),
+                ('lines', models.IntegerField(default=0, verbose_name='Операций')),
+                ('counterparty', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='storage.counterparty', verbose_name='Контрагент')),
+            ],
+            options={
+                'verbose_name': 'Итог контрагента за день',
+                'verbose_name_plural': 'Итоги контрагентов за день',
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='День')),
+                ('action', models.IntegerField(choices=[(1, 'Продажа'), (2, 'Прием')], verbose_name='Действие')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Количество')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=16, verbose_name='Сумма')),
+                ('lines', models.IntegerField(default=0, verbose_name='Операций')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='storage.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Отчет',
+                'verbose_name_plural': 'Отчеты',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailycounterpartyrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'counterparty', 'action'), name='unique_daily_counterparty_rollup'),
+        ),
+        migrations.AddIndex(
+            model_name='dailyrollup',
+            index=models.Index(fields=['product', 'action', 'day'], name='rollup_product_action_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailyrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'product', 'action'), name='unique_daily_rollup'),
+        ),
+    ]
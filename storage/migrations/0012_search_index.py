@@ -0,0 +1,97 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:53
+
+from django.db import migrations, models
+
+
+# SQL поисковых таблиц на момент миграции: storage.search может меняться, миграция - нет.
+
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS storage_product_search USING fts5("
+    "name, category, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3 4 5 6')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS storage_counterparty_search USING fts5("
+    "full_name, company_name, phone, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3 4 5 6')",
+)
+
+POSTGRESQL_CREATE = (
+    "CREATE TABLE IF NOT EXISTS storage_product_search (id bigint PRIMARY KEY, document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS storage_product_search_document_idx ON storage_product_search USING gin (document)",
+    "CREATE TABLE IF NOT EXISTS storage_counterparty_search (id bigint PRIMARY KEY, document tsvector NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS storage_counterparty_search_document_idx ON storage_counterparty_search USING gin (document)",
+)
+
+SQLITE_INSERT = {
+    'product': "INSERT INTO storage_product_search (rowid, name, category) VALUES (%s, %s, %s)",
+    'counterparty': "INSERT INTO storage_counterparty_search (rowid, full_name, company_name, phone) VALUES (%s, %s, %s, %s)",
+}
+
+POSTGRESQL_INSERT = {
+    'product': "INSERT INTO storage_product_search (id, document) VALUES (%s, to_tsvector('simple', %s))",
+    'counterparty': "INSERT INTO storage_counterparty_search (id, document) VALUES (%s, to_tsvector('simple', %s))",
+}
+
+DROP = (
+    "DROP TABLE IF EXISTS storage_product_search",
+    "DROP TABLE IF EXISTS storage_counterparty_search",
+)
+
+
+def phone_tokens(digits):
+    return f'{digits} {digits[-9:]}' if len(digits) > 9 else digits
+
+
+def fill_search_index(apps, schema_editor):
+    Product = apps.get_model('storage', 'Product')
+    Counterparty = apps.get_model('storage', 'Counterparty')
+    counterparties = list(Counterparty.objects.only('id', 'phone'))
+    for counterparty in counterparties:
+        counterparty.phone_digits = ''.join(char for char in counterparty.phone or '' if char.isdigit())
+    Counterparty.objects.bulk_update(counterparties, ['phone_digits'], batch_size=1000)
+
+    connection = schema_editor.connection
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    rows = {
+        'product': [
+            (pk, (name, category or ''))
+            for pk, name, category in Product.objects.order_by().values_list('id', 'name', 'category__name')
+        ],
+        'counterparty': [
+            (pk, (full_name, company_name, phone_tokens(digits)))
+            for pk, full_name, company_name, digits in Counterparty.objects.order_by().values_list('id', 'full_name', 'company_name', 'phone_digits')
+        ],
+    }
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            for sql in SQLITE_CREATE:
+                cursor.execute(sql)
+            for kind, sql in SQLITE_INSERT.items():
+                cursor.executemany(sql, [(pk, *values) for pk, values in rows[kind]])
+        else:
+            for sql in POSTGRESQL_CREATE:
+                cursor.execute(sql)
+            for kind, sql in POSTGRESQL_INSERT.items():
+                cursor.executemany(sql, [(pk, ' '.join(values)) for pk, values in rows[kind]])
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ('sqlite', 'postgresql'):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for sql in DROP:
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0011_daily_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='counterparty',
+            name='phone_digits',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=32, verbose_name='Цифры телефона'),
+        ),
+        migrations.RunPython(fill_search_index, drop_search_index),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:23
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0012_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Задача')),
+                ('payload', models.JSONField(blank=True, default=dict, verbose_name='Параметры')),
+                ('status', models.IntegerField(choices=[(1, 'В очереди'), (2, 'Выполняется'), (3, 'Готово'), (4, 'Ошибка'), (5, 'Отменено')], default=1, verbose_name='Состояние')),
+                ('priority', models.SmallIntegerField(default=0, verbose_name='Приоритет')),
+                ('idempotency_key', models.CharField(blank=True, max_length=200, null=True, unique=True, verbose_name='Ключ идемпотентности')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('max_attempts', models.PositiveSmallIntegerField(default=3, verbose_name='Максимум попыток')),
+                ('run_after', models.DateTimeField(verbose_name='Не раньше')),
+                ('progress', models.PositiveBigIntegerField(default=0, verbose_name='Выполнено')),
+                ('progress_total', models.PositiveBigIntegerField(blank=True, null=True, verbose_name='Всего')),
+                ('message', models.CharField(blank=True, max_length=255, verbose_name='Сообщение')),
+                ('result', models.JSONField(blank=True, null=True, verbose_name='Результат')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('worker', models.CharField(blank=True, max_length=100, verbose_name='Обработчик')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время создания')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Время запуска')),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True, verbose_name='Последний отклик')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Время завершения')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='%(class)s_created_by', to=settings.AUTH_USER_MODEL, verbose_name='Кто создал')),
+            ],
+            options={
+                'verbose_name': 'Фоновая задача',
+                'verbose_name_plural': 'Фоновые задачи',
+                'ordering': ('-id',),
+                'indexes': [models.Index(fields=['status', '-priority', 'run_after'], name='job_queue_idx'), models.Index(fields=['status', 'heartbeat_at'], name='job_heartbeat_idx')],
+            },
+        ),
+    ]
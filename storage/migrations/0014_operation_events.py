@@ -0,0 +1,74 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:34
+
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+def backfill_rollup_events(apps, schema_editor):
+    """ Отчеты читали операции по id до отметки 'rollups', теперь читают журнал.
+    Операции новее отметки записываются в журнал, чтобы отчеты их не потеряли.
+    Если отчеты не строились, build_rollups построит их по всем операциям.
+    """
+    Watermark = apps.get_model('storage', 'Watermark')
+    Operation = apps.get_model('storage', 'Operation')
+    OperationEvent = apps.get_model('storage', 'OperationEvent')
+    watermark = Watermark.objects.filter(name='rollups').first()
+    if watermark is None:
+        return
+    rows = (
+        Operation.objects.filter(id__gt=watermark.value).order_by('id')
+        .values_list(
+            'id', 'product_id', 'operation_group_id', 'operation_group__counterparty_id', 'operation_group__action',
+            'quantity', 'price', 'discount', 'amount', 'signed_quantity', 'created_at',
+        )
+        .iterator(chunk_size=2000)
+    )
+    batch = []
+    for pk, product_id, group_id, counterparty_id, action, quantity, price, discount, amount, signed, created_at in rows:
+        batch.append(OperationEvent(kind=1, operation_id=pk, operation_group_id=group_id, after={
+            'product': product_id,
+            'group': group_id,
+            'counterparty': counterparty_id,
+            'action': action,
+            'quantity': quantity,
+            'price': price,
+            'discount': discount,
+            'amount': amount,
+            'signed_quantity': signed,
+            'created_at': created_at,
+        }))
+        if len(batch) >= 2000:
+            OperationEvent.objects.bulk_create(batch)
+            batch = []
+    OperationEvent.objects.bulk_create(batch)
+    Watermark.objects.create(name='events:rollups', value=0)
+    watermark.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0013_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OperationEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.SmallIntegerField(choices=[(1, 'Создание'), (2, 'Изменение'), (3, 'Удаление')], verbose_name='Изменение')),
+                ('operation_id', models.PositiveBigIntegerField(blank=True, null=True, verbose_name='Операция')),
+                ('operation_group_id', models.PositiveBigIntegerField(verbose_name='Группа операций')),
+                ('before', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='До')),
+                ('after', models.JSONField(blank=True, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True, verbose_name='После')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время создания')),
+            ],
+            options={
+                'verbose_name': 'Событие журнала операций',
+                'verbose_name_plural': 'Журнал операций',
+                'ordering': ('id',),
+                'indexes': [models.Index(fields=['created_at'], name='opevent_created_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_rollup_events, migrations.RunPython.noop),
+    ]
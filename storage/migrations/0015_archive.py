@@ -0,0 +1,81 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0014_operation_events'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpeningBalance',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='opening_balance', serialize=False, to='storage.product', verbose_name='Товар')),
+                ('quantity', models.IntegerField(default=0, verbose_name='Количество')),
+                ('lines', models.IntegerField(default=0, verbose_name='Операций в архиве')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Время изменения')),
+            ],
+            options={
+                'verbose_name': 'Начальный остаток',
+                'verbose_name_plural': 'Начальные остатки',
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOperationGroup',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.IntegerField(choices=[(1, 'Продажа'), (2, 'Прием')], verbose_name='Действие')),
+                ('comment', models.TextField(blank=True, verbose_name='Комментарий')),
+                ('total_quantity', models.IntegerField(default=0, verbose_name='Количество товаров')),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=16, verbose_name='Общая сумма')),
+                ('lines_count', models.IntegerField(default=0, verbose_name='Строк')),
+                ('created_at', models.DateTimeField(verbose_name='Время создания')),
+                ('updated_at', models.DateTimeField(verbose_name='Время изменения')),
+                ('archived_at', models.DateTimeField(verbose_name='Время архивации')),
+                ('counterparty', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='storage.counterparty', verbose_name='Контрагент')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Кто создал')),
+                ('updated_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Кто изменил')),
+            ],
+            options={
+                'verbose_name': 'Архивная группа операций',
+                'verbose_name_plural': 'Архив групп операций',
+                'ordering': ('-id',),
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedOperation',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(verbose_name='Количество')),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Цена')),
+                ('discount', models.DecimalField(decimal_places=2, default=0, max_digits=10, verbose_name='Скидка')),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14, verbose_name='Сумма')),
+                ('signed_quantity', models.IntegerField(default=0, verbose_name='Количество со знаком')),
+                ('created_at', models.DateTimeField(verbose_name='Время создания')),
+                ('updated_at', models.DateTimeField(verbose_name='Время изменения')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Кто создал')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='storage.product', verbose_name='Товар')),
+                ('updated_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Кто изменил')),
+                ('operation_group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='storage.archivedoperationgroup', verbose_name='Группа операций')),
+            ],
+            options={
+                'verbose_name': 'Архивная операция',
+                'verbose_name_plural': 'Архив операций',
+                'ordering': ('-id',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='archivedoperationgroup',
+            index=models.Index(fields=['counterparty', 'action'], name='archgroup_counterparty_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedoperation',
+            index=models.Index(fields=['created_at', 'product', 'signed_quantity'], name='archop_created_product_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0015_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importcheckpoint',
+            name='fingerprint',
+            field=models.CharField(blank=True, max_length=100, verbose_name='Отпечаток файла'),
+        ),
+    ]
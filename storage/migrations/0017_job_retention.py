@@ -0,0 +1,28 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:59
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0016_importcheckpoint_fingerprint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='idempotency_key',
+            field=models.CharField(blank=True, db_index=True, max_length=200, null=True, verbose_name='Ключ идемпотентности'),
+        ),
+        migrations.AddIndex(
+            model_name='job',
+            index=models.Index(fields=['status', 'finished_at'], name='job_finished_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', (1, 2))), fields=('idempotency_key',), name='job_active_idempotency_key'),
+        ),
+    ]
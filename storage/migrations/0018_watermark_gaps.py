@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0017_job_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='watermark',
+            name='gaps',
+            field=models.JSONField(blank=True, default=list, verbose_name='Пропуски'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0018_watermark_gaps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stock',
+            name='version',
+            field=models.PositiveBigIntegerField(default=1, verbose_name='Версия'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 17:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('storage', '0019_stock_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedoperationgroup',
+            name='counterparty',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='storage.counterparty', verbose_name='Контрагент'),
+        ),
+    ]
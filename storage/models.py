@@ -1,9 +1,32 @@
-from django.db import models
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Optional
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
 
 
 User = get_user_model()
 
+CENT = Decimal('0.01')
+
+
+def operation_amount(quantity: int, price, discount) -> Decimal:
+    """ Сумма операции quantity * price * (1 - discount / 100), округленная до копеек.
+
+    Используется во всех путях записи, чтобы хранимые суммы совпадали.
+    """
+    amount = Decimal(quantity) * Decimal(price) * (1 - Decimal(discount) / 100)
+    return amount.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def normalize_phone(phone: str) -> str:
+    """ Только цифры номера: "+992 (90) 000-00-01" -> "992900000001".
+    """
+    return ''.join(char for char in phone or '' if char.isdigit())
+
+
 class Category(models.Model):
     """Model category for product"""
     
@@ -28,8 +51,13 @@ class Product(models.Model):
         ordering = ("-id",)
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
+        indexes = [
+            models.Index(fields=("category", "-id"), name="product_category_idx"),
+            models.Index(fields=("name",), name="product_name_idx"),
+        ]
         
     image = models.ImageField(upload_to="products/", verbose_name="Изображение", blank=True, null=True)
+    image_hash = models.CharField(verbose_name="Хеш изображения", max_length=64, blank=True, editable=False)
     name = models.CharField(verbose_name="Название", max_length=200)
     description = models.TextField(verbose_name="Описание", blank=True, null=True)
     category = models.ForeignKey(Category, verbose_name="Категория", on_delete=models.CASCADE)
@@ -39,9 +67,17 @@ class Product(models.Model):
     updated_by = models.ForeignKey(User, verbose_name="Кто изменил", on_delete=models.SET_NULL, related_name="%(class)s_updated_by", blank=True, null=True)
     
     def __str__(self) -> str:
-        from .utils import get_remaining_product
-        
-        return f"{self.name} ( {get_remaining_product(product=self)} )"
+        # остаток показывается только если он уже загружен: аннотация
+        # remaining или select_related('stock'), без запросов в базу
+        remaining = self.__dict__.get('remaining')
+        if remaining is None and Product.stock.is_cached(self):
+            try:
+                remaining = self.stock.quantity
+            except ObjectDoesNotExist:
+                remaining = 0
+        if remaining is None:
+            return self.name
+        return f"{self.name} ( {remaining} )"
     
     
 
@@ -52,9 +88,14 @@ class Counterparty(models.Model):
         ordering = ("-id",)
         verbose_name = "Контрагент"
         verbose_name_plural = "Контрагенты"
+        indexes = [
+            models.Index(fields=("full_name",), name="counterparty_full_name_idx"),
+            models.Index(fields=("phone",), name="counterparty_phone_idx"),
+        ]
         
     full_name = models.CharField(verbose_name="ФИО", max_length=200)
     phone = models.CharField(verbose_name="Телефон", max_length=200)
+    phone_digits = models.CharField(verbose_name="Цифры телефона", max_length=32, blank=True, editable=False, db_index=True)
     company_name = models.CharField(verbose_name="Компания", max_length=255)
     created_at = models.DateTimeField(verbose_name="Время создания", auto_now_add=True)
     updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
@@ -77,10 +118,21 @@ class OperationGroup(models.Model):
         ordering = ("-id",)
         verbose_name = "Группа операций"
         verbose_name_plural = "Группы операций"
+        indexes = [
+            models.Index(fields=("action", "created_at"), name="opgroup_action_created_idx"),
+            models.Index(fields=("counterparty", "-id"), name="opgroup_counterparty_idx"),
+            models.Index(fields=("created_at",), name="opgroup_created_idx"),
+        ]
         
+    TOTAL_FIELDS = ('total_quantity', 'total_amount', 'lines_count')
+
     counterparty = models.ForeignKey(Counterparty, verbose_name="Контрагент", on_delete=models.CASCADE)
     action = models.IntegerField(verbose_name="Действие", choices=Action.choices)
     comment = models.TextField(verbose_name="Комментарий", blank=True)
+    # итоги по операциям группы, поддерживаются сигналами и массовыми загрузками
+    total_quantity = models.IntegerField(verbose_name="Количество товаров", default=0, editable=False)
+    total_amount = models.DecimalField(verbose_name="Общая сумма", max_digits=16, decimal_places=2, default=0, editable=False)
+    lines_count = models.IntegerField(verbose_name="Строк", default=0, editable=False)
     created_at = models.DateTimeField(verbose_name="Время создания", auto_now_add=True)
     updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
     created_by = models.ForeignKey(User, verbose_name="Кто создал", on_delete=models.SET_NULL, related_name="%(class)s_created_by", blank=True, null=True)
@@ -89,7 +141,25 @@ class OperationGroup(models.Model):
     
     def __str__(self) -> str:
         action = 'Продажа' if self.action == Action.SALE else 'Прием'
-        return f"{self.counterparty.full_name} {action}"
+        # контрагент берется только если загружен через select_related
+        if OperationGroup.counterparty.is_cached(self):
+            return f"{self.counterparty.full_name} {action}"
+        return f"№{self.pk} {action}"
+    
+    def save(self, *args, **kwargs):
+        # итоги меняются только операциями, устаревшие значения из памяти не записываем
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.TOTAL_FIELDS
+            ]
+        # сигналы правят остатки и итоги, они должны попасть в ту же транзакцию
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
     
     
 class Operation(models.Model):
@@ -99,24 +169,322 @@ class Operation(models.Model):
         ordering = ("-id",)
         verbose_name = "Операция"
         verbose_name_plural = "Операции"
+        indexes = [
+            # покрывающий индекс для пересчета остатка товара
+            models.Index(fields=("product", "signed_quantity"), name="operation_product_signed_idx"),
+            models.Index(fields=("created_at", "product", "signed_quantity"), name="operation_created_product_idx"),
+        ]
         
     product = models.ForeignKey(Product, verbose_name="Товар", on_delete=models.CASCADE)
     operation_group = models.ForeignKey(OperationGroup, verbose_name="Группа операций", on_delete=models.CASCADE)
     quantity = models.IntegerField(verbose_name="Количество")
     price = models.DecimalField(verbose_name="Цена", max_digits=10, decimal_places=2)
     discount = models.DecimalField(verbose_name="Скидка", max_digits=10, decimal_places=2, default=0)
+    # хранятся при записи, отчеты суммируют их без пересчета и без соединения с группой
+    amount = models.DecimalField(verbose_name="Сумма", max_digits=14, decimal_places=2, default=0, editable=False)
+    signed_quantity = models.IntegerField(verbose_name="Количество со знаком", default=0, editable=False)
     created_at = models.DateTimeField(verbose_name="Время создания", auto_now_add=True)
     updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
     created_by = models.ForeignKey(User, verbose_name="Кто создал", on_delete=models.SET_NULL, related_name="%(class)s_created_by", blank=True, null=True)
     updated_by = models.ForeignKey(User, verbose_name="Кто изменил", on_delete=models.SET_NULL, related_name="%(class)s_updated_by", blank=True, null=True)
     
-    @property
-    def amount(self) -> float:
-        return self.quantity * self.price * (1 - self.discount / 100)
-    
     @property
     def action(self) -> int:
         return self.operation_group.action
     
+    def calculate(self, action: Optional[int] = None) -> None:
+        """ Заполняет amount и signed_quantity. action передается, если действие группы уже известно.
+        При сохранении вызывается сигналом pre_save, в том числе при загрузке фикстур.
+        """
+        if action is None:
+            action = self.action
+        self.amount = operation_amount(self.quantity, self.price, self.discount)
+        self.signed_quantity = -self.quantity if action == Action.SALE else self.quantity
+    
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+    
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            return super().delete(*args, **kwargs)
+    
     def __str__(self) -> str:        
-        return f"{self.product.name}"
\ No newline at end of file
+        return f"{self.product.name}"
+    
+    
+class Stock(models.Model):
+    """Model stock balance of product, maintained by signals"""
+    
+    class Meta:
+        verbose_name = "Остаток"
+        verbose_name_plural = "Остатки"
+        
+    product = models.OneToOneField(Product, verbose_name="Товар", on_delete=models.CASCADE, primary_key=True, related_name="stock")
+    quantity = models.IntegerField(verbose_name="Количество", default=0)
+    # растет с каждым изменением количества, по ней индекс остатков (stockindex) не пишет старое поверх нового
+    version = models.PositiveBigIntegerField(verbose_name="Версия", default=1)
+    updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
+    
+    def __str__(self) -> str:
+        return f"{self.product_id}: {self.quantity}"
+    
+    
+class StockSnapshot(models.Model):
+    """Model stock balance of product at a point in time"""
+    
+    class Meta:
+        ordering = ("-taken_at",)
+        verbose_name = "Снимок остатка"
+        verbose_name_plural = "Снимки остатков"
+        constraints = [
+            models.UniqueConstraint(fields=("taken_at", "product"), name="unique_stock_snapshot"),
+        ]
+        
+    product = models.ForeignKey(Product, verbose_name="Товар", on_delete=models.CASCADE)
+    taken_at = models.DateTimeField(verbose_name="Время снимка")
+    quantity = models.IntegerField(verbose_name="Количество")
+    
+    def __str__(self) -> str:
+        return f"{self.product_id} {self.taken_at}: {self.quantity}"
+    
+    
+class ImportCheckpoint(models.Model):
+    """Model position of bulk import, saved in the same transaction as the batch"""
+    
+    class Meta:
+        verbose_name = "Контрольная точка импорта"
+        verbose_name_plural = "Контрольные точки импорта"
+        
+    source = models.CharField(verbose_name="Источник", max_length=255, unique=True)
+    # размер, время изменения и хеш начала файла: другой файл по тому же пути начинается сначала
+    fingerprint = models.CharField(verbose_name="Отпечаток файла", max_length=100, blank=True)
+    line = models.PositiveBigIntegerField(verbose_name="Обработано строк", default=0)
+    updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
+    
+    def __str__(self) -> str:
+        return f"{self.source}: {self.line}"
+    
+    
+class Watermark(models.Model):
+    """Model position up to which a background job has processed operations"""
+    
+    class Meta:
+        verbose_name = "Отметка обработки"
+        verbose_name_plural = "Отметки обработки"
+        
+    name = models.CharField(verbose_name="Название", max_length=100, unique=True)
+    value = models.PositiveBigIntegerField(verbose_name="Последний id", default=0)
+    # [id, xmax снимка] еще не зафиксированных событий ниже value, см. events._batch
+    gaps = models.JSONField(verbose_name="Пропуски", default=list, blank=True)
+    updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
+    
+    def __str__(self) -> str:
+        return f"{self.name}: {self.value}"
+    
+    
+class DailyRollup(models.Model):
+    """Model operations of product aggregated per day and action, built by build_rollups"""
+    
+    class Meta:
+        verbose_name = "Отчет"
+        verbose_name_plural = "Отчеты"
+        constraints = [
+            models.UniqueConstraint(fields=("day", "product", "action"), name="unique_daily_rollup"),
+        ]
+        indexes = [
+            models.Index(fields=("product", "action", "day"), name="rollup_product_action_day_idx"),
+        ]
+        
+    day = models.DateField(verbose_name="День")
+    product = models.ForeignKey(Product, verbose_name="Товар", on_delete=models.CASCADE)
+    action = models.IntegerField(verbose_name="Действие", choices=Action.choices)
+    quantity = models.IntegerField(verbose_name="Количество", default=0)
+    amount = models.DecimalField(verbose_name="Сумма", max_digits=16, decimal_places=2, default=0)
+    lines = models.IntegerField(verbose_name="Операций", default=0)
+    
+    def __str__(self) -> str:
+        return f"{self.day} {self.product_id} {self.action}"
+    
+    
+class DailyCounterpartyRollup(models.Model):
+    """Model operations of counterparty aggregated per day and action, built by build_rollups"""
+    
+    class Meta:
+        verbose_name = "Итог контрагента за день"
+        verbose_name_plural = "Итоги контрагентов за день"
+        constraints = [
+            models.UniqueConstraint(fields=("day", "counterparty", "action"), name="unique_daily_counterparty_rollup"),
+        ]
+        
+    day = models.DateField(verbose_name="День")
+    counterparty = models.ForeignKey(Counterparty, verbose_name="Контрагент", on_delete=models.CASCADE)
+    action = models.IntegerField(verbose_name="Действие", choices=Action.choices)
+    quantity = models.IntegerField(verbose_name="Количество", default=0)
+    amount = models.DecimalField(verbose_name="Сумма", max_digits=16, decimal_places=2, default=0)
+    lines = models.IntegerField(verbose_name="Операций", default=0)
+    
+    def __str__(self) -> str:
+        return f"{self.day} {self.counterparty_id} {self.action}"
+    
+    
+class JobStatus(models.IntegerChoices):
+    QUEUED = 1, "В очереди"
+    RUNNING = 2, "Выполняется"
+    DONE = 3, "Готово"
+    FAILED = 4, "Ошибка"
+    CANCELLED = 5, "Отменено"
+    
+    
+class Job(models.Model):
+    """Model background task, executed by run_workers"""
+    
+    class Meta:
+        ordering = ("-id",)
+        verbose_name = "Фоновая задача"
+        verbose_name_plural = "Фоновые задачи"
+        indexes = [
+            # выбор следующей задачи: status = В очереди, по убыванию приоритета
+            models.Index(fields=("status", "-priority", "run_after"), name="job_queue_idx"),
+            models.Index(fields=("status", "heartbeat_at"), name="job_heartbeat_idx"),
+            models.Index(fields=("status", "finished_at"), name="job_finished_idx"),
+        ]
+        constraints = [
+            # ключ занят, пока задача ждет или выполняется; завершенные его освобождают
+            models.UniqueConstraint(
+                fields=("idempotency_key",),
+                condition=models.Q(status__in=(1, 2)),
+                name="job_active_idempotency_key",
+            ),
+        ]
+        
+    name = models.CharField(verbose_name="Задача", max_length=100)
+    payload = models.JSONField(verbose_name="Параметры", default=dict, blank=True)
+    status = models.IntegerField(verbose_name="Состояние", choices=JobStatus.choices, default=JobStatus.QUEUED)
+    priority = models.SmallIntegerField(verbose_name="Приоритет", default=0)
+    # повторная постановка с тем же ключом возвращает ждущую или выполняемую задачу
+    idempotency_key = models.CharField(verbose_name="Ключ идемпотентности", max_length=200, blank=True, null=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(verbose_name="Попыток", default=0)
+    max_attempts = models.PositiveSmallIntegerField(verbose_name="Максимум попыток", default=3)
+    run_after = models.DateTimeField(verbose_name="Не раньше")
+    progress = models.PositiveBigIntegerField(verbose_name="Выполнено", default=0)
+    progress_total = models.PositiveBigIntegerField(verbose_name="Всего", blank=True, null=True)
+    message = models.CharField(verbose_name="Сообщение", max_length=255, blank=True)
+    result = models.JSONField(verbose_name="Результат", blank=True, null=True)
+    error = models.TextField(verbose_name="Ошибка", blank=True)
+    worker = models.CharField(verbose_name="Обработчик", max_length=100, blank=True)
+    created_at = models.DateTimeField(verbose_name="Время создания", auto_now_add=True)
+    started_at = models.DateTimeField(verbose_name="Время запуска", blank=True, null=True)
+    heartbeat_at = models.DateTimeField(verbose_name="Последний отклик", blank=True, null=True)
+    finished_at = models.DateTimeField(verbose_name="Время завершения", blank=True, null=True)
+    created_by = models.ForeignKey(User, verbose_name="Кто создал", on_delete=models.SET_NULL, related_name="%(class)s_created_by", blank=True, null=True)
+    
+    def __str__(self) -> str:
+        return f"№{self.pk} {self.name}"
+    
+    
+class EventKind(models.IntegerChoices):
+    CREATE = 1, "Создание"
+    UPDATE = 2, "Изменение"
+    DELETE = 3, "Удаление"
+    
+    
+class OperationEvent(models.Model):
+    """Model append-only change log of operations and groups, written in the same transaction as the change"""
+    
+    class Meta:
+        ordering = ("id",)
+        verbose_name = "Событие журнала операций"
+        verbose_name_plural = "Журнал операций"
+        indexes = [
+            models.Index(fields=("created_at",), name="opevent_created_idx"),
+        ]
+        
+    kind = models.SmallIntegerField(verbose_name="Изменение", choices=EventKind.choices)
+    # без внешних ключей: событие переживает удаленную строку
+    operation_id = models.PositiveBigIntegerField(verbose_name="Операция", blank=True, null=True)
+    operation_group_id = models.PositiveBigIntegerField(verbose_name="Группа операций")
+    # состояние строки до и после изменения, см. storage.events
+    before = models.JSONField(verbose_name="До", encoder=DjangoJSONEncoder, blank=True, null=True)
+    after = models.JSONField(verbose_name="После", encoder=DjangoJSONEncoder, blank=True, null=True)
+    created_at = models.DateTimeField(verbose_name="Время создания", auto_now_add=True)
+    
+    def __str__(self) -> str:
+        target = f"операция {self.operation_id}" if self.operation_id else f"группа {self.operation_group_id}"
+        return f"№{self.pk} {self.get_kind_display()}: {target}"
+    
+    
+class OpeningBalance(models.Model):
+    """Model stock of product carried over from operations moved to the archive"""
+    
+    class Meta:
+        verbose_name = "Начальный остаток"
+        verbose_name_plural = "Начальные остатки"
+        
+    product = models.OneToOneField(Product, verbose_name="Товар", on_delete=models.CASCADE, primary_key=True, related_name="opening_balance")
+    quantity = models.IntegerField(verbose_name="Количество", default=0)
+    lines = models.IntegerField(verbose_name="Операций в архиве", default=0)
+    updated_at = models.DateTimeField(verbose_name="Время изменения", auto_now=True)
+    
+    def __str__(self) -> str:
+        return f"{self.product_id}: {self.quantity}"
+    
+    
+class ArchivedOperationGroup(models.Model):
+    """Model operation group moved to the archive by archive_operations, read-only"""
+    
+    class Meta:
+        ordering = ("-id",)
+        verbose_name = "Архивная группа операций"
+        verbose_name_plural = "Архив групп операций"
+        indexes = [
+            models.Index(fields=("counterparty", "action"), name="archgroup_counterparty_idx"),
+        ]
+        
+    # id сохраняются из рабочей таблицы
+    id = models.BigIntegerField(verbose_name="ID", primary_key=True)
+    # каскад удалил бы архивные операции, не поправив начальные остатки (OpeningBalance)
+    counterparty = models.ForeignKey(Counterparty, verbose_name="Контрагент", on_delete=models.PROTECT)
+    action = models.IntegerField(verbose_name="Действие", choices=Action.choices)
+    comment = models.TextField(verbose_name="Комментарий", blank=True)
+    total_quantity = models.IntegerField(verbose_name="Количество товаров", default=0)
+    total_amount = models.DecimalField(verbose_name="Общая сумма", max_digits=16, decimal_places=2, default=0)
+    lines_count = models.IntegerField(verbose_name="Строк", default=0)
+    created_at = models.DateTimeField(verbose_name="Время создания")
+    updated_at = models.DateTimeField(verbose_name="Время изменения")
+    created_by = models.ForeignKey(User, verbose_name="Кто создал", on_delete=models.SET_NULL, related_name="+", blank=True, null=True)
+    updated_by = models.ForeignKey(User, verbose_name="Кто изменил", on_delete=models.SET_NULL, related_name="+", blank=True, null=True)
+    archived_at = models.DateTimeField(verbose_name="Время архивации")
+    
+    def __str__(self) -> str:
+        action = 'Продажа' if self.action == Action.SALE else 'Прием'
+        return f"№{self.pk} {action}"
+    
+    
+class ArchivedOperation(models.Model):
+    """Model operation moved to the archive by archive_operations, read-only"""
+    
+    class Meta:
+        ordering = ("-id",)
+        verbose_name = "Архивная операция"
+        verbose_name_plural = "Архив операций"
+        indexes = [
+            # окна остатков на дату (storage.snapshots) читают и архив
+            models.Index(fields=("created_at", "product", "signed_quantity"), name="archop_created_product_idx"),
+        ]
+        
+    id = models.BigIntegerField(verbose_name="ID", primary_key=True)
+    product = models.ForeignKey(Product, verbose_name="Товар", on_delete=models.CASCADE)
+    operation_group = models.ForeignKey(ArchivedOperationGroup, verbose_name="Группа операций", on_delete=models.CASCADE)
+    quantity = models.IntegerField(verbose_name="Количество")
+    price = models.DecimalField(verbose_name="Цена", max_digits=10, decimal_places=2)
+    discount = models.DecimalField(verbose_name="Скидка", max_digits=10, decimal_places=2, default=0)
+    amount = models.DecimalField(verbose_name="Сумма", max_digits=14, decimal_places=2, default=0)
+    signed_quantity = models.IntegerField(verbose_name="Количество со знаком", default=0)
+    created_at = models.DateTimeField(verbose_name="Время создания")
+    updated_at = models.DateTimeField(verbose_name="Время изменения")
+    created_by = models.ForeignKey(User, verbose_name="Кто создал", on_delete=models.SET_NULL, related_name="+", blank=True, null=True)
+    updated_by = models.ForeignKey(User, verbose_name="Кто изменил", on_delete=models.SET_NULL, related_name="+", blank=True, null=True)
+    
+    def __str__(self) -> str:
+        return f"№{self.pk} {self.product_id}"
@@ -0,0 +1,129 @@
+import hashlib
+import json
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .cache import get_or_compute
+
+
+# Списки админки для больших таблиц. Обычный ChangeList на каждой странице считает
+# COUNT(*) по всей выборке и пропускает строки через OFFSET, на миллионах строк это
+# секунды. Здесь страницы выбираются по id (seek): WHERE id < последний id страницы
+# ORDER BY -id LIMIT n, а количество строк оценивается или берется из кеша.
+
+CURSOR_AFTER = 'after'
+CURSOR_BEFORE = 'before'
+CURSOR_VARS = (CURSOR_AFTER, CURSOR_BEFORE)
+
+
+def _planner_rows(queryset) -> Optional[int]:
+    """ Оценка количества строк планировщиком PostgreSQL, без выполнения запроса.
+    """
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    rows = plan[0]['Plan'].get('Plan Rows')
+    return int(rows) if rows is not None else None
+
+
+def estimated_count(queryset) -> Optional[int]:
+    """ Оценка планировщика для больших выборок в PostgreSQL. None, если выборка
+    меньше STORAGE_ADMIN_EXACT_COUNT строк или база не дает оценки: тогда нужен точный COUNT.
+    """
+    if connections[queryset.db].vendor != 'postgresql':
+        return None
+    estimate = _planner_rows(queryset)
+    if estimate is None or estimate <= getattr(settings, 'STORAGE_ADMIN_EXACT_COUNT', 10000):
+        return None
+    return estimate
+
+
+def cached_count(queryset) -> int:
+    """ COUNT(*) выборки, кешируется на STORAGE_ADMIN_COUNT_TIMEOUT секунд.
+    """
+    sql, params = queryset.order_by().query.sql_with_params()
+    digest = hashlib.md5(f'{queryset.db}:{sql}:{params!r}'.encode()).hexdigest()
+    return get_or_compute(f'storage:count:{digest}', queryset.count, getattr(settings, 'STORAGE_ADMIN_COUNT_TIMEOUT', 60))
+
+
+class EstimatedCountPaginator(Paginator):
+    """ Paginator без COUNT(*) на каждой странице: большие выборки оцениваются,
+    остальные считаются точно с кешем. estimated - количество приблизительное.
+    """
+
+    estimated = False
+
+    @cached_property
+    def count(self) -> int:
+        estimate = estimated_count(self.object_list)
+        self.estimated = estimate is not None
+        return estimate if self.estimated else cached_count(self.object_list)
+
+
+def _cursor(value) -> Optional[int]:
+    return int(value) if value and value.isdigit() else None
+
+
+class KeysetChangeList(ChangeList):
+    """ Страницы списка по id вместо OFFSET: ?after=<id> - следующие (более старые) строки,
+    ?before=<id> - предыдущие. Любая страница стоит как первая. При сортировке
+    по другой колонке и в списках с list_editable работает обычная постраничная навигация.
+    """
+
+    def __init__(self, request, *args, **kwargs):
+        self.after = _cursor(request.GET.get(CURSOR_AFTER))
+        self.before = _cursor(request.GET.get(CURSOR_BEFORE))
+        self.keyset = False
+        self.first_url = self.newer_url = self.older_url = None
+        super().__init__(request, *args, **kwargs)
+        # ссылки фильтров и сортировки ведут на первую страницу
+        for name in CURSOR_VARS:
+            self.params.pop(name, None)
+            self.filter_params.pop(name, None)
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        for name in CURSOR_VARS:
+            lookup_params.pop(name, None)
+        return lookup_params
+
+    def _cursor_url(self, **cursor) -> str:
+        return self.get_query_string(cursor, list(CURSOR_VARS))
+
+    def get_results(self, request):
+        ordering = tuple(self.queryset.query.order_by)
+        if ORDER_VAR in self.params or self.list_editable or ordering not in (('-pk',), ('-id',)):
+            return super().get_results(request)
+        self.keyset = True
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = paginator.count
+        self.full_result_count = None
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.can_show_all = self.result_count <= self.list_max_show_all
+        self.paginator = paginator
+        if self.show_all and self.can_show_all:
+            self.result_list = self.queryset._clone()
+            self.multi_page = False
+            return
+
+        size = self.list_per_page
+        if self.before is not None:
+            rows = list(self.queryset.filter(pk__gt=self.before).order_by('pk')[:size + 1])
+            has_newer, has_older = len(rows) > size, True
+            rows = rows[:size][::-1]
+        else:
+            queryset = self.queryset if self.after is None else self.queryset.filter(pk__lt=self.after)
+            rows = list(queryset[:size + 1])
+            has_newer, has_older = self.after is not None, len(rows) > size
+            rows = rows[:size]
+        self.result_list = rows
+        self.multi_page = has_newer or has_older
+        if rows and has_newer:
+            self.first_url = self._cursor_url()
+            self.newer_url = self._cursor_url(**{CURSOR_BEFORE: rows[0].pk})
+        if rows and has_older:
+            self.older_url = self._cursor_url(**{CURSOR_AFTER: rows[-1].pk})
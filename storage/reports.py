@@ -0,0 +1,94 @@
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Dict, List
+
+from django.db.models import Exists, F, Max, OuterRef, Subquery, Sum
+
+from .models import Action, DailyRollup, DailyCounterpartyRollup, Stock
+
+
+def _sales(start: date, end: date):
+    return DailyRollup.objects.filter(action=Action.SALE, day__gte=start, day__lte=end).order_by()
+
+
+def daily_revenue(start: date, end: date) -> List[dict]:
+    return list(
+        _sales(start, end).values('day')
+        .annotate(quantity=Sum('quantity'), amount=Sum('amount'))
+        .order_by('day')
+    )
+
+
+def revenue_by_category(start: date, end: date) -> List[dict]:
+    return list(
+        _sales(start, end).values(category=F('product__category__name'))
+        .annotate(quantity=Sum('quantity'), amount=Sum('amount'))
+        .order_by('-amount')
+    )
+
+
+def revenue_by_counterparty(start: date, end: date, limit: int = 50) -> List[dict]:
+    return list(
+        DailyCounterpartyRollup.objects.filter(action=Action.SALE, day__gte=start, day__lte=end).order_by()
+        .values(counterparty_name=F('counterparty__full_name'))
+        .annotate(quantity=Sum('quantity'), amount=Sum('amount'))
+        .order_by('-amount')[:limit]
+    )
+
+
+def top_products(start: date, end: date, limit: int = 20) -> List[dict]:
+    return list(
+        _sales(start, end).values(name=F('product__name'))
+        .annotate(quantity=Sum('quantity'), amount=Sum('amount'))
+        .order_by('-quantity')[:limit]
+    )
+
+
+def turnover(start: date, end: date) -> Dict[str, dict]:
+    """ Приход и продажи за период.
+    """
+    rows = (
+        DailyRollup.objects.filter(day__gte=start, day__lte=end).order_by()
+        .values('action')
+        .annotate(quantity=Sum('quantity'), amount=Sum('amount'))
+    )
+    result = {name: {'quantity': 0, 'amount': Decimal('0')} for name in ('sale', 'receipt')}
+    for row in rows:
+        result['sale' if row['action'] == Action.SALE else 'receipt'] = {'quantity': row['quantity'], 'amount': row['amount']}
+    return result
+
+
+def slow_moving(today: date, days: int = 90, limit: int = 50) -> List[dict]:
+    """ Товары на складе без продаж за последние days дней, давно не продававшиеся первыми.
+    """
+    sales = DailyRollup.objects.filter(product=OuterRef('product'), action=Action.SALE)
+    return list(
+        Stock.objects.filter(quantity__gt=0)
+        .filter(~Exists(sales.filter(day__gt=today - timedelta(days=days))))
+        .annotate(last_sale=Subquery(sales.order_by().values('product').annotate(last=Max('day')).values('last')))
+        .values('quantity', 'last_sale', name=F('product__name'))
+        .order_by(F('last_sale').asc(nulls_first=True), '-quantity')[:limit]
+    )
+
+
+def year_over_year(year: int) -> List[dict]:
+    """ Выручка по месяцам за год и предыдущий год.
+    """
+    # суммы по дням, месяцы собираются в Python: функции дат в SQLite медленнее самой выборки
+    amounts = defaultdict(Decimal)
+    for row in _sales(date(year - 1, 1, 1), date(year, 12, 31)).values('day').annotate(amount=Sum('amount')):
+        amounts[(row['day'].year, row['day'].month)] += row['amount']
+    months = [
+        {
+            'month': month,
+            'current': amounts.get((year, month), Decimal('0')),
+            'previous': amounts.get((year - 1, month), Decimal('0')),
+        }
+        for month in range(1, 13)
+    ]
+    peak = max([row['current'] for row in months] + [row['previous'] for row in months]) or 1
+    for row in months:
+        row['current_width'] = round(row['current'] / peak * 100)
+        row['previous_width'] = round(row['previous'] / peak * 100)
+    return months
@@ -0,0 +1,195 @@
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from . import events
+from .archive import lock_archive
+from .events import consumer, state_amount, state_created_at
+from .jobs import enqueue
+from .models import Operation, ArchivedOperation, DailyRollup, DailyCounterpartyRollup, OperationEvent
+
+
+# отчеты - потребитель журнала операций, отметка хранит id последнего учтенного события
+WATERMARK = events.cursor_name('rollups')
+
+# (день, товар или контрагент, действие) -> [количество, сумма, операций]
+Totals = Dict[Tuple, list]
+
+
+def _totals() -> Totals:
+    return defaultdict(lambda: [0, Decimal('0'), 0])
+
+
+def _add(model, field: str, totals: Totals) -> None:
+    """ Прибавляет итоги к строкам отчета, создает недостающие и удаляет опустевшие.
+    """
+    by_day = defaultdict(set)
+    for day, object_id, action in totals:
+        by_day[day].add(object_id)
+    existing = {}
+    for day, object_ids in by_day.items():
+        for row in model.objects.filter(day=day, **{f'{field}_id__in': object_ids}):
+            existing[(row.day, getattr(row, f'{field}_id'), row.action)] = row
+
+    # товар или контрагент мог быть удален до того, как его события дошли до отчетов
+    missing = {object_id for day, object_id, action in totals if (day, object_id, action) not in existing}
+    alive = set(model._meta.get_field(field).related_model.objects.filter(pk__in=missing).values_list('pk', flat=True)) if missing else set()
+
+    created, updated, empty = [], [], []
+    for (day, object_id, action), (quantity, amount, lines) in sorted(totals.items()):
+        row = existing.get((day, object_id, action))
+        if row is None:
+            if lines > 0 and object_id in alive:
+                created.append(model(day=day, action=action, quantity=quantity, amount=amount, lines=lines, **{f'{field}_id': object_id}))
+            continue
+        if row.lines + lines:
+            updated.append((quantity, connection.ops.adapt_decimalfield_value(amount, 16, 2), lines, row.pk))
+        else:
+            empty.append(row.pk)
+    model.objects.bulk_create(created, batch_size=1000)
+    if updated:
+        # прибавление одним executemany: bulk_update строит CASE на каждую строку и в разы медленнее
+        table = connection.ops.quote_name(model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'UPDATE {table} SET "quantity" = "quantity" + %s, "amount" = "amount" + %s, "lines" = "lines" + %s WHERE "id" = %s',
+                updated,
+            )
+    if empty:
+        model.objects.filter(pk__in=empty).delete()
+
+
+def _save(products: Totals, counterparties: Totals) -> None:
+    _add(DailyRollup, 'product', products)
+    _add(DailyCounterpartyRollup, 'counterparty', counterparties)
+
+
+def _lag() -> int:
+    return getattr(settings, 'STORAGE_ROLLUP_LAG', 60)
+
+
+def _upsert(model, field: str, source: str, operations) -> None:
+    """ Прибавляет итоги пачки операций одним INSERT ... SELECT ... ON CONFLICT DO UPDATE
+    (SQLite 3.24+ и PostgreSQL), без выборки строк отчета в Python.
+    """
+    rows = (
+        operations.order_by()
+        .values(
+            rollup_day=TruncDate('created_at'),
+            rollup_object=F(source),
+            rollup_action=F('operation_group__action'),
+        )
+        .annotate(rollup_quantity=Sum('quantity'), rollup_amount=Sum('amount'), rollup_lines=Count('id'))
+    )
+    sql, params = rows.query.sql_with_params()
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    column = quote(f'{field}_id')
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ("day", {column}, "action", "quantity", "amount", "lines") '
+            f'SELECT rollup_day, rollup_object, rollup_action, rollup_quantity, rollup_amount, rollup_lines '
+            f'FROM ({sql}) AS batch WHERE true '
+            f'ON CONFLICT ("day", {column}, "action") DO UPDATE SET '
+            f'"quantity" = {table}."quantity" + excluded."quantity", '
+            f'"amount" = {table}."amount" + excluded."amount", '
+            f'"lines" = {table}."lines" + excluded."lines"',
+            params,
+        )
+
+
+@consumer('rollups', "Дневные итоги отчетов")
+def apply_events(batch: List[OperationEvent]) -> None:
+    """ Правит итоги по событиям журнала: вставка прибавляет операцию,
+    удаление вычитает, правка вычитает старое состояние и прибавляет новое.
+    """
+    products, counterparties = _totals(), _totals()
+    for item in batch:
+        if item.operation_id is None:
+            # смена действия или контрагента группы приходит событиями ее операций
+            continue
+        for state, sign in ((item.before, -1), (item.after, 1)):
+            if not state:
+                continue
+            day = timezone.localdate(state_created_at(state))
+            for totals, key in ((products, (day, state['product'], state['action'])), (counterparties, (day, state['counterparty'], state['action']))):
+                totals[key][0] += sign * state['quantity']
+                totals[key][1] += sign * state_amount(state)
+                totals[key][2] += sign
+    _save(products, counterparties)
+
+
+def reset_rollups(chunk_size: int = 20000, progress: Optional[Callable[[int], None]] = None) -> int:
+    """ Строит отчеты заново по всем операциям, рабочим и архивным; журнал дальше
+    читается с последнего события.
+
+    Идет одной транзакцией, запись и перенос операций в архив на это время ждут.
+    Возвращает количество учтенных операций.
+    """
+    processed = 0
+    with transaction.atomic():
+        last_event = events.lock_log()
+        lock_archive()
+        DailyRollup.objects.all().delete()
+        DailyCounterpartyRollup.objects.all().delete()
+        for model in (ArchivedOperation, Operation):
+            after = 0
+            while True:
+                remaining = model.objects.filter(id__gt=after).order_by('id')
+                bound = remaining.values_list('id', flat=True)[chunk_size - 1:chunk_size].first()
+                if bound is None:
+                    bound = remaining.order_by('-id').values_list('id', flat=True).first()
+                if bound is None:
+                    break
+                operations = model.objects.filter(id__gt=after, id__lte=bound)
+                _upsert(DailyRollup, 'product', 'product_id', operations)
+                _upsert(DailyCounterpartyRollup, 'counterparty', 'operation_group__counterparty_id', operations)
+                processed += operations.count()
+                after = bound
+                if progress:
+                    progress(processed)
+        events.set_position('rollups', last_event)
+    return processed
+
+
+def build_rollups(chunk_size: int = 5000, progress: Optional[Callable[[int], None]] = None) -> int:
+    """ Правит отчеты по событиям журнала новее отметки, пачками по chunk_size.
+
+    Каждая пачка сохраняется одной транзакцией вместе с отметкой,
+    прерванный запуск продолжается с последней сохраненной пачки.
+    Если отчеты еще не строились, они строятся по всем операциям.
+    Возвращает количество обработанных событий или операций.
+    """
+    if events.position('rollups') is None:
+        return reset_rollups(progress=progress)
+    return events.consume('rollups', batch_size=chunk_size, progress=progress)
+
+
+# ключ последней задачи, поставленной этим процессом и зафиксированной
+_scheduled: Set[str] = set()
+
+
+def schedule_rollups() -> None:
+    """ Ставит build_rollups в очередь фоновых задач не раньше чем через
+    STORAGE_ROLLUP_LAG секунд. Изменения за один интервал сводятся к одной задаче.
+    """
+    lag = max(_lag(), 1)
+    bucket = int(timezone.now().timestamp() // lag)
+    key = f'build_rollups:{lag}:{bucket}'
+    if key in _scheduled:
+        return
+    run_after = datetime.fromtimestamp((bucket + 2) * lag, tz=timezone.get_current_timezone())
+    enqueue('build_rollups', key=key, run_after=run_after, priority=-1)
+
+    def remember():
+        _scheduled.clear()
+        _scheduled.add(key)
+
+    transaction.on_commit(remember)
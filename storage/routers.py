@@ -0,0 +1,51 @@
+from contextlib import contextmanager
+
+from asgiref.local import Local
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+REPLICA_DB_ALIAS = 'replica'
+
+_state = Local()
+
+
+def replica_alias() -> str:
+    """ База для тяжелых чтений: реплика, если она настроена, иначе основная.
+    """
+    return REPLICA_DB_ALIAS if REPLICA_DB_ALIAS in settings.DATABASES else DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def replica_reads():
+    """ Внутри блока чтения идут на реплику (кроме открытых транзакций на основной базе).
+    """
+    depth = getattr(_state, 'depth', 0)
+    _state.depth = depth + 1
+    try:
+        yield
+    finally:
+        _state.depth = depth
+
+
+class ReplicaRouter:
+    """ Запись всегда в основную базу, чтения в replica_reads() - на реплику.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_state, 'depth', 0) or REPLICA_DB_ALIAS not in settings.DATABASES:
+            return None
+        # внутри транзакции читаем свои же записи из основной базы
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return REPLICA_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплика содержит те же данные, связи между базами допустимы
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != REPLICA_DB_ALIAS
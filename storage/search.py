@@ -0,0 +1,202 @@
+import re
+from dataclasses import dataclass
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from django.db import connection as default_connection, transaction
+from django.db.models.expressions import RawSQL
+
+from .models import Product, Counterparty, normalize_phone
+
+
+# Поисковые таблицы для админки: FTS5 в SQLite, tsvector с GIN-индексом в PostgreSQL.
+# Строки ведутся сигналами, rebuild_search_index строит их заново.
+
+
+@dataclass(frozen=True)
+class SearchIndex:
+    table: str
+    columns: Tuple[str, ...]
+
+
+INDEXES = {
+    'product': SearchIndex('storage_product_search', ('name', 'category')),
+    'counterparty': SearchIndex('storage_counterparty_search', ('full_name', 'company_name', 'phone')),
+}
+
+VENDORS = ('sqlite', 'postgresql')
+
+PHONE_RE = re.compile(r'[\d\s+()-]+')
+
+RANK_WINDOW = 500
+
+
+def supported(connection=default_connection) -> bool:
+    return connection.vendor in VENDORS
+
+
+def phone_tokens(digits: str) -> str:
+    """ Номер целиком и без кода страны, чтобы искать по обоим началам.
+    """
+    return f'{digits} {digits[-9:]}' if len(digits) > 9 else digits
+
+
+def product_rows(products) -> Iterable[Tuple[int, Tuple[str, ...]]]:
+    for pk, name, category in products.order_by().values_list('id', 'name', 'category__name').iterator(chunk_size=2000):
+        yield pk, (name, category or '')
+
+
+def counterparty_rows(counterparties) -> Iterable[Tuple[int, Tuple[str, ...]]]:
+    for pk, full_name, company_name, digits in (
+        counterparties.order_by().values_list('id', 'full_name', 'company_name', 'phone_digits').iterator(chunk_size=2000)
+    ):
+        yield pk, (full_name, company_name, phone_tokens(digits))
+
+
+def create_tables(connection) -> None:
+    with connection.cursor() as cursor:
+        for index in INDEXES.values():
+            if connection.vendor == 'sqlite':
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {index.table} USING fts5("
+                    f"{', '.join(index.columns)}, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3 4 5 6')"
+                )
+            elif connection.vendor == 'postgresql':
+                cursor.execute(f"CREATE TABLE IF NOT EXISTS {index.table} (id bigint PRIMARY KEY, document tsvector NOT NULL)")
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {index.table}_document_idx ON {index.table} USING gin (document)")
+
+
+def drop_tables(connection) -> None:
+    if not supported(connection):
+        return
+    with connection.cursor() as cursor:
+        for index in INDEXES.values():
+            cursor.execute(f"DROP TABLE IF EXISTS {index.table}")
+
+
+def remove(kind: str, ids: Sequence[int], connection=default_connection) -> None:
+    ids = list(ids)
+    if not ids or not supported(connection):
+        return
+    # FTS5 ищет по rowid только при сравнении на равенство, IN (...) читает всю таблицу
+    column = 'rowid' if connection.vendor == 'sqlite' else 'id'
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {INDEXES[kind].table} WHERE {column} = %s", [(pk,) for pk in ids])
+
+
+def write(
+    kind: str,
+    rows: Iterable[Tuple[int, Tuple[str, ...]]],
+    connection=default_connection,
+    batch_size: int = 1000,
+    replace: bool = True,
+) -> None:
+    """ Добавляет строки индекса (id, значения колонок); при replace=True старые строки тех же id удаляются.
+    """
+    if not supported(connection):
+        return
+    index = INDEXES[kind]
+    batch: List[Tuple[int, Tuple[str, ...]]] = []
+
+    def flush():
+        if replace:
+            remove(kind, [pk for pk, values in batch], connection)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.executemany(
+                    f"INSERT INTO {index.table} (rowid, {', '.join(index.columns)}) VALUES (%s{', %s' * len(index.columns)})",
+                    [(pk, *values) for pk, values in batch],
+                )
+            else:
+                cursor.executemany(
+                    f"INSERT INTO {index.table} (id, document) VALUES (%s, to_tsvector('simple', %s))",
+                    [(pk, ' '.join(values)) for pk, values in batch],
+                )
+        batch.clear()
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+
+def index_products(products, replace: bool = True) -> None:
+    write('product', product_rows(products), replace=replace)
+
+
+def index_counterparties(counterparties, replace: bool = True) -> None:
+    write('counterparty', counterparty_rows(counterparties), replace=replace)
+
+
+def rebuild() -> None:
+    with transaction.atomic():
+        with default_connection.cursor() as cursor:
+            for index in INDEXES.values():
+                cursor.execute(f"DELETE FROM {index.table}")
+        index_products(Product.objects.all(), replace=False)
+        index_counterparties(Counterparty.objects.all(), replace=False)
+
+
+def terms(kind: str, search_term: str) -> List[str]:
+    """ Слова запроса в нижнем регистре; номер телефона сводится к цифрам.
+    """
+    if kind == 'counterparty' and PHONE_RE.fullmatch(search_term.strip()):
+        digits = normalize_phone(search_term)
+        if digits:
+            return [digits]
+    return re.findall(r'\w+', search_term.lower())
+
+
+def _query(words: List[str], connection) -> str:
+    if connection.vendor == 'sqlite':
+        return ' '.join('"{}"*'.format(word.replace('"', '""')) for word in words)
+    return ' & '.join(f'{word}:*' for word in words)
+
+
+def match(kind: str, search_term: str, connection=default_connection) -> Optional[Tuple[str, list]]:
+    """ SQL и параметры выборки id, у которых каждое слово запроса совпадает с началом слова.
+    """
+    words = terms(kind, search_term)
+    if not words or not supported(connection):
+        return None
+    table = INDEXES[kind].table
+    query = _query(words, connection)
+    if connection.vendor == 'sqlite':
+        return f"SELECT rowid FROM {table} WHERE {table} MATCH %s", [query]
+    return f"SELECT id FROM {table} WHERE document @@ to_tsquery('simple', %s)", [query]
+
+
+def ranked_ids(kind: str, search_term: str, limit: int, window: int = RANK_WINDOW) -> List[int]:
+    """ До limit лучших совпадений. Ранжируются первые window найденных строк:
+    оценка всех совпадений частого слова ("товар") стоит сотни миллисекунд.
+    """
+    words = terms(kind, search_term)
+    if not words or not supported():
+        return []
+    table = INDEXES[kind].table
+    query = _query(words, default_connection)
+    if default_connection.vendor == 'sqlite':
+        sql = (
+            f"SELECT rowid FROM (SELECT rowid, bm25({table}) AS score FROM {table} WHERE {table} MATCH %s LIMIT %s) AS candidates "
+            f"ORDER BY score LIMIT %s"
+        )
+        params = [query, window, limit]
+    else:
+        sql = (
+            f"SELECT id FROM (SELECT id, document FROM {table} WHERE document @@ to_tsquery('simple', %s) LIMIT %s) AS candidates "
+            f"ORDER BY ts_rank(document, to_tsquery('simple', %s)) DESC LIMIT %s"
+        )
+        params = [query, window, query, limit]
+    with default_connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def matching(kind: str, search_term: str) -> Optional[RawSQL]:
+    """ Подзапрос для filter(pk__in=...) без ограничения количества.
+    """
+    found = match(kind, search_term)
+    if found is None:
+        return None
+    return RawSQL(*found)
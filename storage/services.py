@@ -0,0 +1,174 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Dict, Iterable, List
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+
+from . import cache, events
+from .models import Product, OperationGroup, Operation, Action, Stock, EventKind
+from .snapshots import apply_snapshot_deltas
+from .utils import apply_group_totals, apply_stock_deltas, set_group_totals
+
+
+class InsufficientStock(ValidationError):
+    """ Операции уводят остаток товаров в минус.
+
+    shortages - {product_id: (остаток, изменение)}.
+    """
+
+    def __init__(self, shortages: Dict[int, tuple]):
+        self.shortages = shortages
+        names = dict(Product.objects.filter(pk__in=shortages).values_list('pk', 'name'))
+        super().__init__([
+            f"Недостаточно товара «{names.get(product_id, product_id)}»: остаток {available}, нужно {-delta}"
+            for product_id, (available, delta) in sorted(shortages.items())
+        ])
+
+
+@dataclass
+class SaleLine:
+    product_id: int
+    quantity: int
+    price: Decimal
+    discount: Decimal = Decimal('0')
+
+
+def lock_and_check(deltas: Dict[int, int]) -> Dict[int, int]:
+    """ Блокирует строки остатков и проверяет, что ни один не уйдет в минус.
+
+    Должна вызываться внутри transaction.atomic(). Строки блокируются
+    одним запросом в порядке product_id, поэтому параллельные продажи
+    одних и тех же товаров не взаимоблокируются.
+    """
+    decreasing = sorted(product_id for product_id, delta in deltas.items() if delta < 0)
+    if not decreasing:
+        return {}
+    available = dict(
+        Stock.objects.select_for_update()
+        .filter(product_id__in=decreasing)
+        .order_by('product_id')
+        .values_list('product_id', 'quantity')
+    )
+    shortages = {
+        product_id: (available.get(product_id, 0), deltas[product_id])
+        for product_id in decreasing
+        if available.get(product_id, 0) + deltas[product_id] < 0
+    }
+    if shortages:
+        raise InsufficientStock(shortages)
+    return available
+
+
+def apply_sale(counterparty_id: int, lines: Iterable[SaleLine], user=None, comment: str = '') -> OperationGroup:
+    """ Проводит продажу целиком: проверка остатков, группа, операции и остатки в одной транзакции.
+
+    Вызывает InsufficientStock, если хотя бы одна строка уводит остаток в минус;
+    тогда ничего не сохраняется.
+    """
+    lines: List[SaleLine] = list(lines)
+    deltas: Dict[int, int] = defaultdict(int)
+    for line in lines:
+        if line.quantity <= 0:
+            raise ValidationError(f"Количество должно быть больше нуля: товар {line.product_id}")
+        deltas[line.product_id] -= line.quantity
+
+    with transaction.atomic():
+        lock_and_check(deltas)
+        group = OperationGroup(
+            counterparty_id=counterparty_id,
+            action=Action.SALE,
+            comment=comment,
+            created_by=user,
+            updated_by=user,
+        )
+        operations = [
+            Operation(
+                product_id=line.product_id,
+                quantity=line.quantity,
+                price=line.price,
+                discount=line.discount,
+                created_by=user,
+                updated_by=user,
+            )
+            for line in lines
+        ]
+        set_group_totals(group, operations)
+        group.save()
+        for operation in operations:
+            operation.operation_group = group
+        Operation.objects.bulk_create(operations)
+        events.write(events.operations_created(group, operations))
+        apply_stock_deltas(deltas)
+        cache.invalidate_operations(deltas, [counterparty_id])
+    return group
+
+
+def group_edit_deltas(group: OperationGroup, lines: Iterable[tuple]) -> Dict[int, int]:
+    """ Изменение остатков от сохранения группы с новыми строками (product_id, quantity).
+
+    Учитывает старые строки группы и смену действия.
+    """
+    deltas: Dict[int, int] = defaultdict(int)
+    sign = -1 if group.action == Action.SALE else 1
+    for product_id, quantity in lines:
+        deltas[product_id] += sign * quantity
+    if group.pk:
+        for product_id, signed in Operation.objects.filter(operation_group=group).values_list('product_id', 'signed_quantity'):
+            deltas[product_id] -= signed
+    return deltas
+
+
+def save_group_lines(group: OperationGroup, created: Iterable[Operation], changed: Iterable[Operation], user=None) -> None:
+    """ Сохраняет новые и измененные строки группы через bulk_create/bulk_update.
+
+    Сигналы при этом не срабатывают, поэтому остатки, итоги группы, снимки,
+    журнал операций и кеш поправляются здесь же. Остатки проверяет вызывающий (lock_and_check).
+    """
+    created, changed = list(created), list(changed)
+    if not created and not changed:
+        return
+    now = timezone.now()
+    stock: Dict[int, int] = defaultdict(int)
+    snapshots: Dict[tuple, int] = defaultdict(int)
+    logged = []
+    quantity, amount = 0, Decimal('0')
+    with transaction.atomic():
+        old = events.operation_states(Operation.objects.filter(pk__in=[operation.pk for operation in changed]))
+        for operation in changed:
+            before = old[operation.pk]
+            operation.calculate(group.action)
+            operation.updated_by = user
+            operation.updated_at = now
+            stock[before['product']] -= before['signed_quantity']
+            stock[operation.product_id] += operation.signed_quantity
+            snapshots[(before['product'], operation.created_at)] -= before['signed_quantity']
+            snapshots[(operation.product_id, operation.created_at)] += operation.signed_quantity
+            quantity += operation.quantity - before['quantity']
+            amount += operation.amount - before['amount']
+            logged.append(events.event(
+                EventKind.UPDATE, group.pk, operation.pk, before=before,
+                after=events.operation_state(operation, group.counterparty_id, group.action),
+            ))
+        for operation in created:
+            operation.operation_group = group
+            operation.created_by = user
+            operation.updated_by = user
+            operation.calculate(group.action)
+            stock[operation.product_id] += operation.signed_quantity
+            quantity += operation.quantity
+            amount += operation.amount
+        Operation.objects.bulk_update(
+            changed,
+            ['product', 'quantity', 'price', 'discount', 'amount', 'signed_quantity', 'updated_by', 'updated_at'],
+            batch_size=500,
+        )
+        Operation.objects.bulk_create(created, batch_size=500)
+        events.write(logged + events.operations_created(group, created))
+        apply_stock_deltas(stock)
+        apply_group_totals({group.pk: (quantity, amount, len(created))})
+        # новые операции позже всех снимков, правятся только измененные
+        apply_snapshot_deltas((product_id, created_at, delta) for (product_id, created_at), delta in snapshots.items())
+        cache.invalidate_operations(stock, [group.counterparty_id])
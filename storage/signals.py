@@ -0,0 +1,256 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import cache, events, search, stockindex
+from .images import schedule_renditions
+from .rollups import schedule_rollups
+from .models import Category, Product, Counterparty, OperationGroup, Operation, Stock, EventKind, normalize_phone
+from .snapshots import apply_snapshot_deltas
+from .utils import apply_group_totals, apply_stock_deltas, group_stock_deltas, signed_quantity
+
+
+@receiver(post_save, sender=Product)
+def create_product_stock(sender, instance, created, **kwargs):
+    if created:
+        Stock.objects.get_or_create(product=instance)
+
+
+def group_values(instance: Operation):
+    """ (контрагент, действие) группы операции; без запроса, если группа уже загружена.
+    """
+    if Operation.operation_group.is_cached(instance):
+        return instance.operation_group.counterparty_id, instance.operation_group.action
+    if not hasattr(instance, '_group_values'):
+        instance._group_values = (
+            OperationGroup.objects.filter(pk=instance.operation_group_id).values_list('counterparty_id', 'action').first()
+        )
+    return instance._group_values
+
+
+@receiver(pre_save, sender=Operation)
+def calculate_operation(sender, instance, **kwargs):
+    # и при raw-сохранении loaddata: фикстуры не содержат сумм и количества со знаком
+    instance.calculate()
+
+
+@receiver(pre_save, sender=Operation)
+def remember_operation(sender, instance, **kwargs):
+    instance._ledger_old = None
+    if instance.pk:
+        instance._ledger_old = events.operation_states(Operation.objects.filter(pk=instance.pk)).get(instance.pk)
+
+
+@receiver(post_save, sender=Operation)
+def update_stock_on_operation_save(sender, instance, **kwargs):
+    deltas = defaultdict(int)
+    totals = defaultdict(lambda: [0, Decimal('0'), 0])
+    old = getattr(instance, '_ledger_old', None)
+    if old:
+        deltas[old['product']] -= old['signed_quantity']
+        group_totals = totals[old['group']]
+        group_totals[0] -= old['quantity']
+        group_totals[1] -= old['amount']
+        group_totals[2] -= 1
+    deltas[instance.product_id] += instance.signed_quantity
+    group_totals = totals[instance.operation_group_id]
+    group_totals[0] += instance.quantity
+    group_totals[1] += instance.amount
+    group_totals[2] += 1
+    apply_stock_deltas(deltas)
+    apply_group_totals(totals)
+    if old:
+        # новые операции позже всех снимков, править нужно только при изменении
+        apply_snapshot_deltas((product_id, instance.created_at, delta) for product_id, delta in deltas.items())
+
+
+@receiver(post_delete, sender=Operation)
+def update_stock_on_operation_delete(sender, instance, **kwargs):
+    group = group_values(instance)
+    if group is None:
+        return
+    action = group[1]
+    # строка остатка удаляется вместе с товаром, создавать ее не нужно
+    apply_stock_deltas({instance.product_id: -signed_quantity(action, instance.quantity)}, create=False)
+    apply_group_totals({instance.operation_group_id: (-instance.quantity, -instance.amount, -1)})
+    apply_snapshot_deltas([(instance.product_id, instance.created_at, -signed_quantity(action, instance.quantity))])
+
+
+@receiver(pre_save, sender=OperationGroup)
+def remember_operation_group(sender, instance, **kwargs):
+    instance._ledger_old_action = None
+    instance._ledger_old_counterparty_id = None
+    instance._event_before = None
+    if instance.pk:
+        old = OperationGroup.objects.filter(pk=instance.pk).values_list('action', 'counterparty_id', 'comment').first()
+        if old:
+            instance._ledger_old_action, instance._ledger_old_counterparty_id, comment = old
+            instance._event_before = {'counterparty': old[1], 'action': old[0], 'comment': comment}
+
+
+@receiver(post_save, sender=OperationGroup)
+def update_stock_on_action_change(sender, instance, **kwargs):
+    old_action = getattr(instance, '_ledger_old_action', None)
+    if old_action is None or old_action == instance.action:
+        return
+    factor = signed_quantity(instance.action, 1) - signed_quantity(old_action, 1)
+    apply_stock_deltas(group_stock_deltas(instance.pk, factor))
+    # updated_at тоже: действие входит в историю операций (API), ее ETag должен измениться
+    instance.operation_set.update(signed_quantity=F('quantity') * signed_quantity(instance.action, 1), updated_at=timezone.now())
+    apply_snapshot_deltas(
+        (product_id, created_at, quantity * factor)
+        for product_id, created_at, quantity in instance.operation_set.values_list('product_id', 'created_at', 'quantity')
+    )
+
+
+@receiver(post_save, sender=Operation)
+def log_operation_save(sender, instance, **kwargs):
+    counterparty_id, action = group_values(instance)
+    old = getattr(instance, '_ledger_old', None)
+    events.write([events.event(
+        EventKind.UPDATE if old else EventKind.CREATE,
+        instance.operation_group_id,
+        instance.pk,
+        before=old,
+        after=events.operation_state(instance, counterparty_id, action),
+    )])
+
+
+@receiver(post_delete, sender=Operation)
+def log_operation_delete(sender, instance, **kwargs):
+    group = group_values(instance)
+    if group is None:
+        return
+    events.write([events.event(
+        EventKind.DELETE, instance.operation_group_id, instance.pk, before=events.operation_state(instance, *group),
+    )])
+
+
+@receiver(post_save, sender=OperationGroup)
+def log_operation_group_save(sender, instance, **kwargs):
+    before = getattr(instance, '_event_before', None)
+    logged = [events.event(
+        EventKind.UPDATE if before else EventKind.CREATE, instance.pk, before=before, after=events.group_state(instance),
+    )]
+    if before and (before['counterparty'], before['action']) != (instance.counterparty_id, instance.action):
+        # контрагент и действие входят в состояние операций: каждая операция группы изменилась
+        for pk, state in events.operation_states(instance.operation_set.all()).items():
+            old_state = dict(
+                state,
+                counterparty=before['counterparty'],
+                action=before['action'],
+                signed_quantity=signed_quantity(before['action'], state['quantity']),
+            )
+            logged.append(events.event(EventKind.UPDATE, instance.pk, pk, before=old_state, after=state))
+    events.write(logged)
+
+
+@receiver(post_delete, sender=OperationGroup)
+def log_operation_group_delete(sender, instance, **kwargs):
+    # удаленные вместе с группой операции записали свои события
+    events.write([events.event(EventKind.DELETE, instance.pk, before=events.group_state(instance))])
+
+
+@receiver(post_save, sender=Operation)
+@receiver(post_delete, sender=Operation)
+@receiver(post_save, sender=OperationGroup)
+@receiver(post_delete, sender=OperationGroup)
+def schedule_rollups_on_change(sender, raw=False, **kwargs):
+    # отчеты дочитают журнал фоновой задачей после задержки STORAGE_ROLLUP_LAG
+    if not raw:
+        schedule_rollups()
+
+
+@receiver(pre_save, sender=Product)
+def remember_product(sender, instance, **kwargs):
+    instance._cache_old_category_id = None
+    old_image = None
+    if instance.pk:
+        old = Product.objects.filter(pk=instance.pk).values_list('category_id', 'image').first()
+        if old:
+            instance._cache_old_category_id, old_image = old
+    image_changed = (instance.image.name or '') != (old_image or '')
+    instance._image_changed = image_changed and bool(instance.image)
+    if image_changed:
+        # старые уменьшенные копии больше не подходят
+        instance.image_hash = ''
+
+
+@receiver(post_save, sender=Product)
+def schedule_product_renditions(sender, instance, raw=False, **kwargs):
+    if not raw and getattr(instance, '_image_changed', False):
+        schedule_renditions(instance.pk, instance.image.name)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_cache(sender, instance, **kwargs):
+    cache.invalidate_on_commit('category', instance.category_id, getattr(instance, '_cache_old_category_id', None))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_product_stock_index(sender, instance, **kwargs):
+    # новый товар получает строку Stock, у удаленного она пропадает
+    stockindex.refresh_on_commit([instance.pk])
+
+
+@receiver(post_save, sender=Operation)
+@receiver(post_delete, sender=Operation)
+def invalidate_operation_cache(sender, instance, **kwargs):
+    old = getattr(instance, '_ledger_old', None)
+    group = group_values(instance)
+    cache.invalidate_operations([instance.product_id] + ([old['product']] if old else []), [group[0]] if group else [])
+
+
+@receiver(post_save, sender=OperationGroup)
+@receiver(post_delete, sender=OperationGroup)
+def invalidate_operation_group_cache(sender, instance, **kwargs):
+    cache.invalidate_on_commit('counterparty', instance.counterparty_id, getattr(instance, '_ledger_old_counterparty_id', None))
+    old_action = getattr(instance, '_ledger_old_action', None)
+    if old_action is not None and old_action != instance.action:
+        cache.invalidate_operations(instance.operation_set.values_list('product_id', flat=True), [])
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products(Product.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    search.remove('product', [instance.pk])
+
+
+@receiver(pre_save, sender=Category)
+def remember_category_name(sender, instance, **kwargs):
+    instance._search_old_name = None
+    if instance.pk:
+        instance._search_old_name = Category.objects.filter(pk=instance.pk).values_list('name', flat=True).first()
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, **kwargs):
+    # название категории входит в поисковую строку товара
+    if not created and instance._search_old_name != instance.name:
+        search.index_products(Product.objects.filter(category=instance))
+
+
+@receiver(pre_save, sender=Counterparty)
+def normalize_counterparty_phone(sender, instance, **kwargs):
+    # и при raw-сохранении loaddata, по phone_digits ищут поиск и импорт
+    instance.phone_digits = normalize_phone(instance.phone)
+
+
+@receiver(post_save, sender=Counterparty)
+def index_counterparty(sender, instance, **kwargs):
+    search.index_counterparties(Counterparty.objects.filter(pk=instance.pk))
+
+
+@receiver(post_delete, sender=Counterparty)
+def unindex_counterparty(sender, instance, **kwargs):
+    search.remove('counterparty', [instance.pk])
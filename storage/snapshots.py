@@ -0,0 +1,127 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from django.db import transaction
+from django.db.models import F, Max, Min, QuerySet
+from django.utils import timezone
+
+from .models import Product, Operation, Stock, StockSnapshot, ArchivedOperation
+from .utils import remaining_expression
+
+
+# товаров в одном IN (...): в SQLite число параметров запроса ограничено
+CHUNK_SIZE = 500
+
+
+def _chunks(product_ids: Optional[Iterable[int]]) -> Iterator[Optional[List[int]]]:
+    """ Списки id товаров по CHUNK_SIZE; None - все товары, одним запросом.
+    """
+    if product_ids is None:
+        yield None
+        return
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), CHUNK_SIZE):
+        yield product_ids[start:start + CHUNK_SIZE]
+
+
+def window_deltas(start: Optional[datetime], end: Optional[datetime], product_ids: Optional[Iterable[int]] = None) -> Dict[int, int]:
+    """ Изменение остатков по операциям с created_at в интервале (start, end],
+    рабочим и перенесенным в архив.
+    """
+    deltas: Dict[int, int] = defaultdict(int)
+    product_ids = None if product_ids is None else list(product_ids)
+    for model in (Operation, ArchivedOperation):
+        operations = model.objects.order_by()
+        if start is not None:
+            operations = operations.filter(created_at__gt=start)
+        if end is not None:
+            operations = operations.filter(created_at__lte=end)
+        for chunk in _chunks(product_ids):
+            rows = operations if chunk is None else operations.filter(product_id__in=chunk)
+            for row in rows.values('product_id').annotate(delta=remaining_expression(prefix='')):
+                deltas[row['product_id']] += row['delta']
+    return dict(deltas)
+
+
+def _quantities(queryset, product_ids: Optional[Iterable[int]]) -> Dict[int, int]:
+    quantities = {}
+    for chunk in _chunks(product_ids):
+        rows = queryset if chunk is None else queryset.filter(product_id__in=chunk)
+        quantities.update(rows.values_list('product_id', 'quantity'))
+    return quantities
+
+
+def _snapshot_quantities(taken_at: datetime, product_ids: Optional[Iterable[int]]) -> Dict[int, int]:
+    return _quantities(StockSnapshot.objects.filter(taken_at=taken_at), product_ids)
+
+
+def _current_quantities(product_ids: Optional[Iterable[int]]) -> Dict[int, int]:
+    return _quantities(Stock.objects.all(), product_ids)
+
+
+def _stock_as_of_ids(product_ids: Optional[list], timestamp: datetime) -> Dict[int, int]:
+    before = StockSnapshot.objects.filter(taken_at__lte=timestamp).aggregate(taken_at=Max('taken_at'))['taken_at']
+    if before is not None:
+        base = _snapshot_quantities(before, product_ids)
+        deltas = window_deltas(before, timestamp, product_ids)
+        sign = 1
+    else:
+        after = StockSnapshot.objects.filter(taken_at__gt=timestamp).aggregate(taken_at=Min('taken_at'))['taken_at']
+        base = _snapshot_quantities(after, product_ids) if after is not None else _current_quantities(product_ids)
+        deltas = window_deltas(timestamp, after, product_ids)
+        sign = -1
+
+    result = defaultdict(int)
+    for product_id, quantity in base.items():
+        result[product_id] += quantity
+    for product_id, delta in deltas.items():
+        result[product_id] += sign * delta
+    if product_ids is not None:
+        return {product_id: result.get(product_id, 0) for product_id in product_ids}
+    return dict(result)
+
+
+def stock_as_of(product_or_queryset: Union[Product, QuerySet, None], timestamp: datetime) -> Union[int, Dict[int, int]]:
+    """ Остаток на момент timestamp.
+
+    Берется ближайший снимок до timestamp (или после, если раньше снимков
+    нет) и к нему добавляются операции между снимком и timestamp, поэтому
+    читается только окно операций, а не вся история. Для товара
+    возвращает число, для queryset или None - словарь {product_id: остаток}.
+    """
+    if isinstance(product_or_queryset, Product):
+        return _stock_as_of_ids([product_or_queryset.pk], timestamp)[product_or_queryset.pk]
+    if product_or_queryset is None:
+        return _stock_as_of_ids(None, timestamp)
+    return _stock_as_of_ids(list(product_or_queryset.values_list('pk', flat=True)), timestamp)
+
+
+def take_snapshot(taken_at: Optional[datetime] = None) -> int:
+    """ Записывает снимок остатков всех товаров на момент taken_at.
+    """
+    taken_at = taken_at or timezone.now()
+    with transaction.atomic():
+        quantities = stock_as_of(None, taken_at)
+        StockSnapshot.objects.filter(taken_at=taken_at).delete()
+        StockSnapshot.objects.bulk_create(
+            [StockSnapshot(product_id=product_id, taken_at=taken_at, quantity=quantity) for product_id, quantity in quantities.items()],
+            batch_size=1000,
+        )
+    return len(quantities)
+
+
+def apply_snapshot_deltas(entries: Iterable[Tuple[int, datetime, int]]) -> None:
+    """ Поправляет снимки после изменения старой операции.
+
+    entries - (product_id, created_at операции, delta): delta добавляется
+    ко всем снимкам товара, сделанным после created_at.
+    """
+    entries = [entry for entry in entries if entry[2]]
+    if not entries:
+        return
+    earliest = min(created_at for product_id, created_at, delta in entries)
+    if not StockSnapshot.objects.filter(taken_at__gte=earliest).exists():
+        return
+    for product_id, created_at, delta in entries:
+        StockSnapshot.objects.filter(product_id=product_id, taken_at__gte=created_at).update(quantity=F('quantity') + delta)
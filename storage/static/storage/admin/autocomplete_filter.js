@@ -0,0 +1,18 @@
+'use strict';
+{
+    const $ = django.jQuery;
+
+    // выбор в фильтре с автодополнением открывает список с этим значением, с первой страницы
+    $(document).on('change', '.autocomplete-filter', function() {
+        const params = new URLSearchParams(window.location.search);
+        for (const name of ['p', 'after', 'before', 'e']) {
+            params.delete(name);
+        }
+        if (this.value) {
+            params.set(this.dataset.filterParameter, this.value);
+        } else {
+            params.delete(this.dataset.filterParameter);
+        }
+        window.location.search = params.toString();
+    });
+}
@@ -0,0 +1,281 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Stock
+
+
+logger = logging.getLogger('storage.stockindex')
+
+# Общий индекс остатков: файл STORAGE_STOCK_INDEX, отображенный в память всех
+# процессов (gunicorn, run_workers) одного сервера. На товар - три int64 по его id:
+# количество, версия строки Stock (0 - данных нет) и время ее изменения в микросекундах.
+# Чтение идет без блокировок и без базы; запись - под блокировкой файла, после
+# фиксации транзакции и только если версия не меньше записанной. Раз в
+# STORAGE_STOCK_INDEX_RECONCILE секунд индекс сверяется с таблицей Stock целиком.
+# Без настройки индекс выключен и остатки читаются из базы.
+
+MAGIC = b'STOCKIX2'
+# файлы прежнего формата (версии вместо времени не было) заполняются заново
+OLD_MAGICS = (b'STOCKIX1', )
+# магия, емкость (товаров), заполнен ли, время последней сверки
+HEADER = struct.Struct('<8sqqd')
+HEADER_SIZE = 64
+SLOT = 3
+MIN_CAPACITY = 1024
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+MICROSECOND = timedelta(microseconds=1)
+
+# (количество, версия, время изменения)
+Entry = Tuple[int, int, int]
+
+
+def _stamp(value: datetime) -> int:
+    return (value - EPOCH) // MICROSECOND
+
+
+def stamp_datetime(stamp: int) -> datetime:
+    """ Время изменения остатка из индекса, совпадает с Stock.updated_at.
+    """
+    return EPOCH + stamp * MICROSECOND
+
+
+class StockIndex:
+    """ Отображенный в память файл индекса. Объект принадлежит одному процессу.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = os.getpid()
+        self.thread_lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.mm = None
+        self.slots = None
+        self.capacity = 0
+        with self.locked():
+            if os.fstat(self.fd).st_size < HEADER_SIZE or os.pread(self.fd, len(MAGIC), 0) in OLD_MAGICS:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, HEADER_SIZE + MIN_CAPACITY * SLOT * 8)
+                self._map()
+                HEADER.pack_into(self.mm, 0, MAGIC, MIN_CAPACITY, 0, 0.0)
+        self._map()
+
+    def _map(self) -> None:
+        # старое отображение закроется, когда его перестанут читать другие потоки
+        self.mm = mmap.mmap(self.fd, os.fstat(self.fd).st_size)
+        if self.mm[:len(MAGIC)] not in (MAGIC, bytes(len(MAGIC))):
+            raise ValueError(f"{self.path}: не файл индекса остатков")
+        self.capacity = (len(self.mm) - HEADER_SIZE) // (SLOT * 8)
+        self.slots = memoryview(self.mm)[HEADER_SIZE:].cast('q')
+
+    def header(self) -> Tuple[int, bool, float]:
+        magic, capacity, warmed, reconciled_at = HEADER.unpack_from(self.mm, 0)
+        return capacity, bool(warmed), reconciled_at
+
+    def _set_header(self, warmed: bool, reconciled_at: float) -> None:
+        HEADER.pack_into(self.mm, 0, MAGIC, self.capacity, int(warmed), reconciled_at)
+
+    @contextmanager
+    def locked(self, blocking: bool = True):
+        """ Блокировка записи: потоки процесса и другие процессы.
+        """
+        if not self.thread_lock.acquire(blocking):
+            yield False
+            return
+        try:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        finally:
+            self.thread_lock.release()
+
+    def _follow(self) -> None:
+        # другой процесс увеличил файл
+        if self.header()[0] > self.capacity:
+            self._map()
+
+    def _grow(self, product_id: int) -> None:
+        self._follow()
+        if product_id < self.capacity:
+            return
+        _, warmed, reconciled_at = self.header()
+        capacity = max(product_id + 1, self.capacity * 2, MIN_CAPACITY)
+        os.ftruncate(self.fd, HEADER_SIZE + capacity * SLOT * 8)
+        HEADER.pack_into(self.mm, 0, MAGIC, capacity, int(warmed), reconciled_at)
+        self._map()
+
+    def lookup(self, product_ids: Iterable[int]) -> Dict[int, Entry]:
+        """ {product_id: (количество, версия, время изменения)} для товаров, которые есть в индексе.
+        """
+        self._follow()
+        slots, capacity = self.slots, self.capacity
+        found = {}
+        for product_id in product_ids:
+            if 0 <= product_id < capacity:
+                offset = product_id * SLOT
+                version = slots[offset + 1]
+                if version:
+                    found[product_id] = (slots[offset], version, slots[offset + 2])
+        return found
+
+    def _write(self, product_id: int, quantity: int, version: int, stamp: int) -> None:
+        # версия пишется последней: читатель без блокировки не увидит ее раньше количества
+        offset = product_id * SLOT
+        self.slots[offset] = quantity
+        self.slots[offset + 2] = stamp
+        self.slots[offset + 1] = version
+
+    def store(self, rows: Iterable[Tuple[int, int, int, int]], missing: Iterable[int] = ()) -> None:
+        """ Записывает (product_id, количество, версия, время изменения), если версия
+        не меньше сохраненной; у товаров missing (строки Stock нет) данные стираются.
+
+        Время изменения у параллельных транзакций может совпасть или идти не по порядку
+        фиксации, версия строки Stock растет с каждым изменением под блокировкой строки.
+        """
+        rows = list(rows)
+        missing = list(missing)
+        with self.locked():
+            self._grow(max([row[0] for row in rows] + missing, default=0))
+            slots = self.slots
+            for product_id, quantity, version, stamp in rows:
+                if version >= slots[product_id * SLOT + 1]:
+                    self._write(product_id, quantity, version, stamp)
+            for product_id in missing:
+                self._write(product_id, 0, 0, 0)
+
+    def reconcile(self, blocking: bool = True) -> Optional[int]:
+        """ Сверяет индекс с таблицей Stock. Возвращает количество товаров
+        или None, если индекс сейчас сверяет другой процесс.
+        """
+        with self.locked(blocking) as acquired:
+            if not acquired:
+                return None
+            started = time.time()
+            # чтение под блокировкой: записи, ждущие ее, сравнят версии с прочитанным здесь,
+            # поэтому таблица переписывается целиком, без сравнения (и после восстановления базы)
+            rows = list(
+                Stock.objects.order_by().values_list('product_id', 'quantity', 'version', 'updated_at').iterator(chunk_size=10000)
+            )
+            self._grow(max((row[0] for row in rows), default=0))
+            slots = self.slots
+            present = bytearray(self.capacity)
+            for product_id, quantity, version, updated_at in rows:
+                present[product_id] = 1
+                self._write(product_id, quantity, version, _stamp(updated_at))
+            # удаленные товары
+            for product_id in range(self.capacity):
+                if not present[product_id] and slots[product_id * SLOT + 1]:
+                    self._write(product_id, 0, 0, 0)
+            self._set_header(True, started)
+        logger.info("Индекс остатков сверен: товаров %s за %.3f с", len(rows), time.time() - started)
+        return len(rows)
+
+    def due(self) -> bool:
+        capacity, warmed, reconciled_at = self.header()
+        return not warmed or time.time() - reconciled_at > getattr(settings, 'STORAGE_STOCK_INDEX_RECONCILE', 300)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+_index: Optional[StockIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> Optional[StockIndex]:
+    """ Индекс этого процесса или None, если STORAGE_STOCK_INDEX не задан.
+    После fork файл открывается заново: блокировки не должны быть общими с родителем.
+    """
+    global _index
+    path = getattr(settings, 'STORAGE_STOCK_INDEX', None)
+    if not path:
+        return None
+    index = _index
+    if index is None or index.pid != os.getpid() or index.path != path:
+        with _index_lock:
+            if _index is None or _index.pid != os.getpid() or _index.path != path:
+                if _index is not None and _index.pid == os.getpid():
+                    _index.close()
+                _index = StockIndex(path)
+            index = _index
+    return index
+
+
+def lookup(product_ids: Iterable[int]) -> Dict[int, Entry]:
+    """ Остатки из индекса, {product_id: (количество, версия, время изменения)}. Без базы:
+    товары, которых нет в ответе, читаются из Stock. Выключенный индекс дает {}.
+    """
+    index = get_index()
+    return index.lookup(product_ids) if index else {}
+
+
+def due() -> bool:
+    index = get_index()
+    return index is not None and index.due()
+
+
+def reconcile_if_due() -> None:
+    """ Сверка, если индекс пуст или давно не сверялся. Если сверяет другой процесс - не ждет.
+
+    Внутри транзакции сверка откладывается до фиксации: иначе она прочитает
+    незафиксированные строки Stock, и после отката они останутся в индексе.
+    """
+    index = get_index()
+    if index is None or not index.due():
+        return
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: index.reconcile(blocking=False))
+    else:
+        index.reconcile(blocking=False)
+
+
+def refresh(product_ids: Iterable[int]) -> None:
+    """ Перечитывает из Stock остатки товаров и записывает их в индекс.
+    """
+    index = get_index()
+    if index is None:
+        return
+    product_ids = set(product_ids)
+    rows = [
+        (product_id, quantity, version, _stamp(updated_at))
+        for product_id, quantity, version, updated_at in (
+            Stock.objects.filter(product_id__in=product_ids).values_list('product_id', 'quantity', 'version', 'updated_at')
+        )
+    ]
+    index.store(rows, missing=product_ids - {row[0] for row in rows})
+
+
+def refresh_on_commit(product_ids: Iterable[int]) -> None:
+    """ Обновляет индекс после фиксации транзакции, чтобы не записать незафиксированные остатки.
+    """
+    if not getattr(settings, 'STORAGE_STOCK_INDEX', None):
+        return
+    product_ids = [product_id for product_id in product_ids if product_id is not None]
+    if product_ids:
+        transaction.on_commit(lambda: _refresh_safely(product_ids))
+
+
+def _refresh_safely(product_ids) -> None:
+    # ошибка индекса не должна ломать запрос после фиксации, сверка исправит остаток
+    try:
+        refresh(product_ids)
+    except Exception:
+        logger.exception("Не удалось обновить индекс остатков")
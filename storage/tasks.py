@@ -0,0 +1,112 @@
+from datetime import datetime, time
+
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from . import events, search
+from .archive import archive_operations
+from .exports import save_export
+from .images import generate_renditions
+from .importer import ImportRowError, import_operations
+from .jobs import FatalJobError, prune_jobs, task
+from .models import Product, OperationGroup, Operation
+from .rollups import build_rollups
+from .utils import rebuild_stock, rebuild_totals
+
+
+# Фоновые задачи: func(progress, **payload), результат сохраняется в Job.result.
+
+
+@task('rebuild_stock', "Сверка и исправление остатков", admin=True)
+def rebuild_stock_task(progress):
+    return {'mismatches': len(rebuild_stock(fix=True))}
+
+
+@task('check_totals', "Сверка сумм операций и итогов групп", admin=True)
+def check_totals_task(progress):
+    operations, groups = rebuild_totals(fix=True)
+    return {'operations': len(operations), 'groups': len(groups)}
+
+
+@task('build_rollups', "Обновление отчетов", admin=True)
+def build_rollups_task(progress, chunk_size=5000):
+    total = events.pending('rollups') if events.position('rollups') is not None else Operation.objects.count()
+    return {'processed': build_rollups(chunk_size=chunk_size, progress=lambda processed: progress(processed, total))}
+
+
+@task('prune_events', "Очистка прочитанного журнала операций", admin=True)
+def prune_events_task(progress):
+    return {'deleted': events.prune()}
+
+
+@task('prune_jobs', "Очистка завершенных фоновых задач", admin=True)
+def prune_jobs_task(progress):
+    return {'deleted': prune_jobs()}
+
+
+@task('archive_operations', "Перенос старых операций в архив")
+def archive_operations_task(progress, before, chunk_size=500):
+    """ before - день YYYY-MM-DD, переносятся группы, созданные до его начала.
+    """
+    try:
+        day = datetime.strptime(before, '%Y-%m-%d').date()
+    except ValueError as exc:
+        raise FatalJobError(f"Неверная дата: {before}") from exc
+    stats = archive_operations(
+        timezone.make_aware(datetime.combine(day, time.min)),
+        chunk_size=chunk_size,
+        progress=lambda stats: progress(stats.groups, message=f"операций: {stats.operations}"),
+    )
+    return {'groups': stats.groups, 'operations': stats.operations, 'seconds': round(stats.seconds, 1)}
+
+
+@task('rebuild_search_index', "Перестроение поискового индекса", admin=True)
+def rebuild_search_index_task(progress):
+    search.rebuild()
+
+
+@task('generate_renditions', "Уменьшенные копии изображения товара")
+def generate_renditions_task(progress, product_id, force=False):
+    return {'image_hash': generate_renditions(product_id, force=force)}
+
+
+@task('import_operations', "Импорт операций из файла")
+def import_operations_task(progress, path, fmt=None, chunk_size=5000, source=None, user_id=None):
+    user = get_user_model().objects.filter(pk=user_id).first() if user_id else None
+    try:
+        stats = import_operations(
+            path,
+            fmt=fmt,
+            chunk_size=chunk_size,
+            source=source,
+            user=user,
+            progress=lambda stats: progress(stats.rows, message=f"групп: {stats.groups}"),
+        )
+    except ImportRowError as exc:
+        # ошибка в данных, повтор упадет на той же строке
+        raise FatalJobError(str(exc)) from exc
+    return {'rows': stats.rows, 'groups': stats.groups, 'skipped': stats.skipped, 'seconds': round(stats.seconds, 1)}
+
+
+EXPORT_QUERYSETS = {
+    'operations': lambda ids: Operation.objects.filter(operation_group__in=ids),
+    'groups': lambda ids: OperationGroup.objects.filter(pk__in=ids),
+    'stock': lambda ids: Product.objects.filter(pk__in=ids),
+}
+
+
+@task('export', "Выгрузка в файл")
+def export_task(progress, kind, fmt='csv', ids=None):
+    """ ids - выбранные группы для operations и groups, товары для stock; без ids выгружается все.
+    """
+    if kind not in EXPORT_QUERYSETS:
+        raise FatalJobError(f"Неизвестная выгрузка: {kind}")
+    queryset = EXPORT_QUERYSETS[kind](ids) if ids is not None else None
+    name, rows = save_export(kind, fmt, queryset, progress=progress)
+    return {'file': name, 'rows': rows, 'size': default_storage.size(name)}
+
+
+@task('noop', "Пустая задача для замеров очереди")
+def noop_task(progress):
+    return None
@@ -1,3 +1,1127 @@
-from django.test import TestCase
+import csv
+import hashlib
+import json
+import os
+import tempfile
+from io import BytesIO, StringIO
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import F, ProtectedError
+from django.http import StreamingHttpResponse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import events, images, jobs, search, snapshots, stockindex
+from .admin import OperationGroupAdmin
+from .archive import archive_operations
+from .cache import cache_keys, counterparty_turnover, get_or_compute_many
+from .importer import ImportRowError, fingerprint, import_operations
+from .models import (
+    Category, Product, Counterparty, OperationGroup, Operation, Action, Stock, Job, JobStatus, EventKind, OperationEvent, DailyRollup, DailyCounterpartyRollup,
+    OpeningBalance, ArchivedOperationGroup, ImportCheckpoint, Watermark,
+)
+from .rollups import build_rollups, reset_rollups
+from .routers import ReplicaRouter, replica_alias, replica_reads
+from .services import InsufficientStock, SaleLine, apply_sale, group_edit_deltas, lock_and_check
+from .snapshots import stock_as_of, take_snapshot
+from .utils import get_remaining_product, rebuild_stock, rebuild_totals, remaining_expression
+
+
+class HotPathIndexTests(TestCase):
+    """ Регрессия планов запросов: горячие запросы должны идти по индексам.
+    """
+
+    def assertUsesIndex(self, queryset, index_name):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # на маленьких тестовых таблицах планировщик иначе выберет seq scan
+                cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        self.assertIn(index_name, plan, msg=f"\n{queryset.query}\n{plan}")
+
+    def test_product_stock_uses_product_signed_index(self):
+        queryset = Operation.objects.filter(product_id=1).order_by().values('product_id').annotate(
+            remaining=remaining_expression(prefix=''),
+        )
+        self.assertUsesIndex(queryset, 'operation_product_signed_idx')
+
+    def test_operation_window_uses_created_index(self):
+        now = timezone.now()
+        queryset = Operation.objects.filter(created_at__gt=now - timedelta(days=1), created_at__lte=now).order_by().values('product_id').annotate(
+            remaining=remaining_expression(prefix=''),
+        )
+        self.assertUsesIndex(queryset, 'operation_created_product_idx')
+
+    def test_report_by_action_uses_action_created_index(self):
+        queryset = OperationGroup.objects.filter(action=Action.SALE, created_at__gte=timezone.now() - timedelta(days=30))
+        self.assertUsesIndex(queryset, 'opgroup_action_created_idx')
+
+    def test_counterparty_filter_uses_counterparty_index(self):
+        self.assertUsesIndex(OperationGroup.objects.filter(counterparty_id=1), 'opgroup_counterparty_idx')
+
+    def test_counterparty_phone_lookup_uses_index(self):
+        self.assertUsesIndex(Counterparty.objects.filter(phone='+992900000000'), 'counterparty_phone_idx')
+
+
+REPLICA_DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+    'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+}
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    """ Маршрутизация чтений: реплика только внутри replica_reads().
+    """
+
+    router = ReplicaRouter()
+
+    def test_reads_go_to_default_outside_context(self):
+        with override_settings(DATABASES=REPLICA_DATABASES):
+            self.assertIsNone(self.router.db_for_read(Product))
+
+    def test_reads_go_to_replica_inside_context(self):
+        with override_settings(DATABASES=REPLICA_DATABASES), replica_reads():
+            self.assertEqual(self.router.db_for_read(Product), 'replica')
+            self.assertEqual(replica_alias(), 'replica')
+
+    def test_writes_always_go_to_default(self):
+        with override_settings(DATABASES=REPLICA_DATABASES), replica_reads():
+            self.assertEqual(self.router.db_for_write(Product), 'default')
+        self.assertFalse(self.router.allow_migrate('replica', 'storage'))
+
+    def test_without_replica_everything_stays_on_default(self):
+        with override_settings(DATABASES={'default': REPLICA_DATABASES['default']}), replica_reads():
+            self.assertIsNone(self.router.db_for_read(Product))
+            self.assertEqual(replica_alias(), 'default')
+
+
+class ConcurrentSqliteBackendTests(SimpleTestCase):
+    """ storage.backends.sqlite3: WAL, busy_timeout и BEGIN IMMEDIATE.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = dict(connection.settings_dict, ENGINE='storage.backends.sqlite3', NAME=os.path.join(directory.name, 'db.sqlite3'))
+        patcher = mock.patch.dict(connections.settings, {'concurrent': settings_dict})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = connections['concurrent']
+        self.addCleanup(connections.__delitem__, 'concurrent')
+        self.addCleanup(self.connection.close)
+
+    def pragma(self, name):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        self.assertEqual(self.pragma('busy_timeout'), 20000)
+
+    def test_atomic_begins_immediate(self):
+        statements = []
+
+        def capture(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        with self.connection.execute_wrapper(capture):
+            with transaction.atomic(using='concurrent'):
+                self.pragma('user_version')
+        self.assertEqual(statements[0], 'BEGIN IMMEDIATE')
+
+
+class SearchIndexTests(TestCase):
+    """ Поисковые таблицы следуют за изменениями товаров, категорий и контрагентов.
+    """
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Напитки')
+        self.product = Product.objects.create(name='Чай зеленый', category=self.category)
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван', phone='+992 (90) 123-45-67', company_name='Восток')
+
+    def test_prefix_match_on_name_and_category(self):
+        self.assertEqual(search.ranked_ids('product', 'чай зел', 10), [self.product.pk])
+        self.assertEqual(search.ranked_ids('product', 'напит', 10), [self.product.pk])
+        self.assertEqual(search.ranked_ids('product', 'кофе', 10), [])
+
+    def test_index_follows_changes(self):
+        self.category.name = 'Чайная'
+        self.category.save()
+        self.assertEqual(search.ranked_ids('product', 'чайная', 10), [self.product.pk])
+        self.product.delete()
+        self.assertEqual(search.ranked_ids('product', 'чай', 10), [])
+
+    def test_phone_matches_digits_in_any_format(self):
+        self.assertEqual(self.counterparty.phone_digits, '992901234567')
+        for term in ('992901234567', '+992 90 123', '90-123-45'):
+            self.assertEqual(search.ranked_ids('counterparty', term, 10), [self.counterparty.pk], term)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class OperationGroupAdminTests(TestCase):
+    """ Строки группы в админке читаются и сохраняются пачкой, остатки и итоги не расходятся.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.force_login(self.user)
+        category = Category.objects.create(name='Напитки')
+        self.products = [Product.objects.create(name=f'Товар {number}', category=category) for number in range(12)]
+        self.group = OperationGroup.objects.create(counterparty=Counterparty.objects.create(full_name='Иванов Иван'), action=Action.RECEIPT)
+        self.operations = [
+            Operation.objects.create(operation_group=self.group, product=product, quantity=5, price='10.00')
+            for product in self.products[:2]
+        ]
+
+    def change_url(self):
+        return reverse('admin:storage_operationgroup_change', args=(self.group.pk,))
+
+    def test_change_form_queries_do_not_grow_with_lines(self):
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.client.get(self.change_url()).status_code, 200)
+        for product in self.products[2:]:
+            Operation.objects.create(operation_group=self.group, product=product, quantity=1, price='10.00')
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(self.client.get(self.change_url()).status_code, 200)
+        self.assertEqual(len(large), len(small))
+
+    def test_bulk_save_keeps_stock_and_totals(self):
+        kept, deleted = self.operations
+        data = {
+            'counterparty': self.group.counterparty_id,
+            'action': Action.RECEIPT,
+            'comment': '',
+            'operation_set-TOTAL_FORMS': 3,
+            'operation_set-INITIAL_FORMS': 2,
+            'operation_set-MIN_NUM_FORMS': 0,
+            'operation_set-MAX_NUM_FORMS': 1000,
+        }
+        lines = [
+            (kept.pk, self.products[2].pk, 7, ''),
+            (deleted.pk, deleted.product_id, 5, 'on'),
+            ('', self.products[3].pk, 4, ''),
+        ]
+        for number, (pk, product_id, quantity, delete) in enumerate(lines):
+            data.update({
+                f'operation_set-{number}-id': pk,
+                f'operation_set-{number}-operation_group': self.group.pk,
+                f'operation_set-{number}-product': product_id,
+                f'operation_set-{number}-price': '10.00',
+                f'operation_set-{number}-quantity': quantity,
+                f'operation_set-{number}-discount': '0',
+                f'operation_set-{number}-DELETE': delete,
+            })
+        response = self.client.post(self.change_url(), data)
+        self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(rebuild_stock(fix=False), [])
+        self.assertEqual(rebuild_totals(fix=False), ([], []))
+        stock = dict(Stock.objects.values_list('product_id', 'quantity'))
+        self.assertEqual([stock[product.pk] for product in self.products[:4]], [0, 0, 7, 4])
+        self.group.refresh_from_db()
+        self.assertEqual((self.group.total_quantity, self.group.total_amount, self.group.lines_count), (11, Decimal('110.00'), 2))
+        kept.refresh_from_db()
+        self.assertEqual((kept.product_id, kept.updated_by), (self.products[2].pk, self.user))
+        created = self.group.operation_set.get(product=self.products[3])
+        self.assertEqual((created.created_by, created.updated_by, created.amount), (self.user, self.user, Decimal('40.00')))
+
+    def test_changelist_pages_by_id(self):
+        groups = [self.group] + [OperationGroup.objects.create(counterparty=self.group.counterparty, action=Action.SALE) for number in range(4)]
+        other = OperationGroup.objects.create(counterparty=Counterparty.objects.create(full_name='Петров Петр'), action=Action.SALE)
+        url = reverse('admin:storage_operationgroup_changelist')
+        with mock.patch.object(OperationGroupAdmin, 'list_per_page', 2):
+            pages = [self.client.get(url).context['cl']]
+            while pages[-1].older_url:
+                pages.append(self.client.get(url + pages[-1].older_url).context['cl'])
+            newer = self.client.get(url + pages[1].newer_url).context['cl']
+            filtered = self.client.get(url, {'counterparty__id__exact': self.group.counterparty_id}).context['cl']
+        listed = [[group.pk for group in page.result_list] for page in pages]
+        self.assertEqual(listed, [[other.pk, groups[4].pk], [groups[3].pk, groups[2].pk], [groups[1].pk, groups[0].pk]])
+        self.assertEqual([group.pk for group in newer.result_list], listed[0])
+        self.assertEqual(filtered.result_count, 5)
+        self.assertNotIn(other, filtered.result_list)
+
+
+class StockLedgerTests(TestCase):
+    """ Таблица Stock следует за каждым изменением операций и групп.
+    """
+
+    def setUp(self):
+        category = Category.objects.create(name='Напитки')
+        self.tea, self.coffee = (Product.objects.create(name=name, category=category) for name in ('Чай', 'Кофе'))
+        counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.receipt = OperationGroup.objects.create(counterparty=counterparty, action=Action.RECEIPT)
+        self.sale = OperationGroup.objects.create(counterparty=counterparty, action=Action.SALE)
+        self.operation = Operation.objects.create(operation_group=self.receipt, product=self.tea, quantity=10, price='10.00')
+
+    def stock(self):
+        self.assertEqual(rebuild_stock(fix=False), [])
+        stock = dict(Stock.objects.values_list('product_id', 'quantity'))
+        return stock[self.tea.pk], stock[self.coffee.pk]
+
+    def test_create_and_edit(self):
+        self.assertEqual(self.stock(), (10, 0))
+        Operation.objects.create(operation_group=self.sale, product=self.tea, quantity=3, price='10.00')
+        self.assertEqual(self.stock(), (7, 0))
+        self.operation.quantity = 4
+        self.operation.save()
+        self.assertEqual(self.stock(), (1, 0))
+
+    def test_product_move(self):
+        self.operation.product = self.coffee
+        self.operation.save()
+        self.assertEqual(self.stock(), (0, 10))
+
+    def test_delete(self):
+        Operation.objects.create(operation_group=self.sale, product=self.coffee, quantity=2, price='10.00')
+        self.operation.delete()
+        self.assertEqual(self.stock(), (0, -2))
+        self.sale.delete()
+        self.assertEqual(self.stock(), (0, 0))
+
+    def test_action_flip(self):
+        self.receipt.action = Action.SALE
+        self.receipt.save()
+        self.assertEqual(self.stock(), (-10, 0))
+        self.operation.refresh_from_db()
+        self.assertEqual(self.operation.signed_quantity, -10)
+        self.assertEqual(rebuild_totals(fix=False), ([], []))
+
+
+class SaleServiceTests(TestCase):
+    """ Продажа с проверкой остатков: apply_sale, lock_and_check, group_edit_deltas.
+    """
+
+    def setUp(self):
+        category = Category.objects.create(name='Напитки')
+        self.tea, self.coffee = (Product.objects.create(name=name, category=category) for name in ('Чай', 'Кофе'))
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.receipt = OperationGroup.objects.create(counterparty=self.counterparty, action=Action.RECEIPT)
+        Operation.objects.create(operation_group=self.receipt, product=self.tea, quantity=5, price='10.00')
+
+    def stock(self):
+        return dict(Stock.objects.values_list('product_id', 'quantity'))
+
+    def test_sale(self):
+        group = apply_sale(self.counterparty.pk, [SaleLine(self.tea.pk, 2, Decimal('10.00'), Decimal('1.00'))])
+        self.assertEqual(self.stock(), {self.tea.pk: 3, self.coffee.pk: 0})
+        self.assertEqual(group.operation_set.get().signed_quantity, -2)
+        self.assertEqual(rebuild_totals(fix=False), ([], []))
+        self.assertTrue(OperationEvent.objects.filter(operation_group_id=group.pk, operation_id__isnull=False).exists())
+
+    def test_oversell_rejected(self):
+        lines = [SaleLine(self.tea.pk, 3, Decimal('10.00')), SaleLine(self.tea.pk, 3, Decimal('10.00')), SaleLine(self.coffee.pk, 1, Decimal('10.00'))]
+        with self.assertRaises(InsufficientStock) as raised:
+            apply_sale(self.counterparty.pk, lines)
+        self.assertEqual(raised.exception.shortages, {self.tea.pk: (5, -6), self.coffee.pk: (0, -1)})
+        self.assertEqual(OperationGroup.objects.count(), 1)
+        self.assertEqual(self.stock(), {self.tea.pk: 5, self.coffee.pk: 0})
+        with self.assertRaises(ValidationError):
+            apply_sale(self.counterparty.pk, [SaleLine(self.tea.pk, 0, Decimal('10.00'))])
+
+    def test_edit_deltas(self):
+        # строки заменяют старые строки группы
+        lines = [(self.tea.pk, 3), (self.coffee.pk, 2)]
+        self.assertEqual(dict(group_edit_deltas(self.receipt, lines)), {self.tea.pk: -2, self.coffee.pk: 2})
+        self.receipt.action = Action.SALE
+        deltas = group_edit_deltas(self.receipt, lines)
+        self.assertEqual(dict(deltas), {self.tea.pk: -8, self.coffee.pk: -2})
+        with self.assertRaises(InsufficientStock):
+            lock_and_check(deltas)
+
+    def test_lock_order(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(lock_and_check({self.tea.pk: 1}), {})
+        self.assertEqual(len(queries), 0)
+        with CaptureQueriesContext(connection) as queries:
+            available = lock_and_check({self.coffee.pk: 0, self.tea.pk: -5})
+        self.assertEqual(available, {self.tea.pk: 5})
+        # только уменьшаемые остатки, одним запросом в порядке product_id
+        self.assertEqual(len(queries), 1)
+        self.assertIn('ORDER BY', queries[0]['sql'])
+        if connection.features.has_select_for_update:
+            self.assertIn('FOR UPDATE', queries[0]['sql'])
+
+
+class StockSnapshotTests(TestCase):
+    """ Остаток на дату по ближайшему снимку и окну операций; правка старых операций правит снимки.
+    """
+
+    def setUp(self):
+        category = Category.objects.create(name='Напитки')
+        self.tea, self.coffee = (Product.objects.create(name=name, category=category) for name in ('Чай', 'Кофе'))
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.now = timezone.now()
+        self.receipt = self.operation(Action.RECEIPT, self.tea, 10, days=10)
+        self.operation(Action.RECEIPT, self.coffee, 4, days=8)
+        take_snapshot(self.now - timedelta(days=5))
+        self.operation(Action.SALE, self.tea, 3, days=2)
+
+    def operation(self, action, product, quantity, days):
+        group = OperationGroup.objects.create(counterparty=self.counterparty, action=action)
+        operation = Operation.objects.create(operation_group=group, product=product, quantity=quantity, price='10.00')
+        Operation.objects.filter(pk=operation.pk).update(created_at=self.now - timedelta(days=days))
+        operation.refresh_from_db()
+        return operation
+
+    def as_of(self, days):
+        return stock_as_of(self.tea, self.now - timedelta(days=days))
+
+    def test_across_snapshot_boundary(self):
+        # до снимка - назад от него, после - вперед
+        self.assertEqual([self.as_of(days) for days in (20, 7, 5, 3, 1)], [0, 10, 10, 10, 7])
+        self.assertEqual(stock_as_of(self.tea, self.now), Stock.objects.get(product=self.tea).quantity)
+
+    def test_edit_before_snapshot_updates_it(self):
+        self.receipt.quantity = 4
+        self.receipt.save()
+        self.assertEqual([self.as_of(days) for days in (7, 3, 1)], [4, 4, 1])
+        self.receipt.delete()
+        self.assertEqual([self.as_of(days) for days in (7, 3, 1)], [0, 0, -3])
+
+    def test_product_lists_are_chunked(self):
+        expected = stock_as_of(Product.objects.all(), self.now - timedelta(days=3))
+        with mock.patch.object(snapshots, 'CHUNK_SIZE', 1):
+            self.assertEqual(stock_as_of(Product.objects.all(), self.now - timedelta(days=3)), expected)
+            self.assertEqual(stock_as_of(Product.objects.all(), self.now - timedelta(days=7)), {self.tea.pk: 10, self.coffee.pk: 4})
+        self.assertEqual(expected, {self.tea.pk: 10, self.coffee.pk: 4})
+
+
+class FixtureLoadTests(TestCase):
+    """ loaddata сохраняет строки raw: суммы, количество со знаком и остатки все равно заполняются.
+    """
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin', pk=1)
+        call_command('loaddata', settings.BASE_DIR / 'data.json', verbosity=0)
+
+    def test_loaded_operations_fill_ledger(self):
+        self.assertEqual(rebuild_totals(fix=False), ([], []))
+        self.assertEqual(rebuild_stock(fix=False), [])
+        operation = Operation.objects.get(pk=1)
+        self.assertEqual((operation.amount, operation.signed_quantity), (Decimal('1250.00'), 5))
+        self.assertTrue(Stock.objects.exclude(quantity=0).exists())
+
+    def test_loaded_counterparties_are_searchable_by_phone(self):
+        self.assertEqual(Counterparty.objects.get(pk=2).phone_digits, '79876543210')
+        self.assertEqual(search.ranked_ids('counterparty', '+7 987', 10), [2])
+
+    def test_check_totals_fixes_stock(self):
+        expected = dict(Stock.objects.values_list('product_id', 'quantity'))
+        # как после загрузки без сигнала pre_save
+        Operation.objects.update(amount=0, signed_quantity=0)
+        Stock.objects.update(quantity=0)
+        call_command('check_totals', stdout=StringIO())
+        self.assertEqual(dict(Stock.objects.values_list('product_id', 'quantity')), expected)
+        self.assertEqual(rebuild_totals(fix=False), ([], []))
+
+
+class ImportTests(TestCase):
+    """ Импорт операций: контрольные точки привязаны к файлу, неоднозначные строки отклоняются.
+    """
+
+    HEADER = 'group,action,counterparty,product,quantity,price\n'
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'operations.csv')
+        category = Category.objects.create(name='Напитки')
+        self.tea = Product.objects.create(name='Чай', category=category)
+        Counterparty.objects.create(full_name='Иванов Иван', phone='+992 90 123-45-67')
+
+    def write(self, *lines):
+        with open(self.path, 'w', encoding='utf-8') as file:
+            file.write(self.HEADER + ''.join(f'{line}\n' for line in lines))
+
+    def test_new_file_on_same_path_is_imported_in_full(self):
+        self.write('1,receipt,992901234567,Чай,5,10', '2,sale,992901234567,Чай,1,10')
+        self.assertEqual(import_operations(self.path, chunk_size=1).rows, 2)
+        self.assertFalse(ImportCheckpoint.objects.exists())
+        self.write('3,receipt,992901234567,Чай,7,10')
+        stats = import_operations(self.path)
+        self.assertEqual((stats.rows, stats.skipped), (1, 0))
+        self.assertEqual(Stock.objects.get(product=self.tea).quantity, 11)
+
+    def test_interrupted_import_resumes_only_for_same_file(self):
+        self.write('1,receipt,992901234567,Чай,5,10', '2,sale,992901234567,Чай,1,10')
+        # номер строки файла: первая строка данных - вторая после заголовка
+        ImportCheckpoint.objects.create(source=self.path, line=2, fingerprint=fingerprint(self.path))
+        stats = import_operations(self.path)
+        self.assertEqual((stats.rows, stats.skipped), (1, 1))
+        ImportCheckpoint.objects.create(source=self.path, line=2, fingerprint='другой файл')
+        self.assertEqual(import_operations(self.path).skipped, 0)
+
+    def test_ambiguous_product_is_rejected(self):
+        Product.objects.create(name='Чай', category=self.tea.category)
+        self.write('1,receipt,992901234567,Чай,5,10')
+        with self.assertRaisesMessage(ImportRowError, 'несколько'):
+            import_operations(self.path)
+        self.assertFalse(Operation.objects.exists())
+
+    def test_csv_errors_point_at_file_line(self):
+        self.write('1,receipt,992901234567,Чай,5,10', '2,sale,992901234567,Кофе,1,10')
+        with self.assertRaises(ImportRowError) as raised:
+            import_operations(self.path)
+        self.assertEqual(raised.exception.line, 3)
+
+    def test_non_positive_quantity_is_row_error(self):
+        for quantity in ('0', '-2'):
+            self.write(f'1,receipt,992901234567,Чай,{quantity},10')
+            with self.assertRaises(ImportRowError) as raised:
+                import_operations(self.path)
+            self.assertEqual(raised.exception.line, 2)
+        self.assertFalse(Operation.objects.exists())
+
+    def test_invalid_jsonl_line_is_row_error(self):
+        path = os.path.join(os.path.dirname(self.path), 'operations.jsonl')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('{"group": 1, "action": "receipt"\n')
+        with self.assertRaises(ImportRowError) as raised:
+            import_operations(path)
+        self.assertEqual(raised.exception.line, 1)
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class ChangelistTotalsTests(TestCase):
+    """ Итоги категорий и оборот контрагентов в списках админки не дают запроса на строку.
+    """
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+
+    def add_rows(self, count):
+        for number in range(count):
+            category = Category.objects.create(name=f'Категория {number}')
+            product = Product.objects.create(name=f'Товар {number}', category=category)
+            counterparty = Counterparty.objects.create(full_name=f'Контрагент {number}')
+            group = OperationGroup.objects.create(counterparty=counterparty, action=Action.RECEIPT)
+            Operation.objects.create(operation_group=group, product=product, quantity=2, price='5.00')
+
+    def changelist_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_batch_waits_for_key_computed_elsewhere(self):
+        cache.clear()
+        self.add_rows(2)
+        first, second = Category.objects.order_by('pk').values_list('pk', flat=True)
+        key = cache_keys('category', [first])[first]
+        # другой процесс уже считает итоги первой категории
+        cache.add(f'{key}:lock', 1)
+        computed = []
+
+        def compute(missing):
+            computed.append(sorted(missing))
+            return {category_id: {'products': 1, 'remaining': 2} for category_id in missing}
+
+        def other_process_finishes(seconds):
+            cache.set(key, {'products': 1, 'remaining': 7})
+
+        with mock.patch('storage.cache.time.sleep', other_process_finishes):
+            values = get_or_compute_many('category', [first, second], compute)
+        self.assertEqual(computed, [[second]])
+        self.assertEqual(values[first]['remaining'], 7)
+        self.assertIsNone(cache.get(f'{cache_keys("category", [second])[second]}:lock'))
+
+    def test_queries_do_not_grow_with_rows(self):
+        for name in ('category', 'counterparty'):
+            url = reverse(f'admin:storage_{name}_changelist')
+            self.add_rows(2)
+            small = self.changelist_queries(url)[1]
+            self.add_rows(10)
+            response, large = self.changelist_queries(url)
+            self.assertEqual(large, small, name)
+        self.assertContains(response, '10,00')
+
+
+class ExportTests(TestCase):
+    """ Потоковые выгрузки CSV и JSONL из админки: заголовок, строки, суммы и число запросов.
+    """
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.category = Category.objects.create(name='Напитки')
+        self.tea = Product.objects.create(name='Чай', category=self.category)
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.group = OperationGroup.objects.create(counterparty=self.counterparty, action=Action.RECEIPT)
+        self.operation = Operation.objects.create(operation_group=self.group, product=self.tea, quantity=3, price='10.05', discount='10.00')
+
+    def export(self, model, action, ids):
+        response = self.client.post(reverse(f'admin:storage_{model}_changelist'), {'action': action, '_selected_action': ids})
+        self.assertIsInstance(response, StreamingHttpResponse)
+        with CaptureQueriesContext(connection) as queries:
+            content = b''.join(response.streaming_content).decode('utf-8')
+        return response, content, len(queries)
+
+    def add_operations(self, count):
+        Operation.objects.bulk_create([
+            Operation(operation_group=self.group, product=self.tea, quantity=1, price='1.00', amount='1.00', signed_quantity=1)
+            for _ in range(count)
+        ])
+
+    def test_operations_csv(self):
+        response, content, queries = self.export('operationgroup', 'export_operations_csv', [self.group.pk])
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        self.assertIn('attachment; filename="operations-', response['Content-Disposition'])
+        header, row = list(csv.reader(StringIO(content)))
+        self.assertEqual(header, ['id', 'created_at', 'group', 'action', 'counterparty', 'product', 'category', 'quantity', 'price', 'discount', 'amount'])
+        self.assertEqual(row[0], str(self.operation.pk))
+        self.assertEqual(row[2:], [str(self.group.pk), Action.RECEIPT.label, 'Иванов Иван', 'Чай', 'Напитки', '3', '10.05', '10.00', '27.14'])
+        # все строки читаются одним итератором, без запроса на строку
+        self.assertEqual(queries, 1)
+        self.add_operations(20)
+        content, queries = self.export('operationgroup', 'export_operations_csv', [self.group.pk])[1:]
+        self.assertEqual((len(content.splitlines()), queries), (22, 1))
+
+    def test_operations_jsonl(self):
+        response, content, queries = self.export('operationgroup', 'export_operations_jsonl', [self.group.pk])
+        self.assertTrue(response['Content-Type'].startswith('application/x-ndjson'))
+        row = json.loads(content)
+        self.assertEqual((row['product'], row['quantity'], row['amount']), ('Чай', 3, '27.14'))
+        self.assertEqual(Decimal(row['price']), Decimal('10.05'))
+        self.assertEqual(queries, 1)
+
+    def test_groups_and_stock_csv(self):
+        content, queries = self.export('operationgroup', 'export_groups_csv', [self.group.pk])[1:]
+        self.assertEqual(list(csv.reader(StringIO(content)))[1][2:], [Action.RECEIPT.label, 'Иванов Иван', '3', '27.14'])
+        self.assertEqual(queries, 1)
+        content, queries = self.export('product', 'export_stock_csv', [self.tea.pk])[1:]
+        self.assertEqual(list(csv.reader(StringIO(content))), [['id', 'name', 'category', 'remaining'], [str(self.tea.pk), 'Чай', 'Напитки', '3']])
+        self.assertEqual(queries, 1)
+
+
+class RenditionTests(TestCase):
+    """ Уменьшенные копии изображений: имена по хешу оригинала и вечное кеширование.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = override_settings(MEDIA_ROOT=directory.name)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.product = Product.objects.create(name='Чай', category=Category.objects.create(name='Напитки'))
+
+    def upload(self, color):
+        buffer = BytesIO()
+        Image.new('RGB', (800, 400), color).save(buffer, 'PNG')
+        content = buffer.getvalue()
+        self.product.image = SimpleUploadedFile('tea.png', content, content_type='image/png')
+        self.product.save()
+        return hashlib.sha256(content).hexdigest()
+
+    def test_renditions_are_hashed_and_cached(self):
+        image_hash = self.upload('green')
+        url = reverse('storage:rendition', args=(image_hash, 'thumb', 'webp'))
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+        self.assertEqual(images.generate_renditions(self.product.pk), image_hash)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.image_hash, image_hash)
+        for size, pixels in images.SIZES.items():
+            for fmt in images.FORMATS:
+                name = images.rendition_name(image_hash, size, fmt)
+                self.assertTrue(default_storage.exists(name))
+                with default_storage.open(name) as file:
+                    self.assertEqual(max(Image.open(file).size), pixels)
+
+        response = self.client.get(url)
+        self.addCleanup(response.close)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+
+    def test_replaced_image_gets_new_hash(self):
+        first = self.upload('green')
+        images.generate_renditions(self.product.pk)
+        second = self.upload('red')
+        self.product.refresh_from_db()
+        # старые копии больше не подходят, пока новые не готовы
+        self.assertEqual(self.product.image_hash, '')
+        self.assertNotEqual(images.generate_renditions(self.product.pk), first)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.image_hash, second)
+
+
+@override_settings(STORAGE_LOW_STOCK_THRESHOLD=10)
+class ProductChangelistTests(TestCase):
+    """ Остаток в списке товаров: значения, сортировка и фильтр по остатку без запросов на строку.
+    """
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.category = Category.objects.create(name='Напитки')
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.products = {quantity: self.add_product(quantity) for quantity in (0, 5, 20)}
+
+    def add_product(self, quantity):
+        product = Product.objects.create(name=f'Товар {quantity}', category=self.category)
+        if quantity:
+            group = OperationGroup.objects.create(counterparty=self.counterparty, action=Action.RECEIPT)
+            Operation.objects.create(operation_group=group, product=product, quantity=quantity, price='1.00')
+        return product
+
+    def changelist(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:storage_product_changelist'), params)
+        self.assertEqual(response.status_code, 200)
+        return [(product.name, product.remaining) for product in response.context['cl'].result_list], len(queries)
+
+    def test_remaining_sorting_and_filter(self):
+        # get_remaining - второй столбец списка
+        rows = self.changelist(o='2')[0]
+        self.assertEqual(rows, [('Товар 0', 0), ('Товар 5', 5), ('Товар 20', 20)])
+        self.assertEqual(self.changelist(o='-2')[0], rows[::-1])
+        for bucket, expected in (('out', [0]), ('low', [5]), ('in', [20])):
+            self.assertEqual([remaining for name, remaining in self.changelist(stock=bucket)[0]], expected, bucket)
+
+    def test_queries_do_not_grow_with_rows(self):
+        small = self.changelist()[1]
+        for quantity in range(1, 11):
+            self.add_product(quantity)
+        rows, large = self.changelist()
+        self.assertEqual(len(rows), 13)
+        self.assertEqual(large, small)
+
+
+class StrQueryTests(TestCase):
+    """ __str__ товара и группы и автодополнение товаров не делают запросов на строку.
+    """
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Напитки')
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.tea = Product.objects.create(name='Чай', category=self.category)
+        self.group = OperationGroup.objects.create(counterparty=self.counterparty, action=Action.RECEIPT)
+        Operation.objects.create(operation_group=self.group, product=self.tea, quantity=5, price='1.00')
+
+    def test_str_uses_loaded_data_only(self):
+        product = Product.objects.get(pk=self.tea.pk)
+        group = OperationGroup.objects.get(pk=self.group.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(product), 'Чай')
+            self.assertEqual(str(group), f'№{self.group.pk} Прием')
+        product = Product.objects.select_related('stock').get(pk=self.tea.pk)
+        group = OperationGroup.objects.select_related('counterparty').get(pk=self.group.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(str(product), 'Чай ( 5 )')
+            self.assertEqual(str(group), 'Иванов Иван Прием')
+
+    def test_product_autocomplete(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        params = {'app_label': 'storage', 'model_name': 'operation', 'field_name': 'product', 'term': 'Чай'}
+
+        def autocomplete():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('admin:autocomplete'), params)
+            self.assertEqual(response.status_code, 200)
+            return [row['text'] for row in response.json()['results']], len(queries)
+
+        texts, small = autocomplete()
+        self.assertEqual(texts, ['Чай ( 5 )'])
+        for number in range(10):
+            Product.objects.create(name=f'Чай {number}', category=self.category)
+        texts, large = autocomplete()
+        self.assertEqual(len(texts), 11)
+        self.assertEqual(large, small)
+
+
+@override_settings(ALLOWED_HOSTS=['*'], STORAGE_QUERY_HEADERS=True)
+class QueryInstrumentationTests(TestCase):
+    """ Счетчик SQL запросов работает только при STORAGE_QUERY_INSTRUMENTATION.
+    """
+
+    def test_enabled_by_setting(self):
+        url = reverse('admin:login')
+        with self.settings(STORAGE_QUERY_INSTRUMENTATION=True):
+            self.assertIn('X-Query-Count', self.client_class().get(url))
+        with self.settings(STORAGE_QUERY_INSTRUMENTATION=False):
+            self.assertNotIn('X-Query-Count', self.client_class().get(url))
+
+
+class JobQueueTests(TestCase):
+    """ Очередь фоновых задач: порядок, повторы и возврат задач упавших обработчиков.
+    """
+
+    def setUp(self):
+        Job.objects.all().delete()
+
+    def test_enqueue_with_key_is_idempotent(self):
+        first = jobs.enqueue('noop', key='noop:1')
+        self.assertEqual(jobs.enqueue('noop', key='noop:1'), first)
+        self.assertEqual(Job.objects.count(), 1)
+        with self.assertRaises(ValueError):
+            jobs.enqueue('missing')
+
+    def test_finished_job_releases_key(self):
+        first = jobs.enqueue('noop', key='noop:1')
+        jobs.run_next('test')
+        self.assertEqual(jobs.enqueue('noop', key='noop:1', match_done=True), first)
+        second = jobs.enqueue('noop', key='noop:1')
+        self.assertNotEqual(second, first)
+        self.assertEqual(jobs.enqueue('noop', key='noop:1', match_done=True), second)
+
+    def test_prune_keeps_recent_and_active_jobs(self):
+        old, recent = jobs.enqueue('noop'), jobs.enqueue('noop')
+        jobs.run_next('test')
+        jobs.run_next('test')
+        queued = jobs.enqueue('noop')
+        Job.objects.filter(pk__in=[old.pk, queued.pk]).update(finished_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(jobs.prune_jobs(keep=timedelta(days=7), batch_size=1), 1)
+        self.assertEqual(set(Job.objects.values_list('pk', flat=True)), {recent.pk, queued.pk})
+
+    def test_higher_priority_runs_first(self):
+        low = jobs.enqueue('noop')
+        high = jobs.enqueue('check_totals', priority=5)
+        self.assertEqual(jobs.run_next('test'), high)
+        high.refresh_from_db()
+        self.assertEqual((high.status, high.attempts, high.result), (JobStatus.DONE, 1, {'operations': 0, 'groups': 0}))
+        self.assertEqual(jobs.run_next('test'), low)
+        self.assertIsNone(jobs.run_next('test'))
+
+    def test_failed_job_is_retried_until_max_attempts(self):
+        def fail(progress):
+            raise RuntimeError("сбой")
+
+        with mock.patch.dict(jobs.TASKS, {'fail': jobs.Task(fail, "Сбой")}):
+            job = jobs.enqueue('fail', max_attempts=2)
+            jobs.run_next('test')
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (JobStatus.QUEUED, 1))
+            self.assertIn("сбой", job.error)
+            # повтор откладывается, раньше срока задачу не забирают
+            self.assertIsNone(jobs.run_next('test'))
+            Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            jobs.run_next('test')
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (JobStatus.FAILED, 2))
+
+    def test_fatal_error_is_not_retried(self):
+        def fail(progress):
+            raise jobs.FatalJobError("неверные данные")
+
+        with mock.patch.dict(jobs.TASKS, {'fail': jobs.Task(fail, "Сбой")}):
+            job = jobs.enqueue('fail')
+            jobs.run_next('test')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (JobStatus.FAILED, 1))
+
+    def test_stale_job_is_requeued(self):
+        job = jobs.enqueue('noop', max_attempts=1)
+        other = jobs.enqueue('noop')
+        jobs.claim('dead')
+        jobs.claim('dead')
+        Job.objects.update(heartbeat_at=timezone.now() - timedelta(minutes=10))
+        self.assertEqual(jobs.recover_stale(timeout=60), 2)
+        job.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((job.status, other.status), (JobStatus.FAILED, JobStatus.QUEUED))
+
+
+class OperationEventTests(TestCase):
+    """ Журнал операций пишется вместе с изменениями, отчеты по нему совпадают с полным пересчетом.
+    """
+
+    def setUp(self):
+        category = Category.objects.create(name='Напитки')
+        self.tea, self.coffee = (Product.objects.create(name=name, category=category) for name in ('Чай', 'Кофе'))
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.group = OperationGroup.objects.create(counterparty=self.counterparty, action=Action.RECEIPT)
+        self.operation = Operation.objects.create(operation_group=self.group, product=self.tea, quantity=5, price='10.00')
+        reset_rollups()
+
+    def rollups(self):
+        return (
+            sorted(DailyRollup.objects.values_list('day', 'product_id', 'action', 'quantity', 'amount', 'lines')),
+            sorted(DailyCounterpartyRollup.objects.values_list('day', 'counterparty_id', 'action', 'quantity', 'amount', 'lines')),
+        )
+
+    def assertRollupsMatchRebuild(self):
+        incremental = self.rollups()
+        reset_rollups()
+        self.assertEqual(incremental, self.rollups())
+
+    def test_changes_are_logged_with_before_and_after(self):
+        self.operation.quantity = 7
+        self.operation.save()
+        pk = self.operation.pk
+        self.operation.delete()
+        logged = list(OperationEvent.objects.filter(operation_id=pk).order_by('id'))
+        self.assertEqual([event.kind for event in logged], [EventKind.CREATE, EventKind.UPDATE, EventKind.DELETE])
+        self.assertEqual((logged[1].before['quantity'], logged[1].after['quantity']), (5, 7))
+        self.assertEqual(logged[1].after['amount'], '70.00')
+        self.assertIsNone(logged[2].after)
+
+    def test_rollups_follow_log(self):
+        self.operation.quantity = 3
+        self.operation.product = self.coffee
+        self.operation.save()
+        Operation.objects.create(operation_group=self.group, product=self.tea, quantity=2, price='4.00')
+        # смена действия группы меняет каждую ее операцию
+        self.group.action = Action.SALE
+        self.group.save()
+        self.assertEqual(build_rollups(), 5)
+        self.assertEqual(build_rollups(), 0)
+        self.assertRollupsMatchRebuild()
+
+    def test_deleted_group_leaves_rollups(self):
+        group_id, operation_id = self.group.pk, self.operation.pk
+        self.group.delete()
+        build_rollups()
+        self.assertEqual(self.rollups(), ([], []))
+        kinds = list(OperationEvent.objects.filter(operation_group_id=group_id).values_list('operation_id', 'kind').order_by('id'))
+        self.assertEqual(kinds[-2:], [(operation_id, EventKind.DELETE), (None, EventKind.DELETE)])
+
+    def test_late_commit_is_not_skipped(self):
+        seen = []
+        consumer = events.Consumer(lambda batch: seen.extend(item.pk for item in batch), 'Тест')
+        patcher = mock.patch.dict(events.CONSUMERS, {'late': consumer})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        logged = list(OperationEvent.objects.order_by('id'))
+        # событие транзакции, которая еще не зафиксирована
+        hidden = logged[0]
+        OperationEvent.objects.filter(pk=hidden.pk).delete()
+
+        def consume(xmin, xmax):
+            seen.clear()
+            with mock.patch.object(events, '_snapshot', return_value=(xmin, xmax)):
+                events.consume('late')
+            return list(seen), Watermark.objects.get(name=events.cursor_name('late')).gaps
+
+        self.assertEqual(consume(100, 105), ([item.pk for item in logged if item.pk != hidden.pk], [[hidden.pk, 105]]))
+        self.assertEqual(consume(101, 106), ([], [[hidden.pk, 105]]))
+        hidden.save()
+        self.assertEqual(consume(101, 106), ([hidden.pk], []))
+
+        # откаченная вставка забывается, когда завершились все транзакции до xmax
+        Operation.objects.create(operation_group=self.group, product=self.coffee, quantity=1, price='1.00')
+        rolled_back = OperationEvent.objects.latest('id')
+        OperationEvent.objects.filter(pk=rolled_back.pk).delete()
+        Operation.objects.create(operation_group=self.group, product=self.coffee, quantity=1, price='1.00')
+        self.assertEqual(consume(105, 110)[1], [[rolled_back.pk, 110]])
+        self.assertEqual(consume(110, 112), ([], []))
+
+    def test_prune_keeps_unread_events(self):
+        OperationEvent.objects.update(created_at=timezone.now() - timedelta(days=60))
+        Operation.objects.create(operation_group=self.group, product=self.coffee, quantity=1, price='1.00')
+        OperationEvent.objects.filter(operation_id__isnull=False).update(created_at=timezone.now() - timedelta(days=60))
+        self.assertEqual(events.prune(keep=timedelta(days=30)), 2)
+        self.assertEqual(events.pending('rollups'), 1)
+
+
+class ArchiveTests(TestCase):
+    """ Перенос старых операций в архив не меняет остатки, историю остатков, обороты и отчеты.
+    """
+
+    def setUp(self):
+        category = Category.objects.create(name='Напитки')
+        self.tea = Product.objects.create(name='Чай', category=category)
+        self.counterparty = Counterparty.objects.create(full_name='Иванов Иван')
+        self.now = timezone.now()
+        self.old_groups = []
+        for days, action, quantity in ((40, Action.RECEIPT, 10), (35, Action.SALE, 3)):
+            group = OperationGroup.objects.create(counterparty=self.counterparty, action=action)
+            Operation.objects.create(operation_group=group, product=self.tea, quantity=quantity, price='10.00')
+            OperationGroup.objects.filter(pk=group.pk).update(created_at=self.now - timedelta(days=days))
+            Operation.objects.filter(operation_group=group).update(created_at=self.now - timedelta(days=days))
+            self.old_groups.append(group.pk)
+        recent = OperationGroup.objects.create(counterparty=self.counterparty, action=Action.SALE)
+        Operation.objects.create(operation_group=recent, product=self.tea, quantity=2, price='10.00')
+        reset_rollups()
+
+    def state(self):
+        return (
+            Stock.objects.get(product=self.tea).quantity,
+            stock_as_of(self.tea, self.now - timedelta(days=38)),
+            counterparty_turnover(self.counterparty.pk),
+            sorted(DailyRollup.objects.values_list('day', 'product_id', 'action', 'quantity', 'amount', 'lines')),
+        )
+
+    def test_archive_keeps_totals(self):
+        before = self.state()
+        stats = archive_operations(self.now - timedelta(days=30), chunk_size=1)
+        self.assertEqual((stats.groups, stats.operations), (2, 2))
+        self.assertEqual(sorted(ArchivedOperationGroup.objects.values_list('id', flat=True)), self.old_groups)
+        self.assertFalse(OperationGroup.objects.filter(pk__in=self.old_groups).exists())
+        self.assertEqual(Operation.objects.count(), 1)
+        opening = OpeningBalance.objects.get(product=self.tea)
+        self.assertEqual((opening.quantity, opening.lines), (7, 2))
+        self.assertEqual(rebuild_stock(fix=False), [])
+        cache.clear()
+        reset_rollups()
+        self.assertEqual(self.state(), before)
+        self.assertEqual(before[:2], (5, 10))
+
+    def test_chunk_rows_locked_before_copy(self):
+        with CaptureQueriesContext(connection) as queries:
+            archive_operations(self.now - timedelta(days=30), chunk_size=10)
+        sql = [query['sql'] for query in queries]
+        copy = next(number for number, text in enumerate(sql) if text.startswith('INSERT INTO "storage_archivedoperationgroup"'))
+        locks = [text for text in sql[:copy] if 'FROM "storage_operation"' in text and 'ORDER BY' in text]
+        self.assertTrue(locks)
+        if connection.features.has_select_for_update:
+            self.assertTrue(all('FOR UPDATE' in text for text in locks))
+
+    def test_counterparty_with_archive_is_protected(self):
+        archive_operations(self.now - timedelta(days=30))
+        with self.assertRaises(ProtectedError):
+            self.counterparty.delete()
+        self.assertEqual(OpeningBalance.objects.get(product=self.tea).quantity, 7)
+
+    def test_archive_is_repeatable(self):
+        archive_operations(self.now - timedelta(days=30))
+        self.assertEqual(archive_operations(self.now - timedelta(days=30)).groups, 0)
+        self.assertEqual(OpeningBalance.objects.get(product=self.tea).quantity, 7)
+
+
+class StockIndexTests(TestCase):
+    """ Общий индекс остатков совпадает с таблицей Stock и обновляется после фиксации изменений.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'stock.idx')
+        settings_override = override_settings(STORAGE_STOCK_INDEX=self.path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(lambda: setattr(stockindex, '_index', None))
+        category = Category.objects.create(name='Напитки')
+        self.tea, self.coffee = (Product.objects.create(name=name, category=category) for name in ('Чай', 'Кофе'))
+        self.group = OperationGroup.objects.create(counterparty=Counterparty.objects.create(full_name='Иванов Иван'), action=Action.RECEIPT)
+        Operation.objects.create(operation_group=self.group, product=self.tea, quantity=5, price='10.00')
+        self.product_ids = [self.tea.pk, self.coffee.pk]
+
+    def indexed(self):
+        return {product_id: entry[0] for product_id, entry in stockindex.lookup(self.product_ids).items()}
+
+    def test_reconcile_and_refresh_on_commit(self):
+        self.assertEqual(self.indexed(), {})
+        stockindex.get_index().reconcile()
+        self.assertEqual(self.indexed(), {self.tea.pk: 5, self.coffee.pk: 0})
+        with self.captureOnCommitCallbacks(execute=True):
+            Operation.objects.create(operation_group=self.group, product=self.coffee, quantity=3, price='10.00')
+        self.assertEqual(self.indexed(), {self.tea.pk: 5, self.coffee.pk: 3})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.coffee.delete()
+        self.assertEqual(self.indexed(), {self.tea.pk: 5})
+        self.assertEqual(get_remaining_product(self.tea), 5)
+
+    def test_other_process_sees_growth(self):
+        stockindex.get_index().reconcile()
+        other = stockindex.StockIndex(self.path)
+        self.addCleanup(other.close)
+        far = 5000
+        other.store([(far, 7, 2, 1)])
+        self.assertEqual(stockindex.lookup([far]), {far: (7, 2, 1)})
+        # запись с меньшей версией не пишется, даже если время изменения позже
+        other.store([(far, 9, 1, 5)])
+        self.assertEqual(stockindex.lookup([far])[far][0], 7)
+
+    def test_rollback_leaves_no_phantom_stock(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                Stock.objects.filter(product=self.tea).update(quantity=100, version=F('version') + 1)
+                stockindex.reconcile_if_due()
+                self.assertEqual(get_remaining_product(self.tea), 100)
+                raise RuntimeError
+        self.assertEqual(self.indexed(), {})
+        self.assertEqual(get_remaining_product(self.tea), 5)
+        with self.captureOnCommitCallbacks(execute=True):
+            stockindex.reconcile_if_due()
+        self.assertEqual(self.indexed(), {self.tea.pk: 5, self.coffee.pk: 0})
+
+    def test_versions_order_writes(self):
+        index = stockindex.get_index()
+        index.reconcile()
+        stock = Stock.objects.get(product=self.tea)
+        self.assertEqual((stock.quantity, stock.version), (5, 2))
+        # две фиксации с одинаковым временем: решает версия
+        Stock.objects.filter(product=self.tea).update(quantity=8, version=3, updated_at=stock.updated_at)
+        stockindex.refresh([self.tea.pk])
+        self.assertEqual(self.indexed()[self.tea.pk], 8)
+        index.store([(self.tea.pk, 5, 2, stockindex._stamp(stock.updated_at))])
+        self.assertEqual(self.indexed()[self.tea.pk], 8)
+        # сверка переписывает индекс по таблице, даже если версия в базе меньше
+        Stock.objects.filter(product=self.tea).update(quantity=4, version=1)
+        index.reconcile()
+        self.assertEqual(self.indexed()[self.tea.pk], 4)
+
+    def test_stock_batch_matches_database(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        url = reverse('storage:stock-batch') + f'?ids={self.tea.pk},{self.coffee.pk},999999'
+        with self.settings(STORAGE_STOCK_INDEX=None):
+            expected = self.client.get(url)
+        stockindex.get_index().reconcile()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.json(), expected.json())
+        self.assertEqual(response['ETag'], expected['ETag'])
+        # из базы читается только товар, которого нет в индексе (кроме сессии и пользователя)
+        self.assertEqual(len([query for query in queries if 'storage_stock' in query['sql']]), 1)
+
+
+class StockApiTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name='Напитки')
+        self.other = Category.objects.create(name='Чай')
+        self.tea = Product.objects.create(name='Чай', category=self.category)
+        self.group = OperationGroup.objects.create(counterparty=Counterparty.objects.create(full_name='Иванов Иван'), action=Action.RECEIPT)
+        Operation.objects.create(operation_group=self.group, product=self.tea, quantity=5, price='10.00')
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+
+    def test_requires_staff(self):
+        urls = [
+            reverse('storage:stock-batch') + f'?ids={self.tea.pk}',
+            reverse('storage:category-stock'),
+            reverse('storage:operation-history'),
+        ]
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.client.force_login(User.objects.create_user('customer'))
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.logout()
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_history_rejects_bad_limit(self):
+        url = reverse('storage:operation-history')
+        for limit in ('0', '-1', 'x'):
+            self.assertEqual(self.client.get(url, {'limit': limit}).status_code, 400)
+        self.assertEqual(len(self.client.get(url, {'limit': '1'}).json()['results']), 1)
+
+    def test_etags_change(self):
+        url = reverse('storage:category-stock')
+        etag = self.client.get(url)['ETag']
+        self.tea.category = self.other
+        self.tea.save()
+        self.assertNotEqual(self.client.get(url)['ETag'], etag)
+
+        url = reverse('storage:operation-history')
+        etag = self.client.get(url)['ETag']
+        self.group.action = Action.SALE
+        self.group.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
@@ -0,0 +1,14 @@
+from django.urls import path, re_path
+
+from . import views
+
+
+app_name = 'storage'
+
+urlpatterns = [
+    path('stock/', views.stock_batch, name='stock-batch'),
+    path('stock/<int:pk>/', views.product_stock, name='product-stock'),
+    path('stock/categories/', views.category_stock, name='category-stock'),
+    path('operations/', views.operation_history, name='operation-history'),
+    re_path(r'^renditions/(?P<image_hash>[0-9a-f]{64})/(?P<size>thumb|medium)\.(?P<fmt>webp|jpg)$', views.rendition, name='rendition'),
+]
@@ -1,13 +1,233 @@
-from .models import Product, Operation, Action
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, Iterable, List, Tuple
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import cache, events, stockindex
+from .archive import lock_archive
+from .models import Product, Operation, OperationGroup, Action, EventKind, Stock, OpeningBalance, operation_amount
+
 
 def get_remaining_product(product: Product) -> int:
-    result = 0
-    
-    operations = Operation.objects.filter(product=product)
-    
+    """ Остаток товара: из общего индекса остатков (storage.stockindex), если он включен,
+    иначе одно чтение из таблицы Stock по первичному ключу. Индекс сверяет
+    stock_index --watch (и stock_batch), здесь - только чтение.
+    """
+    found = stockindex.lookup([product.pk])
+    if product.pk in found:
+        return found[product.pk][0]
+    quantity = Stock.objects.filter(product_id=product.pk).values_list('quantity', flat=True).first()
+    return quantity or 0
+
+
+def signed_quantity(action: int, quantity: int) -> int:
+    """ Количество со знаком: продажа уменьшает остаток, прием увеличивает.
+    """
+    return -quantity if action == Action.SALE else quantity
+
+
+def remaining_expression(prefix: str = 'operation__'):
+    """ Сумма хранимого количества со знаком, без соединения с группой операций.
+    """
+    return Coalesce(Sum(f'{prefix}signed_quantity'), 0)
+
+
+def apply_stock_deltas(deltas: Dict[int, int], create: bool = True, batch_size: int = 500) -> None:
+    """ Применяет изменения остатков {product_id: delta}.
+
+    Строки блокируются в порядке product_id, чтобы параллельные транзакции
+    не блокировали друг друга; несколько товаров меняются одним UPDATE с CASE.
+    """
+    now = timezone.now()
+    changed = sorted((product_id, delta) for product_id, delta in deltas.items() if delta)
+    if len(changed) == 1:
+        _apply_stock_delta(*changed[0], now, create)
+        stockindex.refresh_on_commit([changed[0][0]])
+        return
+    for start in range(0, len(changed), batch_size):
+        batch = dict(changed[start:start + batch_size])
+        with transaction.atomic():
+            locked = list(
+                Stock.objects.select_for_update().filter(product_id__in=batch).order_by('product_id').values_list('product_id', flat=True)
+            )
+            if locked:
+                delta = Case(*[When(product_id=product_id, then=Value(batch[product_id])) for product_id in locked], output_field=IntegerField())
+                Stock.objects.filter(product_id__in=locked).update(quantity=F('quantity') + delta, version=F('version') + 1, updated_at=now)
+            for product_id in sorted(batch.keys() - set(locked)):
+                _apply_stock_delta(product_id, batch[product_id], now, create)
+    stockindex.refresh_on_commit(product_id for product_id, delta in changed)
+
+
+def _apply_stock_delta(product_id: int, delta: int, now, create: bool) -> None:
+    changes = {'quantity': F('quantity') + delta, 'version': F('version') + 1, 'updated_at': now}
+    updated = Stock.objects.filter(product_id=product_id).update(**changes)
+    if not updated and create:
+        Stock.objects.get_or_create(product_id=product_id)
+        Stock.objects.filter(product_id=product_id).update(**changes)
+
+
+def apply_group_totals(deltas: Dict[int, Tuple[int, Decimal, int]]) -> None:
+    """ Применяет изменения итогов групп {group_id: (количество, сумма, строк)}.
+    """
+    for group_id, (quantity, amount, lines) in sorted(deltas.items()):
+        if quantity or amount or lines:
+            OperationGroup.objects.filter(pk=group_id).update(
+                total_quantity=F('total_quantity') + quantity,
+                total_amount=F('total_amount') + amount,
+                lines_count=F('lines_count') + lines,
+            )
+
+
+def set_group_totals(group: OperationGroup, operations: Iterable[Operation]) -> None:
+    """ Заполняет операции и итоги группы до bulk_create, минуя сигналы.
+    """
+    group.total_quantity, group.total_amount, group.lines_count = 0, Decimal('0'), 0
     for operation in operations:
-        if operation.action == Action.SALE:
-            result -= operation.quantity
-        else:
-            result += operation.quantity
-    return result
\ No newline at end of file
+        operation.calculate(group.action)
+        group.total_quantity += operation.quantity
+        group.total_amount += operation.amount
+        group.lines_count += 1
+
+
+def group_stock_deltas(operation_group_id: int, factor: int) -> Dict[int, int]:
+    """ Суммарное количество товаров группы, умноженное на factor.
+    """
+    deltas: Dict[int, int] = defaultdict(int)
+    rows = (
+        Operation.objects.filter(operation_group_id=operation_group_id)
+        .order_by()
+        .values('product_id')
+        .annotate(total=Sum('quantity'))
+    )
+    for row in rows:
+        deltas[row['product_id']] += row['total'] * factor
+    return deltas
+
+
+def compute_stock() -> Dict[int, int]:
+    """ Остатки всех товаров, посчитанные заново: начальный остаток из архива и рабочие операции.
+    """
+    opening = dict(OpeningBalance.objects.values_list('product_id', 'quantity'))
+    return {
+        product_id: remaining + opening.get(product_id, 0)
+        for product_id, remaining in Product.objects.order_by().annotate(remaining=remaining_expression()).values_list('id', 'remaining')
+    }
+
+
+def rebuild_stock(fix: bool = True) -> List[Tuple[int, int, int]]:
+    """ Сверяет таблицу Stock с историей операций.
+
+    Возвращает список расхождений (product_id, сохранено, фактически),
+    при fix=True исправляет их.
+    """
+    with transaction.atomic():
+        lock_archive()
+        stored = dict(Stock.objects.select_for_update().values_list('product_id', 'quantity'))
+        actual = compute_stock()
+        mismatches = [
+            (product_id, stored.get(product_id), quantity)
+            for product_id, quantity in sorted(actual.items())
+            if stored.get(product_id) != quantity
+        ]
+        if fix and mismatches:
+            now = timezone.now()
+            Stock.objects.bulk_create(
+                [Stock(product_id=product_id, quantity=quantity, updated_at=now) for product_id, old, quantity in mismatches if old is None]
+            )
+            Stock.objects.bulk_update(
+                [
+                    Stock(product_id=product_id, quantity=quantity, version=F('version') + 1, updated_at=now)
+                    for product_id, old, quantity in mismatches if old is not None
+                ],
+                ['quantity', 'version', 'updated_at'],
+                batch_size=1000,
+            )
+            stockindex.refresh_on_commit(product_id for product_id, old, quantity in mismatches)
+    return mismatches
+
+
+def rebuild_totals(fix: bool = True) -> Tuple[List[tuple], List[tuple]]:
+    """ Сверяет хранимые суммы операций и итоги групп с исходными данными.
+
+    Возвращает расхождения операций (id, сохранено, фактически) и групп
+    (id, сохранено, фактически), где значения - кортежи (количество, сумма, строк)
+    для групп и (сумма, количество со знаком) для операций.
+    При fix=True исправляет их, а с исправленным количеством со знаком - и остатки.
+    """
+    operation_mismatches = []
+    totals: Dict[int, list] = defaultdict(lambda: [0, Decimal('0'), 0])
+    with transaction.atomic():
+        lock_archive()
+        groups = dict(
+            OperationGroup.objects.select_for_update().order_by()
+            .values_list('id', 'action')
+        )
+        rows = (
+            Operation.objects.order_by('id')
+            .values_list('id', 'operation_group_id', 'quantity', 'price', 'discount', 'amount', 'signed_quantity')
+            .iterator(chunk_size=2000)
+        )
+        for pk, group_id, quantity, price, discount, amount, signed in rows:
+            actual = (operation_amount(quantity, price, discount), signed_quantity(groups[group_id], quantity))
+            if (amount, signed) != actual:
+                operation_mismatches.append((pk, (amount, signed), actual))
+            group_totals = totals[group_id]
+            group_totals[0] += quantity
+            group_totals[1] += actual[0]
+            group_totals[2] += 1
+
+        group_mismatches = []
+        for pk, quantity, amount, lines in (
+            OperationGroup.objects.order_by('id')
+            .values_list('id', 'total_quantity', 'total_amount', 'lines_count')
+            .iterator(chunk_size=2000)
+        ):
+            actual = tuple(totals.get(pk, (0, Decimal('0'), 0)))
+            if (quantity, amount, lines) != actual:
+                group_mismatches.append((pk, (quantity, amount, lines), actual))
+
+        if fix:
+            # исправленные суммы - изменение операций, потребители журнала должны его увидеть
+            states = events.operation_states(Operation.objects.filter(pk__in=[pk for pk, old, actual in operation_mismatches]))
+            events.write(
+                events.event(
+                    EventKind.UPDATE, states[pk]['group'], pk,
+                    before=states[pk], after=dict(states[pk], amount=amount, signed_quantity=signed),
+                )
+                for pk, old, (amount, signed) in operation_mismatches
+            )
+            Operation.objects.bulk_update(
+                [Operation(pk=pk, amount=amount, signed_quantity=signed) for pk, old, (amount, signed) in operation_mismatches],
+                ['amount', 'signed_quantity'],
+                batch_size=1000,
+            )
+            OperationGroup.objects.bulk_update(
+                [
+                    OperationGroup(pk=pk, total_quantity=quantity, total_amount=amount, lines_count=lines)
+                    for pk, old, (quantity, amount, lines) in group_mismatches
+                ],
+                list(OperationGroup.TOTAL_FIELDS),
+                batch_size=1000,
+            )
+            if operation_mismatches:
+                _fix_stock_after_totals(states, operation_mismatches)
+    return operation_mismatches, group_mismatches
+
+
+def _fix_stock_after_totals(states: Dict[int, dict], operation_mismatches: List[tuple]) -> None:
+    # bulk_update идет мимо сигналов: остатки, снимки и кеш правятся здесь
+    from .snapshots import apply_snapshot_deltas
+
+    apply_snapshot_deltas(
+        (states[pk]['product'], states[pk]['created_at'], signed - states[pk]['signed_quantity'])
+        for pk, old, (amount, signed) in operation_mismatches
+    )
+    rebuild_stock(fix=True)
+    cache.invalidate_operations(
+        {state['product'] for state in states.values()},
+        {state['counterparty'] for state in states.values()},
+    )
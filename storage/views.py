@@ -1,3 +1,233 @@
-from django.shortcuts import render
+import hashlib
+from datetime import datetime
+from functools import wraps
+from typing import Iterable, Optional
 
-# Create your views here.
+from asgiref.sync import sync_to_async
+from django.core.files.storage import default_storage
+from django.db.models import Count, Max, Sum
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, Http404, HttpResponseBadRequest, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from . import stockindex
+from .images import rendition_name, rendition_urls
+from .models import Category, Product, Operation, Stock
+
+
+MAX_BATCH = 1000
+
+PAGE_SIZE = 100
+
+MAX_PAGE_SIZE = 1000
+
+
+def make_etag(parts: Iterable) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b'|')
+    return f'"{digest.hexdigest()}"'
+
+
+def conditional(request, etag: str, last_modified: Optional[datetime]):
+    """ 304 для клиентов с актуальной версией, иначе None.
+    """
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+
+def with_validators(response, etag: str, last_modified: Optional[datetime]):
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def staff_required(view):
+    """ Доступ как в админке: только активные сотрудники (is_staff). Ответы содержат
+    цены и скидки, анонимный клиент получает 401, остальные - 403.
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        user = await request.auser()
+        if not user.is_authenticated:
+            return JsonResponse({'detail': "Требуется вход"}, status=401)
+        if not (user.is_active and user.is_staff):
+            return JsonResponse({'detail': "Недостаточно прав"}, status=403)
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def parse_ids(value: str) -> list:
+    try:
+        ids = sorted({int(item) for item in value.split(',') if item.strip()})
+    except ValueError:
+        raise ValueError("ids должны быть числами через запятую")
+    if len(ids) > MAX_BATCH:
+        raise ValueError(f"не больше {MAX_BATCH} товаров за запрос")
+    return ids
+
+
+@require_safe
+@staff_required
+async def product_stock(request, pk):
+    """ Остаток одного товара.
+    """
+    stock = await Stock.objects.filter(product_id=pk).values(
+        'quantity', 'updated_at', 'product__name', 'product__updated_at', 'product__image_hash',
+    ).afirst()
+    if stock is None:
+        raise Http404("Товар не найден")
+    last_modified = max(stock['updated_at'], stock['product__updated_at'])
+    etag = make_etag((pk, stock['quantity'], last_modified.isoformat(), stock['product__image_hash']))
+    not_modified = conditional(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    return with_validators(JsonResponse({
+        'id': pk,
+        'name': stock['product__name'],
+        'remaining': stock['quantity'],
+        'updated_at': stock['updated_at'].isoformat(),
+        'images': rendition_urls(stock['product__image_hash']) if stock['product__image_hash'] else None,
+    }), etag, last_modified)
+
+
+@require_safe
+@staff_required
+async def stock_batch(request):
+    """ Остатки нескольких товаров: ?ids=1,2,3.
+    """
+    try:
+        ids = parse_ids(request.GET.get('ids', ''))
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc))
+    # общий индекс остатков отвечает без базы, из Stock читаются только товары, которых в нем нет
+    if stockindex.due():
+        await sync_to_async(stockindex.reconcile_if_due)()
+    indexed = stockindex.lookup(ids)
+    rows = [
+        (product_id, quantity, version, stockindex.stamp_datetime(stamp)) for product_id, (quantity, version, stamp) in indexed.items()
+    ]
+    rest = [product_id for product_id in ids if product_id not in indexed]
+    if rest:
+        rows += [
+            row async for row in Stock.objects.filter(product_id__in=rest).values_list('product_id', 'quantity', 'version', 'updated_at')
+        ]
+    rows.sort()
+    last_modified = max((updated_at for product_id, quantity, version, updated_at in rows), default=None)
+    # версия меняется с каждым изменением остатка, время изменения может совпасть
+    etag = make_etag(item for product_id, quantity, version, updated_at in rows for item in (product_id, quantity, version))
+    not_modified = conditional(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    return with_validators(JsonResponse({
+        'results': [{'id': product_id, 'remaining': quantity} for product_id, quantity, version, updated_at in rows],
+        'missing': sorted(set(ids) - {row[0] for row in rows}),
+    }), etag, last_modified)
+
+
+@require_safe
+@staff_required
+async def category_stock(request):
+    """ Сводка остатков по категориям.
+    """
+    stocks = await Stock.objects.aaggregate(updated_at=Max('updated_at'), products=Count('product_id'))
+    categories = await Category.objects.aaggregate(updated_at=Max('updated_at'), count=Count('id'))
+    # перенос товара в другую категорию меняет только Product.updated_at
+    products = await Product.objects.aaggregate(updated_at=Max('updated_at'), count=Count('id'))
+    last_modified = max(filter(None, (stocks['updated_at'], categories['updated_at'], products['updated_at'])), default=None)
+    etag = make_etag((
+        stocks['updated_at'], stocks['products'], categories['updated_at'], categories['count'], products['updated_at'], products['count'],
+    ))
+    not_modified = conditional(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+    rows = (
+        Stock.objects.order_by('product__category_id')
+        .values('product__category_id', 'product__category__name')
+        .annotate(products=Count('product_id'), remaining=Coalesce(Sum('quantity'), 0))
+    )
+    return with_validators(JsonResponse({
+        'results': [
+            {
+                'id': row['product__category_id'],
+                'name': row['product__category__name'],
+                'products': row['products'],
+                'remaining': row['remaining'],
+            }
+            async for row in rows
+        ],
+    }), etag, last_modified)
+
+
+@require_safe
+@staff_required
+async def operation_history(request):
+    """ История операций от новых к старым, постранично по id: ?product=&before=&limit=.
+    """
+    try:
+        limit = min(int(request.GET.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+        before = int(request.GET['before']) if request.GET.get('before') else None
+        product = int(request.GET['product']) if request.GET.get('product') else None
+    except ValueError:
+        return HttpResponseBadRequest("limit, before и product должны быть числами")
+    if limit < 1:
+        return HttpResponseBadRequest("limit должен быть не меньше 1")
+
+    operations = Operation.objects.order_by('-id')
+    if product is not None:
+        operations = operations.filter(product_id=product)
+    if before is not None:
+        # keyset: следующая страница - строки с id меньше последнего, без OFFSET
+        operations = operations.filter(id__lt=before)
+    rows = [
+        row async for row in operations.values(
+            'id', 'product_id', 'operation_group_id', 'operation_group__action', 'quantity', 'price', 'discount', 'updated_at',
+        )[:limit + 1]
+    ]
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    last_modified = max((row['updated_at'] for row in rows), default=None)
+    etag = make_etag(item for row in rows for item in (row['id'], row['updated_at'].isoformat()))
+    not_modified = conditional(request, etag, last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    next_url = None
+    if has_next:
+        query = request.GET.copy()
+        query['before'] = rows[-1]['id']
+        next_url = f'{request.path}?{query.urlencode()}'
+    return with_validators(JsonResponse({
+        'results': [
+            {
+                'id': row['id'],
+                'product': row['product_id'],
+                'group': row['operation_group_id'],
+                'action': row['operation_group__action'],
+                'quantity': row['quantity'],
+                'price': str(row['price']),
+                'discount': str(row['discount']),
+                'updated_at': row['updated_at'].isoformat(),
+            }
+            for row in rows
+        ],
+        'next': next_url,
+    }), etag, last_modified)
+
+
+@require_safe
+def rendition(request, image_hash, size, fmt):
+    """ Уменьшенная копия изображения. Имя содержит хеш оригинала, поэтому кешируется на год.
+    """
+    name = rendition_name(image_hash, size, fmt)
+    if not default_storage.exists(name):
+        raise Http404("Изображение еще не готово")
+    response = FileResponse(default_storage.open(name, 'rb'), content_type='image/webp' if fmt == 'webp' else 'image/jpeg')
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response